@@ -10,6 +10,7 @@ from antgo.resource.html import *
 from antgo.ant.base import *
 from antgo.dataflow.common import *
 from antgo.measures.statistic import *
+from antgo.measures.base import eva_measures
 from antgo.task.task import *
 from antgo.utils import logger
 from antgo.dataflow.recorder import *
@@ -128,7 +129,8 @@ class AntChallenge(AntBase):
     with safe_recorder_manager(ant_test_dataset):
       # split data and label
       data_annotation_branch = DataAnnotationBranch(Node.inputs(ant_test_dataset))
-      self.context.recorder = RecorderNode(Node.inputs(data_annotation_branch.output(1)))
+      self.context.recorder = RecorderNode(Node.inputs(data_annotation_branch.output(1)),
+                                           record_format=getattr(self.context.params, 'record_format', 'rocksdb'))
 
       self.stage = "CHALLENGE"
       logger.info('start infer process')
@@ -168,6 +170,11 @@ class AntChallenge(AntBase):
       logger.info('start evaluation process')
       evaluation_measure_result = []
       with safe_recorder_manager(RecordReader(intermediate_dump_dir)) as record_reader:
+        # all non crowdsource measures are evaluated in one pass over records
+        offline_measures = [measure for measure in running_ant_task.evaluation_measures if not measure.crowdsource]
+        record_generator = record_reader.iterate_read('predict', 'groundtruth')
+        offline_measure_result = dict(zip(offline_measures, eva_measures(record_generator, offline_measures)))
+
         for measure in running_ant_task.evaluation_measures:
           if measure.crowdsource:
             # start crowdsource server
@@ -188,8 +195,7 @@ class AntChallenge(AntBase):
             # TODO: support bootstrap confidence interval for crowdsource evaluation
           else:
             # evaluation
-            record_generator = record_reader.iterate_read('predict', 'groundtruth')
-            result = measure.eva(record_generator, None)
+            result = offline_measure_result[measure]
             if measure.is_support_rank:
               # compute confidence interval
               confidence_interval = bootstrap_confidence_interval(record_reader, time.time(), measure, 50)
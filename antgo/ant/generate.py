@@ -86,9 +86,9 @@ class AntGenerate(AntBase):
         if not os.path.exists(dataset_record_path):
           os.makedirs(dataset_record_path)
 
-        data_writer = RecordWriter(dataset_record_path)
-        for data,label in self.context.data_generator(category):
-          data_writer.write(Sample(data=data, label=label))
+        with RecordWriter(dataset_record_path, batch_size=1000) as data_writer:
+          for data,label in self.context.data_generator(category):
+            data_writer.write(Sample(data=data, label=label))
 
     # rectify is_public and is_local
     if self.dataset_is_local:
@@ -7,7 +7,12 @@ from __future__ import unicode_literals
 
 import tarfile
 from datetime import datetime
+import multiprocessing
 from multiprocessing import Process
+try:
+  import queue
+except:
+  import Queue as queue
 
 from antgo.ant import flags
 from antgo.ant.base import *
@@ -15,6 +20,8 @@ from antgo.ant.utils import *
 from antgo.dataflow.common import *
 from antgo.dataflow.recorder import *
 from antgo.measures.statistic import *
+from antgo.measures.repeat_statistic import *
+from antgo.measures.base import eva_measures
 from antgo.task.task import *
 from antgo.utils.net import *
 from antgo.utils.serialize import *
@@ -286,77 +293,214 @@ class AntTrain(AntBase):
     evaluation_measure_result = []
 
     with safe_recorder_manager(RecordReader(dump_dir)) as record_reader:
-      for measure in evaluation_measures:
-        record_generator = record_reader.iterate_read('predict', 'groundtruth')
-        result = measure.eva(record_generator, None)
-        evaluation_measure_result.append(result)
+      record_generator = record_reader.iterate_read('predict', 'groundtruth')
+      evaluation_measure_result.extend(eva_measures(record_generator, evaluation_measures))
       task_running_statictic[self.ant_name]['measure'] = evaluation_measure_result
 
     return task_running_statictic
 
+  def _estimation_experiment(self, part_train_dataset, part_validation_dataset, evaluation_measures, dump_dir, stage):
+    part_train_dataset.reset_state()
+
+    # 1.step training model
+    self.stage = '%s-TRAIN' % stage
+    self.context.call_training_process(part_train_dataset, dump_dir)
+
+    # 2.step evaluation measures
+    # split data and label
+    data_annotation_branch = DataAnnotationBranch(Node.inputs(part_validation_dataset))
+    self.context.recorder = RecorderNode(Node.inputs(data_annotation_branch.output(1)))
+
+    self.stage = '%s-EVALUATION' % stage
+    with safe_recorder_manager(self.context.recorder):
+      with running_statistic(self.ant_name):
+        self.context.call_infer_process(data_annotation_branch.output(0), dump_dir)
+
+    # clear
+    self.context.recorder = None
+
+    task_running_statictic = get_running_statistic(self.ant_name)
+    task_running_statictic = {self.ant_name: task_running_statictic}
+    task_running_elapsed_time = task_running_statictic[self.ant_name]['time']['elapsed_time']
+    task_running_statictic[self.ant_name]['time']['elapsed_time_per_sample'] = \
+        task_running_elapsed_time / float(part_validation_dataset.size)
+
+    logger.info('start evaluation process')
+    evaluation_measure_result = []
+
+    with safe_recorder_manager(RecordReader(dump_dir)) as record_reader:
+      record_generator = record_reader.iterate_read('predict', 'groundtruth')
+      evaluation_measure_result.extend(eva_measures(record_generator, evaluation_measures))
+      task_running_statictic[self.ant_name]['measure'] = evaluation_measure_result
+
+    # 3.step save statistic (finished experiment is skipped when resuming)
+    self._save_estimation_file(dump_dir, 'estimation.statistic', task_running_statictic)
+    return task_running_statictic
+
+  def _save_estimation_file(self, dump_dir, file_name, content):
+    file_path = os.path.join(dump_dir, file_name)
+    with open('%s.tmp' % file_path, 'wb') as fp:
+      fp.write(dumps(content))
+    os.rename('%s.tmp' % file_path, file_path)
+
+  def _estimation_resume_dir(self, dump_dir):
+    # experiment folder with saved split, in this dump dir or in the same place of experiment to resume from
+    resume_dirs = [dump_dir]
+    if self.context.from_experiment is not None:
+      resume_dirs.append(os.path.join(self.context.from_experiment, os.path.join(*dump_dir.split(os.sep)[-2:])))
+
+    for resume_dir in resume_dirs:
+      if os.path.exists(os.path.join(resume_dir, 'estimation.split')):
+        return resume_dir
+
+    return None
+
+  def _estimation_resume(self, experiments):
+    # splits are random, so finished experiment is reused only if splits of all experiments
+    # are restored (i.e. kfold folds come from one permutation) and its statistic belongs to the restored split
+    resume_dirs = [self._estimation_resume_dir(dump_dir) for _, dump_dir, _, _ in experiments]
+    is_restored = len(experiments) > 0 and all([resume_dir is not None for resume_dir in resume_dirs])
+
+    experiments_statistic = [None] * len(experiments)
+    for experiment_index, (stage, dump_dir, part_train_dataset, part_validation_dataset) in enumerate(experiments):
+      if is_restored:
+        with open(os.path.join(resume_dirs[experiment_index], 'estimation.split'), 'rb') as fp:
+          split = loads(fp.read())
+        part_train_dataset.ids = split['train']
+        part_validation_dataset.ids = split['val']
+
+        statistic_path = os.path.join(resume_dirs[experiment_index], 'estimation.statistic')
+        if os.path.exists(statistic_path):
+          with open(statistic_path, 'rb') as fp:
+            experiments_statistic[experiment_index] = loads(fp.read())
+      else:
+        # statistic of unknown split is never reused
+        if os.path.exists(os.path.join(dump_dir, 'estimation.statistic')):
+          os.remove(os.path.join(dump_dir, 'estimation.statistic'))
+
+      if resume_dirs[experiment_index] != dump_dir or not is_restored:
+        self._save_estimation_file(dump_dir, 'estimation.split', {'train': np.asarray(part_train_dataset.ids),
+                                                                  'val': np.asarray(part_validation_dataset.ids)})
+        if experiments_statistic[experiment_index] is not None:
+          self._save_estimation_file(dump_dir, 'estimation.statistic', experiments_statistic[experiment_index])
+
+    return experiments_statistic
+
+  def _estimation_schedule(self, experiments, evaluation_measures, method):
+    # experiments - [(stage, dump_dir, part_train_dataset, part_validation_dataset), ...]
+    # independent experiments run concurrently in at most 'estimation_processes' processes (0 - all cpus)
+    processes = int(getattr(self.context.params, 'estimation_processes', 1))
+    if processes <= 0:
+      processes = multiprocessing.cpu_count()
+    apply_devices = getattr(self.context.params, 'devices', [])
+
+    # child func
+    def proc_func(handle, experiment_index, part_train_dataset, part_validation_dataset, dump_dir, stage, spare_device, statistic_queue):
+      # proc_func is running in a new process
+      handle.flash()
+
+      if spare_device is not None:
+        # reassign running device
+        handle.context.params.devices = [spare_device]
+        # only one clone
+        handle.context.params.num_clones = 1
+
+      statistic_queue.put((experiment_index,
+                           handle._estimation_experiment(part_train_dataset,
+                                                         part_validation_dataset,
+                                                         evaluation_measures,
+                                                         dump_dir,
+                                                         stage)))
+      handle.context.wait_until_clear()
+
+    experiments_statistic = self._estimation_resume(experiments)
+    waiting_experiments = []
+    for experiment_index, (stage, dump_dir, _, _) in enumerate(experiments):
+      if experiments_statistic[experiment_index] is not None:
+        logger.info('resume %s from finished experiment' % stage)
+      else:
+        waiting_experiments.append(experiment_index)
+
+    if processes == 1 or len(waiting_experiments) <= 1:
+      # process sequentially in main process
+      for experiment_index in waiting_experiments:
+        stage, dump_dir, part_train_dataset, part_validation_dataset = experiments[experiment_index]
+        experiments_statistic[experiment_index] = self._estimation_experiment(part_train_dataset,
+                                                                              part_validation_dataset,
+                                                                              evaluation_measures,
+                                                                              dump_dir,
+                                                                              stage)
+    else:
+      # apply independent processes, statistic is streamed back as soon as experiment finish
+      statistic_queue = multiprocessing.Queue()
+      running_experiments = {}
+      while len(waiting_experiments) > 0 or len(running_experiments) > 0:
+        while len(waiting_experiments) > 0 and len(running_experiments) < processes:
+          experiment_index = waiting_experiments.pop(0)
+          stage, dump_dir, part_train_dataset, part_validation_dataset = experiments[experiment_index]
+          spare_device = apply_devices[experiment_index % len(apply_devices)] if len(apply_devices) > 0 else None
+          experiment_process = Process(target=proc_func,
+                                       args=(self,
+                                             experiment_index,
+                                             part_train_dataset,
+                                             part_validation_dataset,
+                                             dump_dir,
+                                             stage,
+                                             spare_device,
+                                             statistic_queue),
+                                       name='%s_%s' % (self.ant_name, stage.lower()))
+          experiment_process.start()
+          running_experiments[experiment_index] = experiment_process
+
+        try:
+          experiment_index, experiment_statistic = statistic_queue.get(timeout=1)
+          experiments_statistic[experiment_index] = experiment_statistic
+          running_experiments.pop(experiment_index).join()
+          logger.info('finish %s' % experiments[experiment_index][0])
+        except queue.Empty:
+          for experiment_index, experiment_process in list(running_experiments.items()):
+            if not experiment_process.is_alive() and experiment_process.exitcode != 0:
+              running_experiments.pop(experiment_index)
+              logger.error('%s exit abnormally (code %d), resume it by from_experiment' %
+                           (experiments[experiment_index][0], experiment_process.exitcode))
+
+    experiments_statistic = [s for s in experiments_statistic if s is not None]
+    if len(experiments_statistic) < len(experiments):
+      logger.error('only %d/%d experiments finished in %s' % (len(experiments_statistic), len(experiments), method))
+    if len(experiments_statistic) == 0:
+      return None
+
+    evaluation_result = multi_repeats_measures_statistic(experiments_statistic, method=method)
+    return evaluation_result
+
   def _repeated_holdout_validation(self, repeats,
                                    train_dataset,
                                    split_ratio,
                                    is_stratified_sampling,
                                    evaluation_measures,
                                    nowtime):
-    repeated_running_statistic = []
+    experiments = []
     for repeat in range(repeats):
       # 1.step split train set and validation set
       part_train_dataset, part_validation_dataset = train_dataset.split(split_params={'ratio': split_ratio,
                                                                                       'is_stratified': is_stratified_sampling},
                                                                         split_method='repeated-holdout')
-      part_train_dataset.reset_state()
       # dump_dir
       dump_dir = os.path.join(self.ant_dump_dir, nowtime, 'train', 'repeated-holdout-evaluation', 'repeat-%d'%repeat)
       if not os.path.exists(dump_dir):
         os.makedirs(dump_dir)
 
-      # 2.step training model
-      self.stage = 'EVALUATION-REPEATEDHOLDOUT-TRAIN-%d' % repeat
-      self.context.call_training_process(part_train_dataset, dump_dir)
-
-      # 3.step evaluation measures
-      # split data and label
-      data_annotation_branch = DataAnnotationBranch(Node.inputs(part_validation_dataset))
-      self.context.recorder = RecorderNode(Node.inputs(data_annotation_branch.output(1)))
-
-      self.stage = 'EVALUATION-REPEATEDHOLDOUT-EVALUATION-%d' % repeat
-      with safe_recorder_manager(self.context.recorder):
-        with running_statistic(self.ant_name):
-          self.context.call_infer_process(data_annotation_branch.output(0), dump_dir)
-
-      # clear
-      self.context.recorder = None
-
-      task_running_statictic = get_running_statistic(self.ant_name)
-      task_running_statictic = {self.ant_name: task_running_statictic}
-      task_running_elapsed_time = task_running_statictic[self.ant_name]['time']['elapsed_time']
-      task_running_statictic[self.ant_name]['time']['elapsed_time_per_sample'] = \
-          task_running_elapsed_time / float(part_validation_dataset.size)
-
-      logger.info('start evaluation process')
-      evaluation_measure_result = []
-
-      with safe_recorder_manager(RecordReader(dump_dir)) as record_reader:
-        for measure in evaluation_measures:
-          record_generator = record_reader.iterate_read('predict', 'groundtruth')
-          result = measure.eva(record_generator, None)
-          evaluation_measure_result.append(result)
-        task_running_statictic[self.ant_name]['measure'] = evaluation_measure_result
+      experiments.append(('EVALUATION-REPEATEDHOLDOUT-%d' % repeat, dump_dir, part_train_dataset, part_validation_dataset))
 
-      repeated_running_statistic.append(task_running_statictic)
-
-    evaluation_result = multi_repeats_measures_statistic(repeated_running_statistic, method='repeated-holdout')
-    return evaluation_result
+    # 2.step training and evaluation
+    return self._estimation_schedule(experiments, evaluation_measures, 'repeated-holdout')
 
   def _bootstrap_validation(self, bootstrap_rounds, train_dataset, evaluation_measures, nowtime):
-    bootstrap_running_statistic = []
+    experiments = []
     for bootstrap_i in range(bootstrap_rounds):
       # 1.step split train set and validation set
       part_train_dataset, part_validation_dataset = train_dataset.split(split_params={},
                                                                         split_method='bootstrap')
-      part_train_dataset.reset_state()
       # dump_dir
       dump_dir = os.path.join(self.ant_dump_dir,
                               nowtime,
@@ -366,95 +510,28 @@ class AntTrain(AntBase):
       if not os.path.exists(dump_dir):
         os.makedirs(dump_dir)
 
-      # 2.step training model
-      self.stage = 'EVALUATION-BOOTSTRAP-TRAIN-%d' % bootstrap_i
-      self.context.call_training_process(part_train_dataset, dump_dir)
-
-      # 3.step evaluation measures
-      # split data and label
-      data_annotation_branch = DataAnnotationBranch(Node.inputs(part_validation_dataset))
-      self.context.recorder = RecorderNode(Node.inputs(data_annotation_branch.output(1)))
-
-      self.stage = 'EVALUATION-BOOTSTRAP-EVALUATION-%d' % bootstrap_i
-      with safe_recorder_manager(self.context.recorder):
-        with running_statistic(self.ant_name):
-          self.context.call_infer_process(data_annotation_branch.output(0), dump_dir)
-
-      # clear
-      self.context.recorder = None
-
-      task_running_statictic = get_running_statistic(self.ant_name)
-      task_running_statictic = {self.ant_name: task_running_statictic}
-      task_running_elapsed_time = task_running_statictic[self.ant_name]['time']['elapsed_time']
-      task_running_statictic[self.ant_name]['time']['elapsed_time_per_sample'] = \
-          task_running_elapsed_time / float(part_validation_dataset.size)
-
-      logger.info('start evaluation process')
-      evaluation_measure_result = []
+      experiments.append(('EVALUATION-BOOTSTRAP-%d' % bootstrap_i, dump_dir, part_train_dataset, part_validation_dataset))
 
-      with safe_recorder_manager(RecordReader(dump_dir)) as record_reader:
-        for measure in evaluation_measures:
-          record_generator = record_reader.iterate_read('predict', 'groundtruth')
-          result = measure.eva(record_generator, None)
-          evaluation_measure_result.append(result)
-        task_running_statictic[self.ant_name]['measure'] = evaluation_measure_result
-
-      bootstrap_running_statistic.append(task_running_statictic)
-
-    evaluation_result = multi_repeats_measures_statistic(bootstrap_running_statistic, method='bootstrap')
-    return evaluation_result
+    # 2.step training and evaluation
+    return self._estimation_schedule(experiments, evaluation_measures, 'bootstrap')
 
   def _kfold_cross_validation(self, kfolds, train_dataset, evaluation_measures, nowtime):
     assert (kfolds in [5, 10])
-    kfolds_running_statistic = []
+    experiments = []
     for k in range(kfolds):
       # 1.step split train set and validation set
       part_train_dataset, part_validation_dataset = train_dataset.split(split_params={'kfold': kfolds,
                                                                                       'k': k},
                                                                         split_method='kfold')
-      part_train_dataset.reset_state()
       # dump_dir
       dump_dir = os.path.join(self.ant_dump_dir, nowtime, 'train', 'kfold-evaluation', 'fold-%d-evaluation' % k)
       if not os.path.exists(dump_dir):
         os.makedirs(dump_dir)
 
-      # 2.step training model
-      self.stage = 'EVALUATION-KFOLD-TRAIN-%d' % k
-      self.context.call_training_process(part_train_dataset, dump_dir)
+      experiments.append(('EVALUATION-KFOLD-%d' % k, dump_dir, part_train_dataset, part_validation_dataset))
 
-      # 3.step evaluation measures
-      # split data and label
-      data_annotation_branch = DataAnnotationBranch(Node.inputs(part_validation_dataset))
-      self.context.recorder = RecorderNode(Node.inputs(data_annotation_branch.output(1)))
-
-      self.stage = 'EVALUATION-KFOLD-EVALUATION-%d' % k
-      with safe_recorder_manager(self.context.recorder):
-        with running_statistic(self.ant_name):
-          self.context.call_infer_process(data_annotation_branch.output(0), dump_dir)
-
-      # clear
-      self.context.recorder = None
-
-      task_running_statictic = get_running_statistic(self.ant_name)
-      task_running_statictic = {self.ant_name: task_running_statictic}
-      task_running_elapsed_time = task_running_statictic[self.ant_name]['time']['elapsed_time']
-      task_running_statictic[self.ant_name]['time']['elapsed_time_per_sample'] = \
-          task_running_elapsed_time / float(part_validation_dataset.size)
-
-      logger.info('start evaluation process')
-      evaluation_measure_result = []
-
-      with safe_recorder_manager(RecordReader(dump_dir)) as record_reader:
-        for measure in evaluation_measures:
-          record_generator = record_reader.iterate_read('predict', 'groundtruth')
-          result = measure.eva(record_generator, None)
-          evaluation_measure_result.append(result)
-        task_running_statictic[self.ant_name]['measure'] = evaluation_measure_result
-
-      kfolds_running_statistic.append(task_running_statictic)
-
-    evaluation_result = multi_repeats_measures_statistic(kfolds_running_statistic, method='kfold')
-    return evaluation_result
+    # 2.step training and evaluation
+    return self._estimation_schedule(experiments, evaluation_measures, 'kfold')
 
   def start_ablation_train_proc(self, data_source, challenge_task, ablation_blocks, time_stamp, spare_devices=None):
     # child func
@@ -498,10 +575,9 @@ class AntTrain(AntBase):
       ablation_evaluation_measure_result = []
 
       with safe_recorder_manager(RecordReader(ablation_dump_dir)) as record_reader:
-        for measure in experiment_challenge_task.evaluation_measures:
-          record_generator = record_reader.iterate_read('predict', 'groundtruth')
-          result = measure.eva(record_generator, None)
-          ablation_evaluation_measure_result.append(result)
+        record_generator = record_reader.iterate_read('predict', 'groundtruth')
+        ablation_evaluation_measure_result.extend(eva_measures(record_generator,
+                                                               experiment_challenge_task.evaluation_measures))
 
       ablation_running_statictic[handle.ant_name]['measure'] = ablation_evaluation_measure_result
       handle.stage = 'ABLATION-%s-REPORT' % ablation_block
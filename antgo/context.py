@@ -184,6 +184,10 @@ class Context(object):
     self.data_source = data_source
     self.infer_process(data_source, dump_dir)
 
+    # flush pending records
+    if self.recorder is not None:
+      self.recorder.flush()
+
     # clone charts
     self.job.clone_charts()
   
@@ -5,12 +5,13 @@
 from __future__ import division
 from __future__ import unicode_literals
 from __future__ import print_function
-from antgo.utils.serialize import loads, dumps
+from antgo.utils.serialize import loads, loads_fields, dumps
 import numpy as np
 import os
 import traceback
 import sys
 import yaml
+import struct
 try:
   import rocksdb
 except:
@@ -28,37 +29,114 @@ class Sample(object):
     return dumps(self.data)
 
   @staticmethod
-  def unserialize(bytes_data):
-    return loads(bytes_data)
+  def unserialize(bytes_data, fields=None):
+    if fields is None or len(fields) == 0:
+      return loads(bytes_data)
+
+    return loads_fields(bytes_data, fields)
+
+
+def record_key(index, key_format='binary'):
+  # binary keys (fixed width, big endian) keep rocksdb iterator order consistent with sample order
+  if key_format == 'binary':
+    return struct.pack('>Q', int(index))
+
+  # legacy decimal string keys
+  return str(index).encode('utf-8')
+
+
+def record_key_format(db):
+  key_format = db.get(str('attrib-key_format').encode('utf-8'))
+  if key_format is not None:
+    return key_format.decode('utf-8').replace('attrib-', '')
+
+  if db.get(str('attrib-count').encode('utf-8')) is not None:
+    # db created before binary keys
+    return 'decimal'
+
+  return None
 
 
 class RecordWriter(object):
-  def __init__(self, record_path):
+  def __init__(self, record_path, batch_size=1, batch_bytes=0, db=None):
+    # batch_size: flush pending samples every batch_size samples
+    # batch_bytes: flush pending samples once their serialized size exceeds batch_bytes
     self._record_path = record_path
-    opts = rocksdb.Options()
-    opts.create_if_missing = True
-    self._db = rocksdb.DB(record_path, opts)
-    
+    if db is None:
+      opts = rocksdb.Options()
+      opts.create_if_missing = True
+      db = rocksdb.DB(record_path, opts)
+    self._db = db
+
     count = self._db.get(str('attrib-count').encode('utf-8'))
     if count is None:
+      self._db.put(str('attrib-key_format').encode('utf-8'), b'attrib-binary')
       self._db.put(str('attrib-count').encode('utf-8'), b'0')
-    
+      count = 0
+    self._key_format = record_key_format(self._db)
+
+    # batched mode keeps sample counter in memory and flush it together with samples
+    self._batch_size = max(int(batch_size), 1)
+    self._batch_bytes = int(batch_bytes)
+    self._count = int(count)
+    self._batch = None
+    self._batch_num = 0
+    self._batch_nbytes = 0
+
+  @property
+  def is_batched(self):
+    return self._batch_size > 1 or self._batch_bytes > 0
+
+  def flush(self):
+    if self._batch is None:
+      return
+
+    self._batch.put(str('attrib-count').encode('utf-8'), str(self._count).encode('utf-8'))
+    self._db.write(self._batch)
+
+    self._batch = None
+    self._batch_num = 0
+    self._batch_nbytes = 0
+
   def close(self):
-    pass
+    self.flush()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_val, exc_tb):
+    self.close()
 
   def write(self, sample, sample_index=-1):
-    count = self._db.get(str('attrib-count').encode('utf-8'))
-    assert(count is not None)
-    count = int(count)
+    sample_key = record_key(self._count if sample_index < 0 else sample_index, self._key_format)
+    sample_bytes = sample.serialize()
+    self._count += 1
 
-    sample_key = str(count).encode('utf-8')
-    if sample_index > 0:
-      sample_key = str(sample_index).encode('utf-8')
-    self._db.put(sample_key, sample.serialize())
+    if not self.is_batched:
+      self._db.put(sample_key, sample_bytes)
+      self._db.put(str('attrib-count').encode('utf-8'), str(self._count).encode('utf-8'))
+      return
+
+    if self._batch is None:
+      self._batch = rocksdb.WriteBatch()
+    self._batch.put(sample_key, sample_bytes)
+    self._batch_num += 1
+    self._batch_nbytes += len(sample_bytes)
+
+    if self._batch_num >= self._batch_size or \
+        (self._batch_bytes > 0 and self._batch_nbytes >= self._batch_bytes):
+      self.flush()
+
+  def put(self, key, data):
+    # extra key, in batched mode committed atomically together with pending samples
+    if not self.is_batched:
+      self._db.put(str(key).encode('utf-8'), str(data).encode('utf-8'))
+      return
+
+    if self._batch is None:
+      self._batch = rocksdb.WriteBatch()
+    self._batch.put(str(key).encode('utf-8'), str(data).encode('utf-8'))
 
-    count += 1
-    self._db.put('attrib-count'.encode('utf-8'), str(count).encode('utf-8'))
-    
   def bind_attrs(self, **kwargs):
     # bind extra db attributes
     for k,v in kwargs.items():
@@ -66,12 +144,7 @@ class RecordWriter(object):
   
   @property
   def size(self):
-    count = self._db.get(str('attrib-count').encode('utf-8'))
-    if count is None:
-      return 0
-    
-    count = int(count)
-    return count
+    return self._count
 
 @contextmanager
 def safe_recorder_manager(recorder):
@@ -83,6 +156,14 @@ def safe_recorder_manager(recorder):
 
 
 class RecordReader(object):
+  def __new__(cls, record_path, *args, **kwargs):
+    if cls is RecordReader and os.path.exists(os.path.join(record_path, 'column.yaml')):
+      # columnar record (see antgo.dataflow.column)
+      from antgo.dataflow.column import ColumnRecordReader
+      return ColumnRecordReader(record_path, *args, **kwargs)
+
+    return super(RecordReader, cls).__new__(cls)
+
   def __init__(self, record_path, read_only=True):
     # db
     opts = rocksdb.Options(create_if_missing=False if read_only else True)
@@ -100,16 +181,31 @@ class RecordReader(object):
     for attrib_item in it:
       key, value = attrib_item
       key = key.decode('utf-8')
+      if not key.startswith('attrib-'):
+        break
+
       value = value.decode('utf-8')
-      if key.startswith('attrib-'):
-        key = key.replace('attrib-', '')
-        value = value.replace('attrib-', '')
-        self._db_attrs[key] = value
-        setattr(self, key, value)
+      key = key.replace('attrib-', '')
+      value = value.replace('attrib-', '')
+      self._db_attrs[key] = value
+      setattr(self, key, value)
+
+    self._key_format = None
 
   def close(self):
     pass
 
+  @property
+  def key_encoding(self):
+    if self._key_format is None:
+      key_format = record_key_format(self._db)
+      if key_format is None:
+        # empty db, keys would be created by RecordWriter
+        return 'binary'
+      self._key_format = key_format
+
+    return self._key_format
+
   def record_attrs(self):
     return self._db_attrs
 
@@ -125,71 +221,73 @@ class RecordReader(object):
     return self._db.get(str(key).encode('utf-8'))
 
   def write(self, sample, sample_index=-1):
-    count = self._db.get(str('attrib-count').encode('utf-8'))
-    if count is None:
-      self._db.put(str('attrib-count').encode('utf-8'), b'0')
-      count = 0
+    with RecordWriter(self._record_path, db=self._db) as record_writer:
+      record_writer.write(sample, sample_index)
 
-    count = int(count)
-    sample_key = str(count).encode('utf-8')
-    if sample_index >=0 :
-      sample_key = str(sample_index).encode('utf-8')
-    self._db.put(sample_key, sample.serialize())
+  def batch_writer(self, batch_size=1000, batch_bytes=0):
+    # batched writer sharing this db (should be used as context manager)
+    return RecordWriter(self._record_path, batch_size=batch_size, batch_bytes=batch_bytes, db=self._db)
+
+  def _decode(self, ss, args):
+    data = Sample.unserialize(ss, args)
+    if len(args) == 0:
+      return [data_val for _, data_val in data.items()]
 
-    count += 1
-    self._db.put('attrib-count'.encode('utf-8'), str(count).encode('utf-8'))
+    return [data.get(data_key, None) for data_key in args]
 
   def read(self, index, *args):
     try:
-      ss = self._db.get(str(index).encode('utf-8'))
-      data = Sample.unserialize(ss)
-      sample = []
-      if len(args) == 0:
-        for k, v in data.items():
-          sample.append(v)
-      else:
-        for k in args:
-          if k in data:
-            sample.append(data[k])
-          else:
-            sample.append(None)
-
-      return sample
+      ss = self._db.get(record_key(index, self.key_encoding))
+      return self._decode(ss, args)
     except:
       return [None for _ in range(len(args))]
 
+  def read_range(self, start, stop, *args):
+    # bulk read samples in [start, stop)
+    if self.key_encoding != 'binary':
+      return self.read_many(range(start, stop), *args)
+
+    samples = []
+    stop_key = record_key(stop)
+    it = self._db.iteritems()
+    it.seek(record_key(start))
+    for key, ss in it:
+      if key >= stop_key:
+        break
+      samples.append(self._decode(ss, args))
+
+    return samples
+
+  def read_many(self, index, *args):
+    # bulk read samples at index (duplicated index is fetched once, missing sample is None as read)
+    index_keys = [record_key(i, self.key_encoding) for i in index]
+    index_data = self._db.multi_get(list(set(index_keys)))
+
+    decoded = {}
+    samples = []
+    for key in index_keys:
+      if key not in decoded:
+        if index_data.get(key, None) is None:
+          decoded[key] = [None for _ in range(len(args))]
+        else:
+          decoded[key] = self._decode(index_data[key], args)
+      samples.append(decoded[key])
+
+    return samples
+
+  def iterate_chunk_read(self, chunk_size, *args):
+    count = int(self.count)
+    for start in range(0, count, chunk_size):
+      yield self.read_range(start, min(start + chunk_size, count), *args)
+
   def iterate_read(self, *args):
-    for k in range(int(self.count)):
-      ss = self._db.get(str(k).encode('utf-8'))
-      data = Sample.unserialize(ss)
-      sample = []
-      if len(args) == 0:
-        for data_key, data_val in data.items():
-          sample.append(data_val)
-        yield sample
-      else:
-        for data_key in args:
-          if data_key in data:
-            sample.append(data[data_key])
-          else:
-            sample.append(None)
+    for samples in self.iterate_chunk_read(1024, *args):
+      for sample in samples:
         yield sample
 
   def iterate_sampling_read(self, index, *args):
-    for i in index:
-      ss = self._db.get(str(i).encode('utf-8'))
-      data = Sample.unserialize(ss)
-      sample = []
-      if len(args) == 0:
-        for data_key, data_val in data.items():
-          sample.append(data_val)
-        yield sample
-      else:
-        for data_key in args:
-          if data_key in data:
-            sample.append(data[data_key])
-          else:
-            sample.append(None)
+    for start in range(0, len(index), 1024):
+      for sample in self.read_many(index[start:start + 1024], *args):
         yield sample
 
   @property
@@ -199,4 +297,4 @@ class RecordReader(object):
       return 0
 
     count = int(count)
-    return count
\ No newline at end of file
+    return count
@@ -0,0 +1,295 @@
+# encoding=utf-8
+# @Time    : 18-6-5
+# @File    : column.py
+# @Author  : jian<jian@mltalker.com>
+from __future__ import division
+from __future__ import unicode_literals
+from __future__ import print_function
+from antgo.utils.serialize import loads, dumps
+import numpy as np
+import os
+import yaml
+
+# column record layout (one directory)
+#   column.yaml             - attributes, sample count and column description
+#   column-<i>.data         - contiguous payload (raw numpy bytes or msgpack bytes)
+#   column-<i>.index.npy    - per sample (tag, offset, shape) rows
+# fixed shape numpy fields are memory mapped as (count, *shape) arrays, so gathering
+# samples (e.g. bootstrap replica) is an index operation instead of decode pass.
+
+COLUMN_META = 'column.yaml'
+
+# sample value tags
+_TAG_NONE = 0
+_TAG_ARRAY = 1
+_TAG_OBJECT = 2
+_TAG_DICT = 3
+_TAG_ABSENT = 4
+
+
+class _ColumnWriter(object):
+  def __init__(self, record_path, name, column_id):
+    self.name = name
+    self.column_id = column_id
+    self.data_path = os.path.join(record_path, 'column-%d.data' % column_id)
+    self.index_path = os.path.join(record_path, 'column-%d.index.npy' % column_id)
+    self._fp = open(self.data_path, 'wb')
+
+    self.dtype = None
+    self.ndim = None
+    self.tags = []
+    self.offsets = [0]
+    self.shapes = []
+    self.children = {}
+
+  @property
+  def count(self):
+    return len(self.tags)
+
+  def _append(self, tag, payload=b'', shape=()):
+    if len(payload) > 0:
+      self._fp.write(payload)
+    self.tags.append(tag)
+    self.offsets.append(self.offsets[-1] + len(payload))
+    self.shapes.append(shape)
+
+  def pad(self, count):
+    while self.count < count:
+      self._append(_TAG_ABSENT)
+
+  def write(self, value, new_child):
+    if value is None:
+      self._append(_TAG_NONE)
+    elif type(value) == dict and all([type(k) in [str, type(u'')] for k in value.keys()]):
+      index = self.count
+      self._append(_TAG_DICT)
+      for k, v in value.items():
+        if k not in self.children:
+          self.children[k] = new_child('%s/%s' % (self.name, k))
+        child = self.children[k]
+        child.pad(index)
+        child.write(v, new_child)
+    elif type(value) == np.ndarray and value.dtype != np.object_ and \
+        (self.dtype is None or (self.dtype == value.dtype and self.ndim == value.ndim)):
+      self.dtype = value.dtype
+      self.ndim = value.ndim
+      self._append(_TAG_ARRAY, np.ascontiguousarray(value).tobytes(), value.shape)
+    else:
+      self._append(_TAG_OBJECT, dumps(value))
+
+  def flush(self, count):
+    self.pad(count)
+    for child in self.children.values():
+      child.pad(count)
+
+    self._fp.flush()
+    ndim = self.ndim if self.ndim is not None else 0
+    index = np.zeros((count, 2 + ndim), dtype=np.int64)
+    index[:, 0] = self.tags
+    index[:, 1] = self.offsets[:-1]
+    for i, shape in enumerate(self.shapes):
+      if len(shape) == ndim:
+        index[i, 2:] = shape
+    np.save(self.index_path, index)
+
+    fixed_shape = None
+    if count > 0 and self.dtype is not None and (index[:, 0] == _TAG_ARRAY).all():
+      if (index[:, 2:] == index[0, 2:]).all():
+        fixed_shape = index[0, 2:].tolist()
+
+    return {'id': self.column_id,
+            'dtype': str(self.dtype) if self.dtype is not None else None,
+            'ndim': ndim,
+            'size': self.offsets[-1],
+            'fixed': fixed_shape,
+            'children': {k: c.name for k, c in self.children.items()}}
+
+  def close(self):
+    self._fp.close()
+
+
+class ColumnRecordWriter(object):
+  def __init__(self, record_path, **kwargs):
+    self._record_path = record_path
+    if not os.path.exists(record_path):
+      os.makedirs(record_path)
+
+    self._columns = {}
+    self._fields = []
+    self._attrs = {}
+    self._count = 0
+
+  def _new_column(self, name):
+    column = _ColumnWriter(self._record_path, name, len(self._columns))
+    self._columns[name] = column
+    return column
+
+  def write(self, sample, sample_index=-1):
+    # column record is append only
+    assert(sample_index < 0 or sample_index == self._count)
+
+    for k, v in sample.data.items():
+      if k not in self._columns:
+        self._fields.append(k)
+        self._new_column(k)
+      column = self._columns[k]
+      column.pad(self._count)
+      column.write(v, self._new_column)
+
+    self._count += 1
+
+  def bind_attrs(self, **kwargs):
+    for k, v in kwargs.items():
+      self._attrs[k] = str(v)
+
+  def flush(self):
+    meta = {'count': self._count,
+            'attrs': self._attrs,
+            'fields': self._fields,
+            'columns': {}}
+    for name, column in self._columns.items():
+      meta['columns'][name] = column.flush(self._count)
+
+    with open(os.path.join(self._record_path, COLUMN_META), 'w') as fp:
+      yaml.safe_dump(meta, fp)
+
+  def close(self):
+    self.flush()
+    for column in self._columns.values():
+      column.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_val, exc_tb):
+    self.close()
+
+  @property
+  def size(self):
+    return self._count
+
+
+class _ColumnReader(object):
+  def __init__(self, record_path, meta, count):
+    self.meta = meta
+    self.index = np.load(os.path.join(record_path, 'column-%d.index.npy' % meta['id']), mmap_mode='r')
+
+    self.data = None
+    if meta['fixed'] is not None and meta['size'] == 0:
+      self.data = np.zeros(tuple([count] + meta['fixed']), dtype=np.dtype(meta['dtype']))
+    elif meta['size'] > 0:
+      data_path = os.path.join(record_path, 'column-%d.data' % meta['id'])
+      if meta['fixed'] is not None:
+        # read only, returned arrays are views shared by all readers
+        self.data = np.memmap(data_path, dtype=np.dtype(meta['dtype']), mode='r',
+                              shape=tuple([count] + meta['fixed']))
+      else:
+        self.data = np.memmap(data_path, dtype=np.uint8, mode='r', shape=(meta['size'],))
+
+    self.children = {}
+
+  @property
+  def is_fixed(self):
+    return self.meta['fixed'] is not None
+
+  def value(self, i):
+    if self.is_fixed:
+      return self.data[i]
+
+    tag = self.index[i, 0]
+    if tag == _TAG_ARRAY:
+      shape = tuple(self.index[i, 2:])
+      nbytes = int(np.prod(shape)) * np.dtype(self.meta['dtype']).itemsize
+      offset = int(self.index[i, 1])
+      return self.data[offset:offset + nbytes].view(np.dtype(self.meta['dtype'])).reshape(shape)
+    elif tag == _TAG_OBJECT:
+      offset = int(self.index[i, 1])
+      end = int(self.index[i + 1, 1]) if i + 1 < self.index.shape[0] else self.meta['size']
+      return loads(self.data[offset:end].tobytes())
+    elif tag == _TAG_DICT:
+      value = {}
+      for k, child in self.children.items():
+        if child.index[i, 0] != _TAG_ABSENT:
+          value[k] = child.value(i)
+      return value
+
+    return None
+
+  def gather(self, index):
+    if self.is_fixed:
+      return self.data[index]
+
+    return [self.value(i) for i in index]
+
+
+class ColumnRecordReader(object):
+  def __init__(self, record_path, read_only=True):
+    self._record_path = record_path
+    with open(os.path.join(record_path, COLUMN_META), 'r') as fp:
+      self._meta = yaml.safe_load(fp)
+
+    self.count = str(self._meta['count'])
+    self._db_attrs = {'count': self.count}
+    for k, v in self._meta['attrs'].items():
+      self._db_attrs[k] = v
+      setattr(self, k, v)
+
+    count = int(self._meta['count'])
+    columns = {}
+    for name, column_meta in self._meta['columns'].items():
+      columns[name] = _ColumnReader(record_path, column_meta, count)
+    for name, column in columns.items():
+      for k, child_name in column.meta['children'].items():
+        column.children[k] = columns[child_name]
+
+    self._columns = columns
+    self._fields = self._meta['fields']
+
+  def close(self):
+    pass
+
+  def record_attrs(self):
+    return self._db_attrs
+
+  def column(self, name):
+    # memory mapped (count, *shape) array for fixed shape field
+    column = self._columns[name]
+    return column.data if column.is_fixed else None
+
+  def gather(self, index, *args):
+    # columns of samples at index (fixed shape field is returned as stacked array)
+    fields = args if len(args) > 0 else self._fields
+    return [self._columns[k].gather(index) if k in self._columns else [None] * len(index) for k in fields]
+
+  def _sample(self, i, args):
+    fields = args if len(args) > 0 else self._fields
+    return [self._columns[k].value(i) if k in self._columns else None for k in fields]
+
+  def read(self, index, *args):
+    try:
+      return self._sample(index, args)
+    except:
+      return [None for _ in range(len(args))]
+
+  def read_range(self, start, stop, *args):
+    return [self._sample(i, args) for i in range(start, stop)]
+
+  def read_many(self, index, *args):
+    return [self._sample(i, args) for i in index]
+
+  def iterate_chunk_read(self, chunk_size, *args):
+    count = int(self.count)
+    for start in range(0, count, chunk_size):
+      yield self.read_range(start, min(start + chunk_size, count), *args)
+
+  def iterate_read(self, *args):
+    for i in range(int(self.count)):
+      yield self._sample(i, args)
+
+  def iterate_sampling_read(self, index, *args):
+    for i in index:
+      yield self._sample(i, args)
+
+  @property
+  def size(self):
+    return int(self.count)
@@ -8,6 +8,10 @@ from __future__ import print_function
 import copy
 import numpy as np
 import sys
+import os
+import random
+import multiprocessing
+from datetime import datetime
 from antgo.dataflow.core import *
 from antgo.utils import get_rng
 from antgo.utils.concurrency import *
@@ -18,12 +22,28 @@ except:
     import Queue as queue
 
 class BatchData(Node):
-  def __init__(self, inputs, batch_size, remainder=False):
+  """
+  Collate ``batch_size`` datapoints into one batch.
+  Note:
+      1. Samples are padded (zero) to the max shape of batch, any rank is supported. With
+         ``fixed_shape=True`` all samples are assumed to have same shape and padding is skipped.
+      2. With ``ring_size > 0`` batches are written into a ring of preallocated buffers, so a
+         returned batch is only valid until ``ring_size`` more batches are fetched.
+      3. With ``collate_label=True`` labels are collated too. Array labels become padded arrays
+         with length vectors (first dimension of every sample): ``(padded, length)`` for array and
+         tuple item, ``key`` and ``key_length`` for dict item. Scalars become arrays, others stay list.
+  """
+  def __init__(self, inputs, batch_size, remainder=False, fixed_shape=False, ring_size=0, collate_label=False):
     super(BatchData, self).__init__(name=None, action=None, inputs=inputs)
     self.batch_size = batch_size
     self.remainder = remainder
     self.stop_iteration = False
     self.buffer = None
+    self.fixed_shape = fixed_shape
+    self.ring_size = ring_size
+    self.collate_label = collate_label
+    self._ring = [None] * ring_size
+    self._ring_index = 0
 
   def _fetch_batch_data(self):
     try:
@@ -50,11 +70,11 @@ class BatchData(Node):
         if _ != self.batch_size - 1:
           input._force_inputs_dirty()
     
-      batch = BatchData._aggregate_batch(batch_list)
+      batch = self._collate(batch_list)
       # clear reset state
       self._iteration_reset_state = False
       
-      return batch, label_list
+      return batch, self._collate_label(label_list)
     except StopIteration:
       if self.stop_iteration or not self.remainder or len(batch_list) == 0:
         # reset all input
@@ -64,8 +84,8 @@ class BatchData(Node):
     
       if self.remainder:
         self.stop_iteration = True
-        batch = BatchData._aggregate_batch(batch_list)
-        return batch, label_list
+        batch = self._collate(batch_list)
+        return batch, self._collate_label(label_list)
     except:
       info = sys.exc_info()
       logger.error('%s:%s' % (info[0], info[1]))
@@ -73,28 +93,98 @@ class BatchData(Node):
   
   def _evaluate(self):
     return self._fetch_batch_data()
-    
+
+  def _ring_buffer(self, shape, dtype):
+    if self.ring_size == 0:
+      return None
+
+    # reuse preallocated buffer at current ring position
+    buffer = self._ring[self._ring_index]
+    if buffer is None or buffer.shape != shape or buffer.dtype != dtype:
+      buffer = np.empty(shape, dtype=dtype)
+      self._ring[self._ring_index] = buffer
+    self._ring_index = (self._ring_index + 1) % self.ring_size
+    return buffer
+
+  def _collate(self, batch_list):
+    if self.fixed_shape:
+      shape = (len(batch_list),) + batch_list[0].shape
+    else:
+      shape = (len(batch_list),) + BatchData._max_shape(batch_list)
+
+    return BatchData._aggregate_batch(batch_list,
+                                      self._ring_buffer(shape, batch_list[0].dtype),
+                                      self.fixed_shape)
+
+  def _collate_label(self, label_list):
+    if not self.collate_label or label_list[0] is None:
+      return label_list
+
+    return BatchData._aggregate_label(label_list)
+
   @staticmethod
-  def _aggregate_batch(batch_list):
-    batch = None
-    max_shape = np.array([data.shape for data in batch_list]).max(axis=0)
-    if len(max_shape) == 1:
-      batch = np.zeros((len(batch_list), max_shape[0]), dtype=batch_list[0].dtype)
-    elif len(max_shape) == 2:
-      batch = np.zeros((len(batch_list), max_shape[0], max_shape[1]), dtype=batch_list[0].dtype)
-    elif len(max_shape) == 3:
-      batch = np.zeros((len(batch_list), max_shape[0], max_shape[1], max_shape[2]), dtype=batch_list[0].dtype)
-    elif len(max_shape) == 4:
-      batch = np.zeros((len(batch_list), max_shape[0], max_shape[1], max_shape[2], max_shape[3]),
-          dtype=batch_list[0].dtype)
-
-    assert (batch is not None)
-
-    for i in range(len(batch_list)):
-      batch[i] = batch_list[i]
+  def _max_shape(batch_list):
+    shape = batch_list[0].shape
+    for data in batch_list:
+      if data.shape != shape:
+        return tuple([max(s) for s in zip(*[data.shape for data in batch_list])])
+    return shape
+
+  @staticmethod
+  def _aggregate_batch(batch_list, batch=None, fixed_shape=False):
+    is_fixed = fixed_shape
+    if batch is None:
+      shape = (len(batch_list),) + (batch_list[0].shape if fixed_shape else BatchData._max_shape(batch_list))
+      batch = np.empty(shape, dtype=batch_list[0].dtype)
+
+    if not is_fixed:
+      is_fixed = all([data.shape == batch.shape[1:] for data in batch_list])
+
+    if is_fixed:
+      # fast path, one contiguous copy per sample
+      for i, data in enumerate(batch_list):
+        batch[i] = data
+      return batch
+
+    batch.fill(0)
+    for i, data in enumerate(batch_list):
+      batch[(i,) + tuple([slice(0, s) for s in data.shape])] = data
 
     return batch
 
+  @staticmethod
+  def _aggregate_label(label_list):
+    label = label_list[0]
+    if type(label) == dict:
+      collated = {}
+      for k in label.keys():
+        if not all([type(l) == dict and k in l for l in label_list]):
+          # key missing in some samples, keep per sample list
+          collated[k] = [l.get(k, None) if type(l) == dict else None for l in label_list]
+          continue
+
+        value = BatchData._aggregate_label([l[k] for l in label_list])
+        if type(value) == tuple and type(label[k]) == np.ndarray:
+          collated[k], collated['%s_length' % k] = value
+        else:
+          collated[k] = value
+      return collated
+    elif type(label) == list:
+      # list label (i.e. objects of every sample) is always kept as per sample list
+      return list(label_list)
+    elif type(label) == tuple:
+      # fixed arity tuple is collated by position
+      if not all([type(l) == tuple and len(l) == len(label) for l in label_list]):
+        return list(label_list)
+      return tuple([BatchData._aggregate_label([l[i] for l in label_list]) for i in range(len(label))])
+    elif type(label) == np.ndarray and label.dtype != np.object_ and label.ndim > 0:
+      length = np.array([l.shape[0] for l in label_list], dtype=np.int32)
+      return BatchData._aggregate_batch(label_list), length
+    elif type(label) == np.ndarray or np.isscalar(label):
+      return np.array(label_list)
+
+    return label_list
+
 
 class RandomChooseData(Node):
   def __init__(self, inputs, propabilitys):
@@ -588,6 +678,18 @@ class FilterPNNode(Node):
     return data, is_n
 
 
+def _build_pipe_chain(pipe_nodes):
+  # independent node chain (entry_node -> ... -> end_node)
+  entry_node = Input(name='entry')
+  end_node = entry_node
+  for node in pipe_nodes:
+    end_node = node[0](Node.inputs(end_node), **node[1])
+
+  if isinstance(end_node, Node):
+    end_node.compile()
+  return entry_node, end_node
+
+
 class MultiThreadPipe(Node):
   """
   Same as :class:`MapData`, but start threads to run the mapping function.
@@ -606,6 +708,8 @@ class MultiThreadPipe(Node):
          You can use **strict mode**, where `MultiThreadMapData.get_data()`
          is guranteed to produce the exact set which `df.get_data()`
          produces. Although the order of data still isn't preserved.
+         With ``ordered=True``, the order of input datapoints is restored.
+      3. Every thread owns an independent copy of the ``pipe_nodes`` chain.
   """
 
   class _Worker(StoppableThread):
@@ -633,29 +737,23 @@ class MultiThreadPipe(Node):
       finally:
         self.stop()
 
-  def __init__(self, input_node, pipe_nodes, nr_thread, buffer_size=200, strict=False):
+  def __init__(self, input_node, pipe_nodes, nr_thread, buffer_size=200, strict=False, ordered=False):
     """
     Args:
         input_node (DataFlow): the dataflow to map
+        pipe_nodes (list): [(node class, node kwargs), ...], every thread builds its own node chain
         nr_thread (int): number of threads to use
-        map_func (callable): datapoint -> datapoint | None
         buffer_size (int): number of datapoints in the buffer
         strict (bool): use "strict mode", see notes above.
+        ordered (bool): keep the order of input datapoints
     """
     super(MultiThreadPipe, self).__init__(name='pipe')
 
     self._strict = strict
+    self._ordered = ordered
     self.nr_thread = nr_thread
     self.buffer_size = buffer_size
-    self.entry_node = Input(name='entry')
-    self.end_node = self.entry_node
-    
-    for node in pipe_nodes:
-      self.end_node = node[0](Node.inputs(self.end_node), **node[1])
-    
-    def pipe_process_func(x):
-      self.entry_node.set_value(x)
-      return self.end_node.get_value()
+    self.pipe_nodes = pipe_nodes
 
     self._is_start = False
     self._threads = []
@@ -666,27 +764,33 @@ class MultiThreadPipe(Node):
     self._out_queue = queue.Queue()
     self._evt = threading.Event()
     self._threads = [MultiThreadPipe._Worker(
-      self._in_queue, self._out_queue, self._evt, pipe_process_func)
+      self._in_queue, self._out_queue, self._evt, self._build_pipe_func())
                      for _ in range(self.nr_thread)]
 
-  def _fill_buffer(self):
-    n = self.buffer_size - self._in_queue.qsize() - self._out_queue.qsize()
-    assert n >= 0, n
-    if n == 0:
-      return
+  def _build_pipe_func(self):
+    # independent node chain for every thread
+    entry_node, end_node = _build_pipe_chain(self.pipe_nodes)
+
+    def pipe_process_func(x):
+      index, dp = x
+      entry_node.set_value(dp)
+      return index, end_node.get_value()
+
+    return pipe_process_func
+
+  def _send(self, index):
     try:
-      for _ in range(n):
-        self._in_queue.put(next(self._iter))
+      self._in_queue.put((index, next(self._iter)))
+      return True
     except StopIteration:
-      logger.error("[MultiThreadMapData] buffer_size cannot be larger than the size of the DataFlow!")
-      raise
+      return False
 
   def _recv(self):
-    ret = self._out_queue.get()
+    index, ret = self._out_queue.get()
     if ret is None:
       assert not self._strict, \
         "[MultiThreadMapData] Map function cannot return None when strict mode is used."
-    return ret
+    return index, ret
 
   def iterator_value(self):
     if not self._is_start:
@@ -697,22 +801,34 @@ class MultiThreadPipe(Node):
     self._iter = self._input_node.iterator_value()
 
     # fill bufer
-    self._fill_buffer()
+    send_num = 0
+    while send_num < self.buffer_size and self._send(send_num):
+      send_num += 1
 
-    is_over = False
-    while True:
-      # return value
-      yield self._recv()
+    is_over = send_num < self.buffer_size
+    recv_num = 0
+    ordered_container = OrderedContainer(start=0)
+    while recv_num < send_num:
+      index, ret = self._recv()
+      recv_num += 1
 
       if not is_over:
-        try:
-          self._in_queue.put(next(self._iter))
-        except StopIteration:
+        if self._send(send_num):
+          send_num += 1
+        else:
           is_over = True
-      else:
-        if self._out_queue.qsize() == 0 and self._in_queue.qsize() == 0:
-          self._input_node._reset_iteration_state()
-          break
+
+      # return value
+      if not self._ordered:
+        yield ret
+        continue
+
+      ordered_container.put(index, ret)
+      while ordered_container.has_next():
+        _, ret = ordered_container.get()
+        yield ret
+
+    self._input_node._reset_iteration_state()
 
   def set_value(self, new_value):
     raise NotImplementedError
@@ -725,3 +841,105 @@ class MultiThreadPipe(Node):
   #     self._evt.set()
   #   for p in self._threads:
   #     p.join()
+
+
+class MultiProcessPipe(MultiThreadPipe):
+  """
+  Same as :class:`MultiThreadPipe`, but start processes to run the ``pipe_nodes`` chain,
+  which avoids GIL contention when the chain is python heavy (e.g. augmentation).
+  Note:
+      1. Every process builds its own ``pipe_nodes`` chain, so node classes and kwargs
+         should be picklable.
+      2. Numpy payload of datapoints is exchanged by :class:`SharedMemorySlots` (only a small
+         descriptor is pickled). Datapoint which is larger than ``slot_bytes`` or arrives when
+         all slots are busy is pickled as usual.
+      3. ``strict`` and ``ordered`` mode are same as :class:`MultiThreadPipe`.
+  """
+  @staticmethod
+  def process_func(pipe_nodes, in_queue, out_queue, in_slots, out_slots):
+    # 1.step prepare random seed for current pid
+    seed = (os.getpid() +
+            int(datetime.now().strftime("%Y%m%d%H%M%S%f"))) % 4294967295
+    random.seed(seed)
+    np.random.seed(seed)
+
+    # 2.step independent node chain in current process
+    entry_node, end_node = _build_pipe_chain(pipe_nodes)
+
+    while True:
+      task = in_queue.get()
+      if task is None:
+        return
+
+      index, descriptor = task
+      entry_node.set_value(in_slots.unpack(descriptor))
+      # cannot ignore None here. will lead to unsynced send/recv
+      out_queue.put((index, out_slots.pack(end_node.get_value())))
+
+  def __init__(self, input_node, pipe_nodes, nr_thread, buffer_size=200, strict=False, ordered=False,
+               slot_bytes=4*1024*1024, nr_slots=None):
+    """
+    Args:
+        input_node (DataFlow): the dataflow to map
+        pipe_nodes (list): [(node class, node kwargs), ...], every process builds its own node chain
+        nr_thread (int): number of processes to use
+        buffer_size (int): number of datapoints in the buffer
+        strict (bool): use "strict mode", see notes above.
+        ordered (bool): keep the order of input datapoints
+        slot_bytes (int): bytes of one shared memory slot
+        nr_slots (int): number of shared memory slots in each direction (default buffer_size)
+    """
+    Node.__init__(self, name='pipe')
+
+    self._strict = strict
+    self._ordered = ordered
+    self.nr_thread = nr_thread
+    self.buffer_size = buffer_size
+    self.pipe_nodes = pipe_nodes
+
+    self._is_start = False
+    self._input_node = input_node
+    self._iter = None
+
+    if nr_slots is None:
+      nr_slots = buffer_size
+    self._in_slots = SharedMemorySlots(nr_slots, slot_bytes)
+    self._out_slots = SharedMemorySlots(nr_slots, slot_bytes)
+    self._in_queue = multiprocessing.Queue()
+    self._out_queue = multiprocessing.Queue()
+    self._processes = [multiprocessing.Process(target=MultiProcessPipe.process_func,
+                                               args=(self.pipe_nodes,
+                                                     self._in_queue,
+                                                     self._out_queue,
+                                                     self._in_slots,
+                                                     self._out_slots)) for _ in range(self.nr_thread)]
+    for p in self._processes:
+      p.daemon = True
+    self._threads = self._processes
+
+  def _send(self, index):
+    try:
+      dp = next(self._iter)
+    except StopIteration:
+      return False
+
+    # never block on slots, otherwise parent and workers could wait for each other
+    self._in_queue.put((index, self._in_slots.pack(dp)))
+    return True
+
+  def _recv(self):
+    index, descriptor = self._out_queue.get()
+    ret = self._out_slots.unpack(descriptor)
+    if ret is None:
+      assert not self._strict, \
+        "[MultiProcessPipe] Map function cannot return None when strict mode is used."
+    return index, ret
+
+  def iterator_value(self):
+    if not self._is_start:
+      start_proc_mask_signal(self._processes)
+      ensure_proc_terminate(self._processes)
+      self._is_start = True
+
+    for ret in super(MultiProcessPipe, self).iterator_value():
+      yield ret
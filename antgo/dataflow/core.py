@@ -10,6 +10,7 @@ from functools import total_ordering
 from antgo.utils import logger
 import itertools
 import sys
+import six
 
 if sys.version_info[0] == 2:
   def items(dictionary):
@@ -61,12 +62,16 @@ class BaseNode(object):
   """Base class for Inputs and Nodes"""
 
   _name_counters = defaultdict(int)
+  # number of auto triggered Nodes, no trigger walk is needed if zero
+  _auto_trigger_count = 0
 
   def __init__(self, name=None, value=DIRTY, auto_trigger=False):
     self.name = name or self._generate_name()
     self._value = value
     self._dependents = set()
     self._auto_trigger = auto_trigger
+    if auto_trigger:
+      BaseNode._auto_trigger_count += 1
 
   def _connect(self, dependent):
     """Set the given Node as a dependent of this Node or Input
@@ -115,7 +120,7 @@ class BaseNode(object):
 
     """
     # test if neither, one of or both the old and the new value are DIRTY
-    dirty_count = len([v for v in [value, self._value] if v is DIRTY])
+    dirty_count = (value is DIRTY) + (self._value is DIRTY)
     if dirty_count == 2:
       # both DIRTY, no need to touch anything
       return set()
@@ -141,18 +146,29 @@ class BaseNode(object):
   def _set_dependents_dirty(self):
     """Paint all dependent Nodes dirty
 
-    Paints direct dependent Nodes dirty, which causes recursive painting
-    for the whole dependent Nodes tree.
+    Paints direct dependent Nodes dirty, and walks the whole dependent
+    Nodes tree with an explicit stack (no recursion).
 
     """
-    for dependent in self._dependents:
-        dependent._set_value(DIRTY)
+    stack = list(self._dependents)
+    while stack:
+      dependent = stack.pop()
+      if dependent._value is DIRTY:
+        # already DIRTY, its dependents are DIRTY too
+        continue
+      dependent._value = DIRTY
+      stack.extend(dependent._dependents)
 
   def _trigger(self):
-    if self._auto_trigger:
-      self.get_value()
-    for dependent in self._dependents:
-      dependent._trigger()
+    if BaseNode._auto_trigger_count == 0:
+      return
+
+    stack = [self]
+    while stack:
+      node = stack.pop()
+      if node._auto_trigger:
+        node.get_value()
+      stack.extend(node._dependents)
 
   def _force_inputs_dirty(self):
     self._value = DIRTY
@@ -269,6 +285,7 @@ class Node(BaseNode):
     self.set_inputs(*inputs[0], **inputs[1] or {})
     self._set_dependents_dirty()
     self._iteration_reset_state = False
+    self._plan = None
 
   def _evaluate(self):
     """Calculate the value for the Node
@@ -368,7 +385,10 @@ class Node(BaseNode):
   def get_value(self):
     """Return Node value, evaluate if needed and paint dependents dirty"""
     if DIRTY == self._value:
-      self._value = self._evaluate()
+      if self._plan is not None:
+        self._plan.run()
+      else:
+        self._value = self._evaluate()
       #self._set_dependents_dirty()
 
     return self._value
@@ -376,9 +396,29 @@ class Node(BaseNode):
   def is_dirty(self):
     return DIRTY == self._value
 
+  def compile(self):
+    """Build a flat execution plan for the graph ending at this Node
+
+    After compiling, ``get_value`` and ``iterator_value`` walk the plan
+    instead of recursing through inputs. Compile again if the inputs of
+    any Node in the graph are changed.
+
+    """
+    plan = ExecutionPlan(self)
+    # Node with its own _evaluate is evaluated as usual
+    self._plan = plan if plan.is_compiled else None
+    return self._plan
+
   def iterator_value(self):
     while True:
-      self._value = self._evaluate()
+      try:
+        if self._plan is not None:
+          self._plan.run()
+        else:
+          self._value = self._evaluate()
+      except StopIteration:
+        return
+
       yield self._value
       self._force_inputs_dirty()
 
@@ -423,22 +463,146 @@ class Node(BaseNode):
   def _force_inputs_dirty(self):
     if DIRTY == self._value:
       return
-    
-    for i in self._positional_inputs:
-      i._force_inputs_dirty()
-    for name, i in items(self._keyword_inputs):
-      i._force_inputs_dirty()
-    self._value = DIRTY
+
+    if self._plan is not None:
+      self._plan.invalidate()
+      return
+
+    stack = [self]
+    while len(stack) > 0:
+      node = stack.pop()
+      if node is not self and not _is_default(node, '_force_inputs_dirty'):
+        node._force_inputs_dirty()
+        continue
+      if DIRTY == node._value:
+        continue
+
+      stack.extend(node._iterate_inputs())
+      node._value = DIRTY
 
   def _reset_iteration_state(self):
-    if self._iteration_reset_state:
-        return
-    for i in self._positional_inputs:
-        i._reset_iteration_state()
-    for name, i in items(self._keyword_inputs):
-        i._reset_iteration_state()
-    self._iteration_reset_state = True
+    stack = [self]
+    while len(stack) > 0:
+      node = stack.pop()
+      if node is not self and not _is_default(node, '_reset_iteration_state'):
+        node._reset_iteration_state()
+        continue
+      if node._iteration_reset_state:
+        continue
+
+      stack.extend(node._iterate_inputs())
+      node._iteration_reset_state = True
 
   def __lt__(self, other):
     return self.name < other.name
 
+
+def _is_default(node, method):
+  # node is a Node which doesn't override ``method``
+  if not isinstance(node, Node):
+    return False
+  return six.get_unbound_function(getattr(type(node), method)) is \
+         six.get_unbound_function(getattr(Node, method))
+
+
+class ExecutionPlan(object):
+  """Flat evaluation plan of the graph ending at a Node
+
+  The graph is topologically sorted once (same order as recursive pulling).
+  Nodes which use the default ``_evaluate`` are evaluated by walking the
+  plan, every other Node or Input is a leaf of the plan and evaluated by its
+  own ``get_value``. Dirty flags of plan steps are kept in a flat list.
+
+  """
+  def __init__(self, node):
+    self.node = node
+    # step: (node, positional step indexes, keyword step indexes), leaf step has None
+    self._steps = []
+    self._leaves = []
+    index = {}
+    visiting = set()
+    stack = [(node, False)]
+    while len(stack) > 0:
+      n, expanded = stack.pop()
+      if n in index:
+        continue
+
+      if not (_is_default(n, '_evaluate') and _is_default(n, 'get_value')):
+        index[n] = len(self._steps)
+        self._steps.append((n, None, None))
+        self._leaves.append(n)
+        continue
+
+      if expanded:
+        index[n] = len(self._steps)
+        self._steps.append((n,
+                            [index[i] for i in n._positional_inputs],
+                            [(name, index[i]) for name, i in items(n._keyword_inputs)]))
+        continue
+
+      if n in visiting:
+        continue
+      visiting.add(n)
+      stack.append((n, True))
+      for i in reversed(list(n._iterate_inputs())):
+        if i not in index:
+          stack.append((i, False))
+
+    self._values = [DIRTY] * len(self._steps)
+    self._dirty = [True] * len(self._steps)
+    self._is_reset = False
+
+  def __len__(self):
+    return len(self._steps)
+
+  @property
+  def is_compiled(self):
+    return self._steps[-1][1] is not None
+
+  def invalidate(self):
+    """Paint all plan steps dirty (leaves are forced dirty by their own method)"""
+    for leaf in self._leaves:
+      leaf._force_inputs_dirty()
+    for i, (node, positional, _) in enumerate(self._steps):
+      self._dirty[i] = True
+      if positional is not None:
+        node._value = DIRTY
+
+  def run(self):
+    """Evaluate dirty steps in plan order and return value of the end Node"""
+    values = self._values
+    dirty = self._dirty
+    i = 0
+    try:
+      for node, positional, keyword in self._steps:
+        if positional is None:
+          # leaf caches its own value
+          values[i] = node.get_value()
+        elif dirty[i] or node._value is DIRTY:
+          if keyword:
+            value = node._action(*[values[j] for j in positional],
+                                 **{name: values[j] for name, j in keyword})
+          elif len(positional) == 1:
+            value = node._action(values[positional[0]])
+          else:
+            value = node._action(*[values[j] for j in positional])
+          values[i] = value
+          node._value = value
+        else:
+          values[i] = node._value
+        dirty[i] = False
+        i += 1
+    except StopIteration:
+      # reset all input
+      self.node._reset_iteration_state()
+      self._is_reset = True
+      raise
+
+    if self._is_reset:
+      # clear reset state
+      for node, positional, _ in self._steps:
+        if positional is not None:
+          node._iteration_reset_state = False
+      self._is_reset = False
+
+    return self.node._value
@@ -59,8 +59,14 @@ class CelebA(Dataset):
     
     self.ids = list(range(len(self._file_list)))
     
-    # 3.step annotation folder
-    self._annotations = {}
+    # 3.step annotation (pre-parsed)
+    self._annotation_index = AnnotationIndex.load(self.dir,
+                                                  'annotation_%s_%s' % (image_flag, self.train_or_test),
+                                                  lambda: self._parse_annotation(image_flag),
+                                                  num=len(self._file_list))
+
+  def _parse_annotation(self, image_flag):
+    annotations = {}
     # 3.1 step landmark annotation
     # landmark name
     # lefteye_x
@@ -84,16 +90,16 @@ class CelebA(Dataset):
             [i for i in landmark_content.replace('\n','').split(' ') if i != '']
 
           if file_name in self._file_map:
-            self._annotations[file_name] = {'landmark': [int(l_x),
-                                                         int(l_y),
-                                                         int(r_x),
-                                                         int(r_y),
-                                                         int(n_x),
-                                                         int(n_y),
-                                                         int(lm_x),
-                                                         int(lm_y),
-                                                         int(rm_x),
-                                                         int(rm_y)]}
+            annotations[file_name] = {'landmark': [int(l_x),
+                                                   int(l_y),
+                                                   int(r_x),
+                                                   int(r_y),
+                                                   int(n_x),
+                                                   int(n_y),
+                                                   int(lm_x),
+                                                   int(lm_y),
+                                                   int(rm_x),
+                                                   int(rm_y)]}
           landmark_content = fp.readline()
     else:
       with open(os.path.join(self.dir, 'Anno', 'list_landmarks_celeba.txt')) as fp:
@@ -105,16 +111,16 @@ class CelebA(Dataset):
           file_name, l_x, l_y, r_x, r_y, n_x, n_y, lm_x, lm_y, rm_x, rm_y = \
             [i for i in landmark_content.replace('\n','').split(' ') if i != '']
           if file_name in self._file_map:
-            self._annotations[file_name] = {'landmark': [int(l_x),
-                                                         int(l_y),
-                                                         int(r_x),
-                                                         int(r_y),
-                                                         int(n_x),
-                                                         int(n_y),
-                                                         int(lm_x),
-                                                         int(lm_y),
-                                                         int(rm_x),
-                                                         int(rm_y)]}
+            annotations[file_name] = {'landmark': [int(l_x),
+                                                   int(l_y),
+                                                   int(r_x),
+                                                   int(r_y),
+                                                   int(n_x),
+                                                   int(n_y),
+                                                   int(lm_x),
+                                                   int(lm_y),
+                                                   int(rm_x),
+                                                   int(rm_y)]}
           landmark_content = fp.readline()
 
     # 3.2 step attribute annotation
@@ -209,46 +215,46 @@ class CelebA(Dataset):
         Young = [i for i in attribute_content.replace('\n', '').split(' ') if i != '']
         
         if file_name in self._file_map:
-          self._annotations[file_name]['attribute'] = [int(o_Clock_Shadow),
-                                                       int(Arched_Eyebrows),
-                                                       int(Attractive),
-                                                       int(Bags_Under_Eyes),
-                                                       int(Bald),
-                                                       int(Bangs),
-                                                       int(Big_Lips),
-                                                       int(Big_Nose),
-                                                       int(Black_Hair),
-                                                       int(Blond_Hair),
-                                                       int(Blurry),
-                                                       int(Brown_Hair),
-                                                       int(Bushy_Eyebrows),
-                                                       int(Chubby),
-                                                       int(Double_Chin),
-                                                       int(Eyeglasses),
-                                                       int(Goatee),
-                                                       int(Gray_Hair),
-                                                       int(Heavy_Makeup),
-                                                       int(High_Cheekbones),
-                                                       int(Male),
-                                                       int(Mouth_Slightly_Open),
-                                                       int(Mustache),
-                                                       int(Narrow_Eyes),
-                                                       int(No_Beard),
-                                                       int(Oval_Face),
-                                                       int(Pale_Skin),
-                                                       int(Pointy_Nose),
-                                                       int(Receding_Hairline),
-                                                       int(Rosy_Cheeks),
-                                                       int(Sideburns),
-                                                       int(Smiling),
-                                                       int(Straight_Hair),
-                                                       int(Wavy_Hair),
-                                                       int(Wearing_Earrings),
-                                                       int(Wearing_Hat),
-                                                       int(Wearing_Lipstick),
-                                                       int(Wearing_Necklace),
-                                                       int(Wearing_Necktie),
-                                                       int(Young) ]
+          annotations[file_name]['attribute'] = [int(o_Clock_Shadow),
+                                                 int(Arched_Eyebrows),
+                                                 int(Attractive),
+                                                 int(Bags_Under_Eyes),
+                                                 int(Bald),
+                                                 int(Bangs),
+                                                 int(Big_Lips),
+                                                 int(Big_Nose),
+                                                 int(Black_Hair),
+                                                 int(Blond_Hair),
+                                                 int(Blurry),
+                                                 int(Brown_Hair),
+                                                 int(Bushy_Eyebrows),
+                                                 int(Chubby),
+                                                 int(Double_Chin),
+                                                 int(Eyeglasses),
+                                                 int(Goatee),
+                                                 int(Gray_Hair),
+                                                 int(Heavy_Makeup),
+                                                 int(High_Cheekbones),
+                                                 int(Male),
+                                                 int(Mouth_Slightly_Open),
+                                                 int(Mustache),
+                                                 int(Narrow_Eyes),
+                                                 int(No_Beard),
+                                                 int(Oval_Face),
+                                                 int(Pale_Skin),
+                                                 int(Pointy_Nose),
+                                                 int(Receding_Hairline),
+                                                 int(Rosy_Cheeks),
+                                                 int(Sideburns),
+                                                 int(Smiling),
+                                                 int(Straight_Hair),
+                                                 int(Wavy_Hair),
+                                                 int(Wearing_Earrings),
+                                                 int(Wearing_Hat),
+                                                 int(Wearing_Lipstick),
+                                                 int(Wearing_Necklace),
+                                                 int(Wearing_Necktie),
+                                                 int(Young) ]
           
         attribute_content = fp.readline()
     # 3.3 step bounding box
@@ -268,9 +274,11 @@ class CelebA(Dataset):
           boxes[0, 1] = int(y)
           boxes[0, 2] = int(x) + int(width)
           boxes[0, 3] = int(y) + int(height)
-          self._annotations[file_name]['bbox'] = boxes
+          annotations[file_name]['bbox'] = boxes
         bounding_box_content = fp.readline()
-  
+
+    return [annotations[file_path.split('/')[-1]] for file_path in self._file_list]
+
   @property
   def size(self):
     return len(self.ids)
@@ -299,21 +307,21 @@ class CelebA(Dataset):
 
       for k in idxs:
         image_file = self._file_list[k]
-        file_name = image_file.split('/')[-1]
         image = imread(image_file)
 
-        self._annotations[file_name].update({'id': k, 'info': [image.shape[0], image.shape[1], image.shape[2]]})
-        yield [image, self._annotations[file_name]]
+        annotation = self._annotation_index.at(k)
+        annotation.update({'id': k, 'info': [image.shape[0], image.shape[1], image.shape[2]]})
+        yield [image, annotation]
 
   def at(self, id):
     if self.train_or_test == 'sample':
       return self.data_samples[id]
 
     image_file = self._file_list[id]
-    file_name = image_file.split('/')[-1]
     image = imread(image_file)
-    self._annotations[file_name].update({'id': id, 'info': [image.shape[0], image.shape[1], image.shape[2]]})
-    return image, self._annotations[file_name]
+    annotation = self._annotation_index.at(id)
+    annotation.update({'id': id, 'info': [image.shape[0], image.shape[1], image.shape[2]]})
+    return image, annotation
   
   def split(self, split_params={}, split_method='holdout'):
     assert (self.train_or_test == 'train')
@@ -14,7 +14,7 @@ from six.moves import range
 from ...utils import logger
 from ...utils.fs import download
 from ...utils.fs import maybe_here
-from .dataset import Dataset
+from .dataset import Dataset, load_array_cache
 import copy
 import time
 
@@ -24,8 +24,10 @@ CIFAR_100_URL = 'http://www.cs.toronto.edu/~kriz/cifar-100-python.tar.gz'
 
 
 def read_cifar(filenames, cifar_classnum):
+  # return images (N x 32 x 32 x 3, uint8) and labels (N)
   assert cifar_classnum == 10 or cifar_classnum == 100
-  ret = []
+  images = []
+  labels = []
   for fname in filenames:
     fo = open(fname, 'rb')
     if six.PY3:
@@ -35,16 +37,12 @@ def read_cifar(filenames, cifar_classnum):
     data = dic[b'data']
     if cifar_classnum == 10:
       label = dic[b'labels']
-      IMG_NUM = 10000 # cifar10 data are split into blocks of 10000
     elif cifar_classnum == 100:
       label = dic[b'fine_labels']
-      IMG_NUM = 50000 if 'train' in fname else 10000
     fo.close()
-    for k in range(IMG_NUM):
-      img = data[k].reshape(3, 32, 32)
-      img = np.transpose(img, [1, 2, 0])
-      ret.append([img, label[k]])
-  return ret
+    images.append(np.asarray(data, dtype=np.uint8).reshape(-1, 3, 32, 32).transpose(0, 2, 3, 1))
+    labels.append(np.asarray(label, dtype=np.int32))
+  return np.ascontiguousarray(np.concatenate(images, axis=0)), np.concatenate(labels, axis=0)
 
 
 def get_filenames(dir, cifar_classnum):
@@ -98,10 +96,11 @@ class CifarBase(Dataset):
       if not os.path.isfile(f):
         raise ValueError('Failed to Find File: ' + f)
     self.train_or_test = self.train_or_test
-    self.data = read_cifar(self.fs, self.cifar_classnum)
 
-    # unwarp
-    self.image, self.label = zip(*self.data)
+    # memory mapped (N x 32 x 32 x 3) images and labels
+    self.image, self.label = load_array_cache(self.dir,
+                                              'cifar%d_%s' % (self.cifar_classnum, self.train_or_test),
+                                              lambda: read_cifar(self.fs, self.cifar_classnum))
 
     # ids
     self.ids = [i for i in range(len(self.image))]
@@ -113,7 +112,7 @@ class CifarBase(Dataset):
   def at(self, id):
     if self.train_or_test == 'sample':
       return self.data_samples[id]
-    return self.image[id], self.label[id]
+    return self.image[id], int(self.label[id])
 
   def data_pool(self):
     if self.train_or_test == 'sample':
@@ -138,12 +137,11 @@ class CifarBase(Dataset):
         self.rng.shuffle(ids)
 
       # filter by ids
-      filter_ids = getattr(self, 'filter', None)
-      if filter_ids is not None:
-        ids = [i for i in ids if i in filter_ids]
+      ids = self.filter_by_ids(ids)
 
       for id in ids:
-          yield [copy.deepcopy(self.image[id]), self.label[id]]
+          # read only view of memory mapped images
+          yield [self.image[id], int(self.label[id])]
 
 
 class Cifar10(CifarBase):
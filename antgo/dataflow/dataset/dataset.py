@@ -20,6 +20,10 @@ import tarfile
 import zipfile
 from antgo import config
 import subprocess
+import hashlib
+import json
+import shutil
+import yaml
 from antgo.utils.dht import *
 from antgo.utils.serialize import *
 import copy
@@ -37,6 +41,186 @@ def imresize(image,size):
   return scipy.misc.imresize(image,size)
 
 
+def load_array_cache(cache_dir, name, build_func, num=None):
+  '''
+  contiguous (images, labels) .npy cache of in-memory dataset, opened by np.load(mmap_mode='r'),
+  so that samples are views and forked processes share pages instead of copying
+  :param cache_dir: folder of cache files
+  :param name: cache name
+  :param build_func: () -> (images N x H x W (x C), labels N), only called when cache isn't built
+  :param num: expected sample number (cache is rebuilt if it doesn't match)
+  :return: images, labels
+  '''
+  images_path = os.path.join(cache_dir, '%s_images.npy' % name)
+  labels_path = os.path.join(cache_dir, '%s_labels.npy' % name)
+  if os.path.exists(images_path) and os.path.exists(labels_path):
+    images = np.load(images_path, mmap_mode='r')
+    labels = np.load(labels_path, mmap_mode='r')
+    if num is None or (images.shape[0] == num and labels.shape[0] == num):
+      return images, labels
+
+  images, labels = build_func()
+  try:
+    # write temp file and rename, so that partial cache is never opened
+    for path, array in [(images_path, images), (labels_path, labels)]:
+      temp_path = '%s_%d.npy' % (path[:-4], os.getpid())
+      np.save(temp_path, np.ascontiguousarray(array))
+      os.rename(temp_path, path)
+  except (IOError, OSError):
+    logger.warn('fail to write dataset cache %s in %s' % (name, cache_dir))
+    return images, labels
+
+  return np.load(images_path, mmap_mode='r'), np.load(labels_path, mmap_mode='r')
+
+
+def id_bitmap(ids, size=None):
+  # boolean bitmap of sample ids (bitmap[id] is True if id in ids)
+  ids = np.asarray(ids, dtype=np.int64).reshape(-1)
+  if size is None:
+    size = int(ids.max()) + 1 if len(ids) > 0 else 0
+
+  bitmap = np.zeros((size,), dtype=np.bool_)
+  bitmap[ids[(ids >= 0) & (ids < size)]] = True
+  return bitmap
+
+
+def id_in_bitmap(bitmap, ids):
+  # membership test of id (or id array) against bitmap, ids out of bitmap are not in it
+  ids = np.asarray(ids, dtype=np.int64)
+  is_in = (ids >= 0) & (ids < len(bitmap))
+  if ids.ndim == 0:
+    return is_in and bitmap[ids]
+
+  is_in[is_in] = bitmap[ids[is_in]]
+  return is_in
+
+
+class AnnotationIndex(object):
+  '''
+  struct-of-arrays index of per image annotation, built once and memory-mapped later
+  every field is one .npy array, ragged field (bbox, category_id, ... of objects) is concatenated
+  over images with its own offsets (values of image i are in [offsets[i], offsets[i+1])),
+  others are stacked with one row per image. image whose annotation is None is marked invalid.
+  '''
+  def __init__(self, size, valid, fields, kinds, offsets):
+    self._size = size
+    self._valid = valid
+    self._fields = fields
+    self._kinds = kinds
+    self._offsets = offsets
+
+  @property
+  def size(self):
+    return self._size
+
+  def field(self, name):
+    # values of all images (concatenated values for ragged field)
+    return self._fields[name]
+
+  def at(self, i):
+    if not self._valid[i]:
+      return None
+
+    annotation = {}
+    for name, values in self._fields.items():
+      if name in self._offsets:
+        value = values[self._offsets[name][i]:self._offsets[name][i + 1]]
+      else:
+        value = values[i]
+
+      kind = self._kinds[name]
+      if kind == 'array':
+        # copy (annotation would be changed by following nodes)
+        annotation[name] = np.array(value)
+      elif kind == 'list':
+        annotation[name] = value.tolist()
+      else:
+        annotation[name] = value.item()
+
+    return annotation
+
+  @staticmethod
+  def _build(annotations, ragged):
+    valid = np.array([a is not None for a in annotations], dtype=np.bool_)
+    names = set()
+    kinds = {}
+    for a in annotations:
+      if a is not None:
+        for name, value in a.items():
+          if name not in kinds:
+            kinds[name] = 'array' if type(value) == np.ndarray else 'list' if type(value) in [list, tuple] else 'scalar'
+          names.add(name)
+
+    fields = {}
+    offsets = {}
+    for name in names:
+      values = [np.asarray(a[name]) if a is not None else None for a in annotations]
+      template = [v for v in values if v is not None and v.size > 0]
+      template = template[0] if len(template) > 0 else np.zeros((0,))
+      if name in ragged:
+        lengths = [len(v) if v is not None and v.size > 0 else 0 for v in values]
+        offsets[name] = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        fields[name] = np.concatenate([v for v, l in zip(values, lengths) if l > 0]) \
+          if offsets[name][-1] > 0 else np.zeros((0,) + template.shape[1:], template.dtype)
+      else:
+        fields[name] = np.stack([v if v is not None else np.zeros_like(template) for v in values])
+
+    return AnnotationIndex(len(annotations), valid, fields, kinds, offsets)
+
+  @staticmethod
+  def load(cache_dir, name, build_func, ragged=(), params=None, num=None):
+    '''
+    :param cache_dir: folder of index (next to dataset)
+    :param name: index name
+    :param build_func: () -> [annotation dict or None, ...], only called when index isn't built
+    :param ragged: fields with variable length per image
+    :param params: parameters which annotation depends on (e.g. filter condition), index is built for every value
+    :param num: expected image number (index is rebuilt if it doesn't match)
+    :return: AnnotationIndex
+    '''
+    if params is not None:
+      name = '%s_%s' % (name, hashlib.md5(json.dumps(params, sort_keys=True, default=str).encode('utf-8')).hexdigest()[:8])
+    index_dir = os.path.join(cache_dir, '%s.index' % name)
+
+    if os.path.exists(os.path.join(index_dir, 'index.yaml')):
+      with open(os.path.join(index_dir, 'index.yaml'), 'r') as fp:
+        index_config = yaml.safe_load(fp)
+
+      if num is None or index_config['size'] == num:
+        fields = {}
+        offsets = {}
+        for field in index_config['kinds'].keys():
+          fields[field] = np.load(os.path.join(index_dir, '%s.npy' % field), mmap_mode='r')
+          if field in index_config['ragged']:
+            offsets[field] = np.load(os.path.join(index_dir, '%s-offsets.npy' % field), mmap_mode='r')
+        valid = np.load(os.path.join(index_dir, 'valid.npy'), mmap_mode='r')
+        return AnnotationIndex(index_config['size'], valid, fields, index_config['kinds'], offsets)
+
+    annotation_index = AnnotationIndex._build(build_func(), ragged)
+    try:
+      # write temp folder and rename, so that partial index is never opened
+      temp_dir = '%s_%d' % (index_dir, os.getpid())
+      if not os.path.exists(temp_dir):
+        os.makedirs(temp_dir)
+      np.save(os.path.join(temp_dir, 'valid.npy'), annotation_index._valid)
+      for field, values in annotation_index._fields.items():
+        np.save(os.path.join(temp_dir, '%s.npy' % field), values)
+      for field, offsets in annotation_index._offsets.items():
+        np.save(os.path.join(temp_dir, '%s-offsets.npy' % field), offsets)
+      with open(os.path.join(temp_dir, 'index.yaml'), 'w') as fp:
+        yaml.safe_dump({'size': annotation_index.size,
+                        'kinds': annotation_index._kinds,
+                        'ragged': list(annotation_index._offsets.keys())}, fp)
+
+      if os.path.exists(index_dir):
+        shutil.rmtree(index_dir)
+      os.rename(temp_dir, index_dir)
+    except (IOError, OSError):
+      logger.warn('fail to write annotation index %s in %s' % (name, cache_dir))
+
+    return annotation_index
+
+
 class Dataset(BaseNode):
   __metaclass__ = ABCMeta
   _BASE_DATASET = True
@@ -204,33 +388,28 @@ class Dataset(BaseNode):
   def _split_repeated_holdout(self, split_ratio, is_stratified_sampling=True, idx=[]):
     assert(self.train_or_test in ['train','sample'])
 
-    # split by t/v
+    # split by t/v (idx is label of every sample, return sample index arrays)
     if is_stratified_sampling:
-      labels_num = len(set(idx))
-      labels_index = [[] for _ in range(labels_num)]
-      for index, label in enumerate(idx):
-        labels_index[label].append(index)
-
-      train_idx = [[] for _ in range(labels_num)]
-      validation_idx = [[] for _ in range(labels_num)]
-      for label in range(labels_num):
-        label_samples = labels_index[label]
-        get_rng().shuffle(label_samples)
+      _, label_index = np.unique(np.asarray(idx), return_inverse=True)
+      label_index = label_index.reshape(-1)
 
-        top_k = int(split_ratio * len(label_samples))
-        train_idx[label].extend(label_samples[0:top_k])
-        validation_idx[label].extend((label_samples[top_k:]))
+      # random permutation, then stable sort by label (random order in every label group)
+      order = get_rng().permutation(len(label_index))
+      order = order[np.argsort(label_index[order], kind='mergesort')]
 
-      train_idx = reduce(lambda x, y: x+y, train_idx)
-      validation_idx = reduce(lambda x, y: x+y, validation_idx)
+      # the first ratio of every label group is train
+      group_size = np.bincount(label_index)
+      group_start = np.cumsum(group_size) - group_size
+      top_k = (split_ratio * group_size).astype(np.int64)
+      group_rank = np.arange(len(order)) - np.repeat(group_start, group_size)
+      is_train = group_rank < np.repeat(top_k, group_size)
 
-      return train_idx, validation_idx
+      return order[is_train], order[np.logical_not(is_train)]
     else:
-      index = range(len(idx))
-      get_rng().shuffle(index)
+      index = get_rng().permutation(len(idx))
       top_k = int(split_ratio * len(idx))
       train_idx = index[0:top_k]
-      validation_idx = (index[top_k:])
+      validation_idx = index[top_k:]
       return train_idx, validation_idx
 
   def _split_bootstrap(self, idx):
@@ -240,9 +419,10 @@ class Dataset(BaseNode):
     train_idx = []
     validation_idx = []
     while not is_ok:
-      selected_idx = get_rng().randint(low=0, high=len(idx)-1, size=len(idx)).tolist()
+      selected_idx = get_rng().randint(low=0, high=len(idx), size=len(idx))
       train_idx = selected_idx
-      validation_idx = [i for i in range(len(idx)) if i not in selected_idx]
+      # out of bag samples
+      validation_idx = np.where(np.bincount(selected_idx, minlength=len(idx)) == 0)[0]
 
       if len(validation_idx) > 0:
         is_ok = True
@@ -258,8 +438,12 @@ class Dataset(BaseNode):
     k_start = k * fold_size
     k_end = (k+1) * fold_size if k < k_fold - 1 else len(idx)
 
-    validation_idx = [idx[i] for i in np.arange(k_start, k_end, dtype=np.uint64)]
-    train_idx = [i for i in range(len(idx)) if i not in validation_idx]
+    # idx is (shuffled) sample index, validation is view of k-th fold
+    idx = np.asarray(idx, dtype=np.int64)
+    validation_idx = idx[k_start:k_end]
+    is_train = np.ones((size,), dtype=np.bool_)
+    is_train[validation_idx] = False
+    train_idx = np.where(is_train)[0]
 
     return train_idx, validation_idx
 
@@ -392,66 +576,109 @@ class Dataset(BaseNode):
 
     return data_group
 
-  def filter_by_id(self, id):
+  def _filter_bitmap(self):
+    # bitmap of 'filter' ids (rebuilt only if filter is reassigned)
     id_filter = getattr(self, 'filter', None)
-    if id_filter is not None:
-      if id in id_filter:
-        return True
-      else:
-        return False
+    if id_filter is None:
+      return None
+
+    cached = getattr(self, '_cached_filter_bitmap', None)
+    if cached is None or cached[0] is not id_filter:
+      cached = (id_filter, id_bitmap(id_filter))
+      self._cached_filter_bitmap = cached
+    return cached[1]
 
-    return True
+  def filter_by_id(self, id):
+    bitmap = self._filter_bitmap()
+    if bitmap is None:
+      return True
+
+    return bool(id_in_bitmap(bitmap, id))
+
+  def filter_by_ids(self, ids):
+    # keep ids passed filter_by_id (order is preserved)
+    bitmap = self._filter_bitmap()
+    if bitmap is None:
+      return ids
+
+    ids = np.asarray(ids, dtype=np.int64)
+    return ids[id_in_bitmap(bitmap, ids)]
+
+  def _filter_condition(self, ext_filter=None):
+    # parameters used by filter_by_condition
+    condition = {}
+    for k in ['included', 'excluded', 'transform', 'min_size', 'min_aspect_ratio', 'max_aspect_ratio'] + \
+        (ext_filter if ext_filter is not None else []):
+      condition[k] = getattr(self, k, None)
+    return condition
+
+  def _compile_condition(self, ext_filter=None):
+    # filter condition as category tables (compiled once, rebuilt only if condition is changed)
+    condition = self._filter_condition(ext_filter)
+    compiled = getattr(self, '_compiled_condition', {}).get(tuple(ext_filter or []), None)
+    if compiled is not None and compiled['condition'] == condition:
+      return compiled
+
+    compiled = {'condition': copy.deepcopy(condition)}
+    # included (or excluded) category table
+    compiled['category'] = None
+    if condition['included'] is not None:
+      compiled['category'] = (set(condition['included']), True)
+    elif condition['excluded'] is not None:
+      compiled['category'] = (set(condition['excluded']), False)
+
+    # category -> category_id table
+    compiled['transform'] = None
+    if condition['transform'] is not None and len(condition['transform']) > 0:
+      compiled['transform'] = dict(condition['transform'])
+
+    if not hasattr(self, '_compiled_condition'):
+      self._compiled_condition = {}
+    self._compiled_condition[tuple(ext_filter or [])] = compiled
+    return compiled
 
   def filter_by_condition(self, label, ext_annotation=None, ext_filter=None):
-    #
-    included_cls = getattr(self, 'included', None)
-    excluded_cls = getattr(self, 'excluded', None)
-    transform_cls = getattr(self, 'transform', None)
-    # object must be larger than min_size
-    min_size = getattr(self, 'min_size', None)
-    # object aspect ratio must be suffer to predefined value
-    # (aspect ratio = width / height)
-    min_aspect_ratio = getattr(self, 'min_aspect_ratio', None)
-    max_aspect_ratio = getattr(self, 'max_aspect_ratio', None)
-
-    if included_cls is not None:
-      keep_index = []
-      # cls filter
-      for obj_index, obj in enumerate(label['category']):
-        if obj in included_cls:
-          if 'bbox' in label:
-            x0, y0, x1, y1 = label['bbox'][obj_index, :]
-            # size filter
-            if min_size is not None:
-              if (x1 - x0) < min_size or (y1 - y0) < min_size:
-                continue
-
-            if min_aspect_ratio is not None:
-              if float(x1 - x0) / float(y1 - y0) < min_aspect_ratio:
-                continue
-
-            if max_aspect_ratio is not None:
-              if float(x1 - x0) / float(y1 - y0) > max_aspect_ratio:
-                continue
-
-          # ext filter
-          if ext_filter is not None:
-            is_skip = False
-            for f in ext_filter:
-              remained_tag = getattr(self, f, None)
-              if remained_tag is not None:
-                if label[f][obj_index] != remained_tag:
-                  is_skip = True
-                  break
-            if is_skip:
-              continue
-
-          # keep obj index
-          keep_index.append(obj_index)
-
-        if len(keep_index) == 0:
-          return None
+    # objects are filtered by masks over all objects at once
+    # (1) category in included (not in excluded)
+    # (2) bbox larger than min_size, aspect ratio (width / height) in [min_aspect_ratio, max_aspect_ratio]
+    # (3) ext filter (label[f] == self.f)
+    compiled = self._compile_condition(ext_filter)
+    condition = compiled['condition']
+
+    if compiled['category'] is not None:
+      category = label['category']
+      category_table, is_included = compiled['category']
+      keep = np.array([c in category_table for c in category], dtype=np.bool_)
+      if not is_included:
+        keep = np.logical_not(keep)
+
+      if 'bbox' in label and len(category) > 0:
+        bbox = label['bbox']
+        width = bbox[:, 2] - bbox[:, 0]
+        height = bbox[:, 3] - bbox[:, 1]
+        # size filter
+        if condition['min_size'] is not None:
+          keep &= (width >= condition['min_size']) & (height >= condition['min_size'])
+
+        if condition['min_aspect_ratio'] is not None or condition['max_aspect_ratio'] is not None:
+          with np.errstate(divide='ignore', invalid='ignore'):
+            aspect_ratio = width.astype(np.float64) / height.astype(np.float64)
+          if condition['min_aspect_ratio'] is not None:
+            keep &= aspect_ratio >= condition['min_aspect_ratio']
+          if condition['max_aspect_ratio'] is not None:
+            keep &= aspect_ratio <= condition['max_aspect_ratio']
+
+      # ext filter
+      if ext_filter is not None:
+        for f in ext_filter:
+          if condition[f] is not None:
+            keep &= np.array(label[f]).reshape(-1) == condition[f]
+
+      keep_index = np.where(keep)[0]
+      if len(keep_index) == 0:
+        return None
 
+      if len(keep_index) < len(keep):
         if 'bbox' in label:
           label['bbox'] = label['bbox'][keep_index, :]
         label['category_id'] = label['category_id'][keep_index]
@@ -465,60 +692,18 @@ class Dataset(BaseNode):
               else:
                 label[annotation_name] = label[annotation_name][keep_index]
 
-    elif excluded_cls is not None:
-      keep_index = []
-      for obj_index, obj in enumerate(label['category']):
-        if obj not in excluded_cls:
-          # size filter
-          if 'bbox' in label:
-            x0, y0, x1, y1 = label['bbox'][obj_index, :]
-            if min_size is not None:
-              if (x1 - x0) < min_size or (y1 - y0) < min_size:
-                continue
-
-            if min_aspect_ratio is not None:
-              if float(x1 - x0) / float(y1 - y0) < min_aspect_ratio:
-                continue
-
-            if max_aspect_ratio is not None:
-              if float(x1 - x0) / float(y1 - y0) > max_aspect_ratio:
-                continue
-
-          # ext filter
-          if ext_filter is not None:
-            is_skip = False
-            for f in ext_filter:
-              remained_tag = getattr(self, f, None)
-              if remained_tag is not None:
-                if label[f][obj_index] != remained_tag:
-                  is_skip = True
-                  break
-            if is_skip:
-              continue
-
-          # keep obj index
-          keep_index.append(obj_index)
-
-      if len(keep_index) == 0:
-        return None
-
-      if 'bbox' in label:
-        label['bbox'] = label['bbox'][keep_index, :]
-      label['category_id'] = label['category_id'][keep_index]
-      label['category'] = [label['category'][i] for i in keep_index]
-
-      if ext_annotation is not None:
-        for annotation_name in ext_annotation:
-          if annotation_name in label:
-            if type(label[annotation_name]) == list:
-              label[annotation_name] = [label[annotation_name][i] for i in keep_index]
-            else:
-              label[annotation_name] = label[annotation_name][keep_index]
-
-    if transform_cls is not None:
-      for obj_index, obj in enumerate(label['category']):
-        if obj in transform_cls:
-          label['category_id'][obj_index] = transform_cls[obj]
+    if compiled['transform'] is not None:
+      transform_table = compiled['transform']
+      hit = [obj_index for obj_index, c in enumerate(label['category']) if c in transform_table]
+      if len(hit) > 0:
+        # category_id of caller may be read only (i.e. decoded from record), and isn't modified
+        if type(label['category_id']) == np.ndarray:
+          label['category_id'] = np.array(label['category_id'])
+          label['category_id'][hit] = [transform_table[label['category'][i]] for i in hit]
+        else:
+          label['category_id'] = list(label['category_id'])
+          for obj_index in hit:
+            label['category_id'][obj_index] = transform_table[label['category'][obj_index]]
 
     return label
 
@@ -123,73 +123,18 @@ class FashionAILandmark(Dataset):
       'trousers': 4,
     }
 
-    self.annotation = []
+    self.annotation = None
     self.images = []
     if train_or_test == 'train':
-      with open(os.path.join(self.dir, 'train', 'Annotations', 'train.csv')) as fp:
-        # skip first row
-        content = fp.readline()
-        content = fp.readline()
-        while content:
-          key_terms = content.split(',')
-          image_id = key_terms[0]
-          category = key_terms[1]
-          # record image id
-          self.images.append((image_id, category))
-
-          # record annotation
-          sample_annotation = {}
-          sample_annotation['category'] = category
-          sample_annotation['category_id'] = self.category_map[category]
-          sample_annotation['landmark'] = []
-          sample_annotation['id'] = len(self.images)
-          key_point_annotation = key_terms[2:]
-          for kp_index, kp in enumerate(key_point_annotation):
-            x, y, visible = kp.split('_')
-            x = int(x)
-            y = int(y)
-            visible = int(visible)
-
-            if kp_index in self.category_landmark[category]:
-              sample_annotation['landmark'].append((self.category_landmark[category][kp_index], kp_index, x, y, visible))
-
-          self.annotation.append(sample_annotation)
-
-          # read next line
-          content = fp.readline()
-
-      with open(os.path.join(self.dir, 'train', 'Annotations', 'annotations.csv')) as fp:
-        # skip first row
-        content = fp.readline()
-        content = fp.readline()
-        while content:
-          key_terms = content.split(',')
-          image_id = key_terms[0]
-          category = key_terms[1]
-          # record image id
-          self.images.append((image_id, category))
-    
-          # record annotation
-          sample_annotation = {}
-          sample_annotation['category'] = category
-          sample_annotation['category_id'] = self.category_map[category]
-          sample_annotation['landmark'] = []
-          sample_annotation['id'] = len(self.images)
-          key_point_annotation = key_terms[2:]
-          for kp_index, kp in enumerate(key_point_annotation):
-            x, y, visible = kp.split('_')
-            x = int(x)
-            y = int(y)
-            visible = int(visible)
-      
-            if kp_index in self.category_landmark[category]:
-              sample_annotation['landmark'].append(
-                (self.category_landmark[category][kp_index], kp_index, x, y, visible))
-    
-          self.annotation.append(sample_annotation)
-    
-          # read next line
-          content = fp.readline()
+      # pre-parsed annotation (rebuilt if annotation files change)
+      annotation_files = [os.path.join(self.dir, 'train', 'Annotations', 'train.csv'),
+                          os.path.join(self.dir, 'train', 'Annotations', 'annotations.csv')]
+      self.annotation = AnnotationIndex.load(os.path.join(self.dir, 'train'),
+                                             'annotation',
+                                             self._parse_annotation,
+                                             ragged=['landmark'],
+                                             params={'size': [os.path.getsize(f) for f in annotation_files]})
+      self.images = list(zip(self.annotation.field('image').tolist(), self.annotation.field('category').tolist()))
     else:
       with open(os.path.join(self.dir, 'test', 'test.csv')) as fp:
         # skip first row
@@ -212,6 +157,78 @@ class FashionAILandmark(Dataset):
     # fixed seed
     self.seed = getattr(self, 'seed', 0)
     
+  def _parse_annotation(self):
+    annotation = []
+    images = []
+    with open(os.path.join(self.dir, 'train', 'Annotations', 'train.csv')) as fp:
+      # skip first row
+      content = fp.readline()
+      content = fp.readline()
+      while content:
+        key_terms = content.split(',')
+        image_id = key_terms[0]
+        category = key_terms[1]
+        # record image id
+        images.append((image_id, category))
+
+        # record annotation
+        sample_annotation = {}
+        sample_annotation['image'] = image_id
+        sample_annotation['category'] = category
+        sample_annotation['category_id'] = self.category_map[category]
+        sample_annotation['landmark'] = []
+        sample_annotation['id'] = len(images)
+        key_point_annotation = key_terms[2:]
+        for kp_index, kp in enumerate(key_point_annotation):
+          x, y, visible = kp.split('_')
+          x = int(x)
+          y = int(y)
+          visible = int(visible)
+
+          if kp_index in self.category_landmark[category]:
+            sample_annotation['landmark'].append((self.category_landmark[category][kp_index], kp_index, x, y, visible))
+
+        annotation.append(sample_annotation)
+
+        # read next line
+        content = fp.readline()
+
+    with open(os.path.join(self.dir, 'train', 'Annotations', 'annotations.csv')) as fp:
+      # skip first row
+      content = fp.readline()
+      content = fp.readline()
+      while content:
+        key_terms = content.split(',')
+        image_id = key_terms[0]
+        category = key_terms[1]
+        # record image id
+        images.append((image_id, category))
+  
+        # record annotation
+        sample_annotation = {}
+        sample_annotation['image'] = image_id
+        sample_annotation['category'] = category
+        sample_annotation['category_id'] = self.category_map[category]
+        sample_annotation['landmark'] = []
+        sample_annotation['id'] = len(images)
+        key_point_annotation = key_terms[2:]
+        for kp_index, kp in enumerate(key_point_annotation):
+          x, y, visible = kp.split('_')
+          x = int(x)
+          y = int(y)
+          visible = int(visible)
+    
+          if kp_index in self.category_landmark[category]:
+            sample_annotation['landmark'].append(
+              (self.category_landmark[category][kp_index], kp_index, x, y, visible))
+  
+        annotation.append(sample_annotation)
+  
+        # read next line
+        content = fp.readline()
+
+    return annotation
+
   @property
   def size(self):
     return len(self.ids)
@@ -234,7 +251,8 @@ class FashionAILandmark(Dataset):
         image = imread(image_path)
         
         if self.train_or_test == 'train':
-          data_annotation = copy.deepcopy(self.annotation[k])
+          data_annotation = self.annotation.at(k)
+          data_annotation.pop('image')
           data_annotation['info'] = [image.shape[0], image.shape[1], image.shape[2]]
           yield [(image, category, image_file), data_annotation]
         else:
@@ -123,7 +123,7 @@ class ILSVRC12(Dataset):
           default_url="shell:mkdir train && tar xvf {file_placeholder} -C train\n cd train && find -type f -name '*.tar' | parallel -P 10 'echo {} && mkdir -p {/.} && tar xf {} -C {/.}'")
   
       self.imglist = self.get_train_image_list(self.train_or_test)
-      self.bblist, _ = ILSVRC12.get_bbox(bbdir, self.imglist, self.train_or_test)
+      self.bblist = self._load_bbox_index(bbdir)
     else:
       # maybe download
       if train_or_test == 'val':
@@ -133,7 +133,8 @@ class ILSVRC12(Dataset):
     
       self.imglist = self.get_val_or_test_image_list(self.train_or_test)
       if self.train_or_test == 'val':
-        self.bblist, label_list = ILSVRC12.get_bbox(bbdir, self.imglist, self.train_or_test)
+        self.bblist = self._load_bbox_index(bbdir)
+        label_list = [label if label != '' else -1 for label in self.bblist.field('label').tolist()]
         self.imglist = [(self.imglist[k][0], self.inv_synset[label_list[k]]) for k in range(len(self.imglist))]
 
     self.ids = list(range(len(self.imglist)))
@@ -143,10 +144,11 @@ class ILSVRC12(Dataset):
     :param name: 'train'
     :returns: list of (image filename, cls)
     """
+    # sorted (consistent with bounding box index)
     image_list = [('%s/%s'%(class_name, file_name), self.inv_synset[class_name]) \
-                   for class_index, class_name in enumerate(os.listdir(os.path.join(self.dir, name)) ) \
+                   for class_index, class_name in enumerate(sorted(os.listdir(os.path.join(self.dir, name)))) \
                    if os.path.isdir(os.path.join(self.dir, name, class_name)) \
-                   for file_name in os.listdir(os.path.join(self.dir, name, class_name))]
+                   for file_name in sorted(os.listdir(os.path.join(self.dir, name, class_name)))]
 
     return image_list
   def get_val_or_test_image_list(self, name):
@@ -154,9 +156,23 @@ class ILSVRC12(Dataset):
     :param name: 'val'
     :returns: list of (image filename, cls)
     """
-    image_list = [(filename,-1) for fileindex,filename in enumerate(os.listdir(os.path.join(self.dir, self.train_or_test, name))) ]
+    image_list = [(filename,-1) for fileindex,filename in enumerate(sorted(os.listdir(os.path.join(self.dir, self.train_or_test, name)))) ]
     return image_list
 
+  def _load_bbox_index(self, bbox_dir):
+    # pre-parsed bounding box (and its label) of every image
+    def _build():
+      bblist, label_list = ILSVRC12.get_bbox(bbox_dir, self.imglist, self.train_or_test)
+      return [{'bbox': bbox if bbox is not None else np.zeros((4,), dtype=np.float32),
+               'has_bbox': bbox is not None,
+               'label': label if bbox is not None else ''} for bbox, label in zip(bblist, label_list)]
+
+    return AnnotationIndex.load(self.dir, 'bbox_%s' % self.train_or_test, _build, num=len(self.imglist))
+
+  def _bbox_at(self, k):
+    annotation = self.bblist.at(k)
+    return annotation['bbox'] if annotation['has_bbox'] else None
+
   def split(self, split_params={}, split_method='holdout'):
     assert (self.train_or_test == 'train')
     assert (split_method == 'holdout')
@@ -202,7 +218,7 @@ class ILSVRC12(Dataset):
 
         if self.train_or_test == "train" or \
                 self.train_or_test == 'val':
-          bbox = self.bblist[k]
+          bbox = self._bbox_at(k)
           if bbox is None:
               bbox = np.array([0, 0, im.shape[1] - 1, im.shape[0] - 1])
 
@@ -226,7 +242,7 @@ class ILSVRC12(Dataset):
   
     if self.train_or_test == "train" or \
             self.train_or_test == 'val':
-      bbox = self.bblist[k]
+      bbox = self._bbox_at(k)
       if bbox is None:
         bbox = np.array([0, 0, im.shape[1] - 1, im.shape[0] - 1])
     
@@ -10,7 +10,7 @@ import gzip
 import random
 import numpy as np
 from ...utils import logger
-from .dataset import Dataset
+from .dataset import Dataset, load_array_cache
 import time
 import copy
 
@@ -51,8 +51,17 @@ def extract_labels(filename):
     labels = np.frombuffer(buf, dtype=np.uint8)
     return labels
 
+def extract_normalized(images_filename, labels_filename):
+  """Extract images (float32 [index, y, x, depth] in [0.0, 1.0]) and labels."""
+  images = extract_images(images_filename)
+  # Convert from [0, 255] -> [0.0, 1.0].
+  images = images.astype(np.float32)
+  images = np.multiply(images, 1.0 / 255.0)
+  return images, extract_labels(labels_filename)
+
+
 class DataSet(object):
-  def __init__(self, images, labels, fake_data=False):
+  def __init__(self, images, labels, fake_data=False, normalized=False):
     """Construct a DataSet. """
     assert images.shape[0] == labels.shape[0], (
         'images.shape: %s labels.shape: %s' % (images.shape,
@@ -64,9 +73,10 @@ class DataSet(object):
     assert images.shape[3] == 1
     images = images.reshape(images.shape[0],
                             images.shape[1] * images.shape[2])
-    # Convert from [0, 255] -> [0.0, 1.0].
-    images = images.astype(np.float32)
-    images = np.multiply(images, 1.0 / 255.0)
+    if not normalized:
+      # Convert from [0, 255] -> [0.0, 1.0].
+      images = images.astype(np.float32)
+      images = np.multiply(images, 1.0 / 255.0)
     self._images = images
     self._labels = labels
 
@@ -105,23 +115,24 @@ class Mnist(Dataset):
     # fixed seed
     self.seed = time.time()
 
+    # memory mapped normalized images and labels
     if self.train_or_test == "train":
-      self.download(self.dir, file_names=['train-images-idx3-ubyte.gz'], default_url=MINIST_URL)
-      self.train_images = extract_images(os.path.join(self.dir, 'train-images-idx3-ubyte.gz'))
+      images_file, labels_file = 'train-images-idx3-ubyte.gz', 'train-labels-idx1-ubyte.gz'
+    else:
+      images_file, labels_file = 't10k-images-idx3-ubyte.gz', 't10k-labels-idx1-ubyte.gz'
 
-      self.download(self.dir, file_names=['train-labels-idx1-ubyte.gz'])
-      self.train_labels = extract_labels(os.path.join(self.dir, 'train-labels-idx1-ubyte.gz'))
-      self.train = DataSet(self.train_images, self.train_labels)
+    self.download(self.dir, file_names=[images_file], default_url=MINIST_URL)
+    self.download(self.dir, file_names=[labels_file])
+    images, labels = load_array_cache(self.dir,
+                                      'mnist_%s' % self.train_or_test,
+                                      lambda: extract_normalized(os.path.join(self.dir, images_file),
+                                                                 os.path.join(self.dir, labels_file)))
 
+    if self.train_or_test == "train":
+      self.train = DataSet(images, labels, normalized=True)
       self.ids = [i for i in range(self.train.num_examples)]
     else:
-      self.download(self.dir, file_names=['t10k-images-idx3-ubyte.gz'], default_url=MINIST_URL)
-      test_images = extract_images(os.path.join(self.dir,'t10k-images-idx3-ubyte.gz'))
-
-      self.download(self.dir, file_names=['t10k-labels-idx1-ubyte.gz'])
-      test_labels = extract_labels(os.path.join(self.dir, 't10k-labels-idx1-ubyte.gz'))
-      self.test = DataSet(test_images, test_labels)
-
+      self.test = DataSet(images, labels, normalized=True)
       self.ids = [i for i in range(self.test.num_examples)]
 
   def split(self, split_params={}, split_method='holdout'):
@@ -194,9 +205,7 @@ class Mnist(Dataset):
         self.rng.shuffle(ids)
 
       # filter by ids
-      filter_ids = getattr(self, 'filter', None)
-      if filter_ids is not None:
-        ids = [i for i in ids if i in filter_ids]
+      ids = self.filter_by_ids(ids)
 
       for id in ids:
         img = ds.images[id].reshape((28, 28))
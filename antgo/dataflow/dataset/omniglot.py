@@ -10,6 +10,7 @@ import random
 import copy
 import time
 from antgo.dataflow.dataset import Dataset
+from antgo.dataflow.dataset.dataset import load_array_cache
 from antgo.utils.fs import download
 from antgo.utils.fs import maybe_here_fixed_3_hierarchy
 
@@ -62,6 +63,16 @@ class Omniglot(Dataset):
     self.ids = list(range(self.samples_num))
     self.samples = self.make_data(self.character_image_paths, self.character_labels)
 
+    # memory mapped images of all samples (row is index of sorted image path)
+    image_labels = {p: label for label, paths in enumerate(self.character_image_paths) for p in paths}
+    image_paths = sorted(image_labels.keys())
+    self.image_rows = {p: row for row, p in enumerate(image_paths)}
+    self.images, _ = load_array_cache(self.data_folder,
+                                      'omniglot_%s' % train_or_test,
+                                      lambda: (np.stack([self.load_image(p) for p in image_paths]),
+                                               np.array([image_labels[p] for p in image_paths])),
+                                      num=len(image_paths))
+
     # fixed seed
     self.seed = time.time()
 
@@ -95,13 +106,13 @@ class Omniglot(Dataset):
 
       # generate single image
       for k in idxs:
-          yield [self.load_image(self.samples[k][2]), self.samples[k][1]]
+          yield [self.images[self.image_rows[self.samples[k][2]]], self.samples[k][1]]
 
   def at(self, id):
     if self.train_or_test == 'sample':
       return self.data_samples[id]
 
-    return [self.load_image(self.samples[self.ids[id]][2]), self.samples[self.ids[id]][1]]
+    return [self.images[self.image_rows[self.samples[self.ids[id]][2]]], self.samples[self.ids[id]][1]]
 
   @property
   def size(self):
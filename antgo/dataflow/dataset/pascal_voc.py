@@ -94,6 +94,14 @@ class PascalBase(Dataset):
 
     assert os.path.exists(self._data_path), 'path does not exist: {}'.format(self._data_path)
 
+    # pre-parsed (and filtered) annotation of all images
+    self._annotation_index = AnnotationIndex.load(self._data_path,
+                                                  'annotation_%s' % self._image_set,
+                                                  self._build_annotation_index,
+                                                  ragged=['bbox', 'category_id', 'category', 'difficult', 'area'],
+                                                  params=self._filter_condition(),
+                                                  num=len(self._image_index))
+
   @property
   def size(self):
     return len(self._image_index)
@@ -123,11 +131,8 @@ class PascalBase(Dataset):
       for k in idxs:
         # real index
         index = self._image_index[k]
-        # annotation
-        gt_roidb = self._load_roidb(index)
-
         # label info
-        gt_roidb = self.filter_by_condition(gt_roidb, ['segmentation'])
+        gt_roidb = self._load_roidb(k)
         if gt_roidb is None:
           continue
 
@@ -145,10 +150,8 @@ class PascalBase(Dataset):
       return self.data_samples[id]
 
     index = self._image_index[id]
-    gt_roidb = self._load_roidb(index)
-  
     # label info
-    gt_roidb = self.filter_by_condition(gt_roidb, ['segmentation'])
+    gt_roidb = self._load_roidb(id)
     if gt_roidb is None:
       return [None, None]
   
@@ -175,8 +178,34 @@ class PascalBase(Dataset):
     """
     return self.image_path_from_index(self._image_index[i])
 
-  def _load_roidb(self, index):
-    return self._load_pascal_annotation(index)
+  def _load_roidb(self, k):
+    # pre-parsed annotation, only segmentation image is decoded
+    annotation = self._annotation_index.at(k)
+    if annotation is None:
+      return None
+
+    if annotation.pop('segmented'):
+      seg_file = os.path.join(self._data_path, 'SegmentationClass', self._image_index[k] + '.png')
+      seg_img = imread(seg_file)
+
+      segmentation = []
+      for category in annotation['category']:
+        obj_seg = np.zeros((seg_img.shape[0], seg_img.shape[1]), np.uint8)
+        obj_seg[np.where(seg_img[:, :, 0] == self._class_to_ind[category])] = 255
+        segmentation.append(obj_seg)
+
+      segmentation_map = seg_img[:, :, 0]
+      segmentation_map[np.where(segmentation_map == 255)] = 0
+      annotation.update({'segmentation': segmentation, 'segmentation_map': segmentation_map})
+
+    return annotation
+
+  def _build_annotation_index(self):
+    annotations = []
+    for index in self._image_index:
+      annotation = self._load_pascal_annotation(index, with_segmentation=False)
+      annotations.append(self.filter_by_condition(annotation, ['segmentation']))
+    return annotations
     
   def _load_image_set_index(self):
     """
@@ -192,10 +221,10 @@ class PascalBase(Dataset):
         image_index = [x.strip() for x in f.readlines()]
     return image_index
     
-  def _load_pascal_annotation(self, index):
+  def _load_pascal_annotation(self, index, with_segmentation=True):
     """
     Load image and bounding boxes info from XML file in the PASCAL VOC
-    format.
+    format. (segmentation is only flagged by 'segmented' if not with_segmentation)
     """
     filename = os.path.join(self._data_path, 'Annotations', index + '.xml')
     tree = ET.parse(filename)
@@ -224,7 +253,7 @@ class PascalBase(Dataset):
       has_seg = int(segmented.text)
 
     seg_img = None
-    if has_seg:
+    if has_seg and with_segmentation:
       seg_file = os.path.join(self._data_path, 'SegmentationClass', index + '.png')
       seg_img = imread(seg_file)
 
@@ -256,7 +285,9 @@ class PascalBase(Dataset):
                   'difficult': difficult,
                   'area': area}
 
-    if has_seg:
+    if not with_segmentation:
+      annotation['segmented'] = has_seg
+    elif has_seg:
       segmentation_map = seg_img[:, :, 0]
       segmentation_map[np.where(segmentation_map == 255)] = 0
       annotation.update({'segmentation': segmentation, 'segmentation_map': segmentation_map})
@@ -67,9 +67,7 @@ class CSV(Dataset):
         self.rng.shuffle(ids)
 
       # filter by ids
-      filter_ids = getattr(self, 'filter', None)
-      if filter_ids is not None:
-        ids = [i for i in ids if i in filter_ids]
+      ids = self.filter_by_ids(ids)
 
       # label col
       label_col = getattr(self, 'label', None)
@@ -12,11 +12,16 @@ from antgo.dataflow.basic import *
 import numpy as np
 import copy
 import time
+import glob
+import hashlib
 from antgo.utils.dht import *
 import multiprocessing
 
 class Standard(Dataset):
   is_complete = {}
+  # state of dataset downloading from dht (db reader, data queue, attributes and availability bitmap),
+  # shared by all views (i.e. train/val from split()) of the same dataset
+  dht_states = {}
 
   def __init__(self, train_or_test, dataset_dir=None, ext_params=None):
     dataset_name = dataset_dir.split('/')[-1]
@@ -33,6 +38,8 @@ class Standard(Dataset):
 
     # data queue (provide data from another independent process)
     self.data_queue = None
+    # availability bitmap of samples (None if dataset is complete)
+    self.available = None
     dataset_url = getattr(self, 'dataset_url', None)
     if dataset_url is not None:
       if '%s_%s'%(dataset_name, train_or_test) not in Standard.is_complete:
@@ -40,43 +47,47 @@ class Standard(Dataset):
         # set complete flag
         Standard.is_complete['%s_%s' % (dataset_name, train_or_test)] = False
         # db reader
-        self._record_reader = RecordReader(os.path.join(dataset_dir, train_or_test),
-                                           read_only=False)
+        record_reader = RecordReader(os.path.join(dataset_dir, train_or_test),
+                                     read_only=False)
 
         # launch independent process
         dataset_url = dataset_url.replace('ipfs://','')
-        self.data_queue = multiprocessing.Queue()
+        data_queue = multiprocessing.Queue(maxsize=64)
         dht_process = multiprocessing.Process(target=dataset_download_dht,
                                               args=(dataset_dir,
                                                     train_or_test,
                                                     dataset_url,
-                                                    self.data_queue,
-                                                    self._record_reader,
+                                                    data_queue,
+                                                    record_reader,
                                                     2))
         dht_process.start()
+
+        # dataset basic property
+        dataset_attrs = data_queue.get()
+        Standard.dht_states['%s_%s' % (dataset_name, train_or_test)] = \
+          {'record_reader': record_reader,
+           'data_queue': data_queue,
+           'attrs': dataset_attrs,
+           'available': np.zeros((int(dataset_attrs['count']),), dtype=np.bool_)}
+
+      dht_state = Standard.dht_states['%s_%s' % (dataset_name, train_or_test)]
+      self._record_reader = dht_state['record_reader']
+      self.data_queue = dht_state['data_queue']
+      self.available = dht_state['available']
+      dataset_attrs = dht_state['attrs']
     else:
       Standard.is_complete['%s_%s' % (dataset_name, train_or_test)] = True
       # db reader
       self._record_reader = RecordReader(os.path.join(dataset_dir, train_or_test),
                                          read_only=True)
-
-    # dataset basic property
-    dataset_attrs = {}
-    if self.data_queue is not None:
-      dataset_attrs = self.data_queue.get()
-    else:
+      # dataset basic property
       dataset_attrs = self._record_reader.record_attrs()
 
     for k, v in dataset_attrs.items():
       setattr(self, k, v)
 
     # dataset index
-    self.ids = np.arange(0, int(self.size)).tolist()
-
-    if Standard.is_complete['%s_%s'%(dataset_name, train_or_test)]:
-      self.ok_ids = np.arange(0, int(self.size)).tolist()
-    else:
-      self.ok_ids = []
+    self.ids = np.arange(0, int(self.size))
 
     # fixed seed
     self.seed = time.time()
@@ -99,25 +110,33 @@ class Standard(Dataset):
 
       if not Standard.is_complete['%s_%s'%(self.name, self.train_or_test)]:
         # for !train dataset, we have to wait until complete
+        dht_state = Standard.dht_states['%s_%s' % (self.name, self.train_or_test)]
         while True:
-          # receive data list
-          data_list = self.data_queue.get()
-          for data in data_list:
-            if type(data) == tuple:
-              data_index, data_info, data_label, block_id = data
-              # record sample
-              self._record_reader.write(Sample(data=data_info, label=data_label), data_index)
-              # record block
-              self._record_reader.put(block_id, 'true')
-
-              # update ids (sample index)
-              self.ok_ids.append(data_index)
-            else:
-              # update ids (sample index)
-              self.ok_ids.append(int(data))
+          if dht_state.get('error', None) is not None:
+            # some blocks are given up, dataset would never be complete
+            raise IOError(dht_state['error'])
+
+          # receive data list (wait for one, then take all arrived)
+          data_lists = [self.data_queue.get()]
+          while True:
+            try:
+              data_lists.append(self.data_queue.get_nowait())
+            except queue.Empty:
+              break
+
+          # record samples and finished blocks in batch
+          try:
+            with self._record_reader.batch_writer() as record_writer:
+              for data_list in data_lists:
+                # update available samples
+                self.available[dataset_record_dht(record_writer, data_list)] = True
+          except IOError as e:
+            logger.error('dataset %s (%s) is incomplete, %s' % (self.name, self.train_or_test, str(e)))
+            dht_state['error'] = str(e)
+            raise
 
           # check whether dataset is complete
-          if self.size == len(self.ok_ids):
+          if np.all(self.available):
             Standard.is_complete['%s_%s' % (self.name, self.train_or_test)] = True
             break
 
@@ -129,15 +148,14 @@ class Standard(Dataset):
         self.rng.shuffle(ids)
 
       # filter by ids
-      filter_ids = getattr(self, 'filter', None)
-      if filter_ids is not None:
-        ids = [i for i in ids if i in filter_ids]
+      ids = self.filter_by_ids(ids)
 
-      for id in ids:
-        if not Standard.is_complete['%s_%s'%(self.name, self.train_or_test)]:
-          if id not in self.ok_ids:
-            continue
+      # only samples have been downloaded
+      if not Standard.is_complete['%s_%s'%(self.name, self.train_or_test)]:
+        ids = np.asarray(ids)[id_in_bitmap(self.available, ids)]
 
+      for id in ids:
+        id = int(id)
         data, label = self._record_reader.read(id, 'data', 'label')
         # print((id, data,label))
         # filter by condition
@@ -153,36 +171,81 @@ class Standard(Dataset):
       # increment epoch
       self.epoch += 1
 
+  def _record_signature(self):
+    # signature of record content (size and files state), changed once record is rewritten
+    record_path = os.path.join(self.dir, self.train_or_test)
+    record_state = [str(self.size)]
+    for file_name in sorted(os.listdir(record_path)):
+      if file_name.startswith('LOG') or file_name == 'LOCK':
+        # rocksdb log files change without modifying record
+        continue
+      file_stat = os.stat(os.path.join(record_path, file_name))
+      record_state.append('%s:%d:%d' % (file_name, file_stat.st_size, int(file_stat.st_mtime * 1e6)))
+
+    return hashlib.md5('|'.join(record_state).encode('utf-8')).hexdigest()[:16]
+
+  def _category_column(self):
+    # category (as string) of every sample, cached in dataset folder once dataset is complete
+    # (cache file is keyed by record signature, stale cache is ignored and removed)
+    column_prefix = os.path.join(self.dir, '%s_category' % self.train_or_test)
+    column_path = '%s_%s.npy' % (column_prefix, self._record_signature())
+    if os.path.exists(column_path):
+      return np.load(column_path, mmap_mode='r')
+
+    # read label by id (samples not downloaded yet have '' category)
+    category_column = [''] * self.size
+    ids = np.arange(self.size) if self.available is None else np.where(self.available)[0]
+    for start in range(0, len(ids), 1024):
+      chunk_ids = ids[start:start + 1024].tolist()
+      try:
+        samples = self._record_reader.read_many(chunk_ids, 'label')
+      except:
+        samples = [self._record_reader.read(id, 'label') for id in chunk_ids]
+
+      for id, (label,) in zip(chunk_ids, samples):
+        if type(label) == dict and 'category' in label:
+          category_column[id] = str(label['category'])
+    category_column = np.array(category_column, dtype=np.str_)
+
+    if Standard.is_complete['%s_%s' % (self.name, self.train_or_test)]:
+      try:
+        for stale_path in glob.glob('%s*.npy' % column_prefix):
+          if not stale_path.endswith('.tmp.npy'):
+            os.remove(stale_path)
+        temp_path = '%s_%d.tmp.npy' % (column_prefix, os.getpid())
+        np.save(temp_path, category_column)
+        os.rename(temp_path, column_path)
+      except (IOError, OSError):
+        logger.warn('fail to write category column in %s' % self.dir)
+
+    return category_column
+
   def split(self, split_params={}, split_method='holdout'):
     assert(self.train_or_test == 'train')
 
-    category_ids = copy.copy(self.ids)
-    if 'is_stratified' in split_params and split_params['is_stratified'] and \
-        (split_method == 'repeated-holdout' or split_method == 'holdout'):
-
-      # traverse dataset
-      for id in self.ids:
-        _, label = self._record_reader.read(id, 'data', 'label')
-        if type(label) == dict and 'category' in label:
-          category_ids[id] = label['category']
-        else:
-          category_ids[id] = 0 if random.random() > 0.5 else 1
-
     if split_method == 'holdout':
       if 'ratio' not in split_params:
         val_dataset = Standard('val', self.dir, self.ext_params)
         return self, val_dataset
 
+    ids = np.asarray(self.ids, dtype=np.int64)
+    category_ids = np.arange(len(ids))
+    if 'is_stratified' in split_params and split_params['is_stratified'] and \
+        (split_method == 'repeated-holdout' or split_method == 'holdout'):
+      # stratified by category column (not decode whole dataset)
+      category_ids = self._category_column()[ids]
+
     if split_method == 'kfold':
       np.random.seed(np.int64(self.seed))
-      np.random.shuffle(category_ids)
+      category_ids = np.random.permutation(len(ids))
 
+    # split returns position in ids
     train_ids, val_ids = self._split(category_ids, split_params, split_method)
     train_dataset = Standard(self.train_or_test, self.dir, self.ext_params)
-    train_dataset.ids = train_ids
+    train_dataset.ids = ids[train_ids]
 
     val_dataset = Standard(self.train_or_test, self.dir, self.ext_params)
-    val_dataset.ids = val_ids
+    val_dataset.ids = ids[val_ids]
     return train_dataset, val_dataset
 
   @property
@@ -12,6 +12,7 @@ from six.moves import range
 import copy
 from antgo.utils import logger, get_rng
 from antgo.dataflow.dataset import Dataset
+from antgo.dataflow.dataset.dataset import load_array_cache
 from antgo.utils.fs import download
 from antgo.utils.fs import maybe_here
 import scipy.io
@@ -50,12 +51,16 @@ class SVHNDigit(Dataset):
     assert os.path.isfile(filename), \
       "File {} not found! Please download it from {}.".format(filename, SVHN_URL)
 
-    logger.info("Loading {} ...".format(filename))
-    data = scipy.io.loadmat(filename)
-    self.X = data['X'].transpose(3, 0, 1, 2)
-    self.Y = data['y'].reshape((-1))
-    self.Y[np.where(self.Y == 10)] = 0
-    self.Y = self.Y.astype(np.uint8)
+    def _load():
+      logger.info("Loading {} ...".format(filename))
+      data = scipy.io.loadmat(filename)
+      X = np.ascontiguousarray(data['X'].transpose(3, 0, 1, 2))
+      Y = data['y'].reshape((-1))
+      Y[np.where(Y == 10)] = 0
+      return X, Y.astype(np.uint8)
+
+    # memory mapped (N x 32 x 32 x 3) images and labels
+    self.X, self.Y = load_array_cache(self.dir, 'svhn_%s' % self.train_or_test, _load)
 
     self.ids = list(range(self.Y.shape[0]))
 
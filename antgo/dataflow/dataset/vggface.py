@@ -49,11 +49,31 @@ class VGGFace(Dataset):
             
             content = fp.readline()
     
-    # 1.step data files
-    self._persons_file = []
-    self._persons_annotation = []
-    self._persons_id_str = []
+    # 1.step data files (pre-parsed, rebuilt if downloaded images change)
+    self._annotation_index = AnnotationIndex.load(self.dir,
+                                                  'annotation',
+                                                  self._parse_annotation,
+                                                  params={'data': len(os.listdir(os.path.join(self.dir, 'data')))})
+    self._persons_file = self._annotation_index.field('file').tolist()
+    self._persons_id_str = self._annotation_index.field('person').tolist()
     self._persons_id = []
+
+    id_set = set(self._persons_id_str)
+    person_id_map = {}
+    for s_i, s in enumerate(id_set):
+      person_id_map[s] = s_i
+
+    for person_id_str in self._persons_id_str:
+      person_id = person_id_map[person_id_str]
+      self._persons_id.append(person_id)
+
+    self.ids = list(range(len(self._persons_file)))
+
+    # fixed seed
+    self.seed = time.time()
+  
+  def _parse_annotation(self):
+    annotations = []
     for file in os.listdir(os.path.join(self.dir, 'vgg_face_dataset', 'files')):
       if file[0] == '.':
         continue
@@ -65,35 +85,31 @@ class VGGFace(Dataset):
             [i for i in content.replace('\n', '').split(' ') if i != '']
           image_name = os.path.normpath(_url).split('/')[-1]
           if os.path.exists(os.path.join(self.dir, 'data', image_name)):
-            self._persons_file.append(os.path.join(self.dir, 'data', image_name))
             bbox = np.zeros((1, 4))
             bbox[0, 0] = float(x_1)
             bbox[0, 1] = float(y_1)
             bbox[0, 2] = float(x_2)
             bbox[0, 3] = float(y_2)
-            self._persons_annotation.append({'bbox': bbox, 'pose': float(pose), 'category': file.split('.')[0]})
-            self._persons_id_str.append(file)
+            annotations.append({'bbox': bbox,
+                                'pose': float(pose),
+                                'category': file.split('.')[0],
+                                'file': os.path.join(self.dir, 'data', image_name),
+                                'person': file})
           
           content = fp.readline()
 
-    id_set = set(self._persons_id_str)
-    person_id_map = {}
-    for s_i, s in enumerate(id_set):
-      person_id_map[s] = s_i
-
-    for person_id_str in self._persons_id_str:
-      person_id = person_id_map[person_id_str]
-      self._persons_id.append(person_id)
-
-    self.ids = list(range(len(self._persons_file)))
+    return annotations
 
-    # fixed seed
-    self.seed = time.time()
-  
   @property
   def size(self):
     return len(self.ids)
   
+  def _person_annotation(self, k):
+    annotation = self._annotation_index.at(k)
+    annotation.pop('file')
+    annotation.pop('person')
+    return annotation
+
   def data_pool(self):
     if self.train_or_test == 'sample':
       sample_idxs = copy.deepcopy(self.ids)
@@ -119,7 +135,7 @@ class VGGFace(Dataset):
       for k in idxs:
         person_file = self._persons_file[k]
         person_image = imread(person_file)
-        person_annotation = self._persons_annotation[k]
+        person_annotation = self._person_annotation(k)
         person_id = self._persons_id[k]
         person_annotation.update({'category_id': person_id,
                                   'id': k,
@@ -133,7 +149,7 @@ class VGGFace(Dataset):
     person_file = self._persons_file[id]
     person_image = imread(person_file)
     person_id = self._persons_id[id]
-    person_annotation = self._persons_annotation[id]
+    person_annotation = self._person_annotation(id)
     person_annotation.update({'category_id': person_id,
                               'id': id,
                               'info': [person_image.shape[0], person_image.shape[1], person_image.shape[2]]})
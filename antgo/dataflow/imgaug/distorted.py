@@ -6,15 +6,16 @@ from __future__ import division
 from __future__ import unicode_literals
 from __future__ import print_function
 from antgo.dataflow.core import *
+from antgo.dataflow.imgaug.regular import GeometricNode
 from antgo.utils.bboxes import *
 import copy
 import random
 import math
 
 
-class Distorted(Node):
+class Distorted(GeometricNode):
   def __init__(self, inputs,aspect_ratio_range=(0.6, 1.67), area_range=(0.1, 1.0), max_try_times=100):
-    super(Distorted, self).__init__(name=None, action=self.action, inputs=inputs)
+    super(Distorted, self).__init__(inputs=inputs)
 
     self._aspect_ratio_range = aspect_ratio_range
     self._area_range = area_range
@@ -72,19 +73,18 @@ class Distorted(Node):
     size = np.minimum(np.array((int(w * width), int(h * height), -1)), np.array([width - 1, height - 1, -1]))
     return begin, size, focus_box
   
-  def action(self, *args, **kwargs):
-    assert(len(args) == 1)
-    data, annotation = args[0] if len(args[0]) == 2 else (args[0], {})
+  def transform(self, sample, annotation):
     assert('bbox' in annotation)
 
     # distorted bbox
-    begin, size, distoted_bbox = self._sample_distorted_bounding_box_like(data.shape,
+    begin, size, distoted_bbox = self._sample_distorted_bounding_box_like(sample.shape,
                                                                           annotation['bbox'],
                                                                           aspect_ratio_range=(0.95, 1.0),
                                                                           area_range=(0.1, 0.3))
 
-    # crop image
-    crop_image = data[begin[1]:begin[1]+size[1], begin[0]:begin[0]+size[0]]
+    # crop image (translate)
+    crop_shape = (min(size[1], sample.shape[0] - begin[1]), min(size[0], sample.shape[1] - begin[0]))
+    sample.transform(np.array([[1.0, 0.0, -begin[0]], [0.0, 1.0, -begin[1]], [0.0, 0.0, 1.0]]), crop_shape)
     # remained bboxes
     remained_bboxes,remained_bboxes_ind = \
       bboxes_filter_overlap(np.array((begin[0], begin[1], begin[0]+size[0], begin[1]+size[1])),
@@ -103,12 +103,10 @@ class Distorted(Node):
     if 'area' in annotation:
       annotation['area'] = annotation['area'][remained_bboxes_ind]
     if 'info' in annotation:
-      annotation['info'] = (crop_image.shape[0], crop_image.shape[1], crop_image.shape[2])
+      annotation['info'] = crop_shape + sample.image.shape[2:]
 
-    if 'segmentation' in annotation:
-      annotation['segmentation'] = \
-          [annotation['segmentation'][i][begin[1]:begin[1]+size[1], begin[0]:begin[0]+size[0]]
-           for i in remained_bboxes_ind]
+    if sample.segmentation is not None:
+      sample.segmentation = [sample.segmentation[i] for i in remained_bboxes_ind]
     annotation['cell'] = np.array((begin[0], begin[1], begin[0]+size[0], begin[1]+size[1]))
 
-    return (crop_image, annotation)
\ No newline at end of file
+    return annotation
@@ -6,13 +6,14 @@ from __future__ import division
 from __future__ import unicode_literals
 from __future__ import print_function
 from antgo.dataflow.core import *
+from antgo.dataflow.imgaug.regular import GeometricNode, GeometricSample
 from antgo.utils.bboxes import *
 import copy
 
 
-class Grid(Node):
+class Grid(GeometricNode):
   def __init__(self, inputs, grid=(), cell_size=0.5, obj_overlap=0.5):
-    super(Grid, self).__init__(name=None, action=self.action, inputs=inputs)
+    super(Grid, self).__init__(inputs=inputs)
     self._grid = grid
     self._cell_size = cell_size
     self._obj_overlap = obj_overlap
@@ -45,6 +46,9 @@ class Grid(Node):
   def action(self, *args, **kwargs):
     assert(len(args) == 1)
     data, annotation = args[0] if len(args[0]) == 2 else (args[0], {})
+    if isinstance(data, GeometricSample):
+      # pending geometric transform is warped once, every cell is a view of it
+      data, annotation = data.value(annotation)
     assert(type(data) == np.ndarray)
     crops = self._grid_crop(data.shape, self._grid, self._cell_size)
 
@@ -6,16 +6,139 @@ from __future__ import division
 from __future__ import unicode_literals
 from __future__ import print_function
 import numpy as np
-import scipy.misc
 from antgo.utils import get_rng
 from antgo.dataflow.core import *
 import copy
 from scipy.ndimage.interpolation import affine_transform
 
 
-class Flip(Node):
+def _transform_bbox(bbox, matrix):
+  # transform bbox (x0,y0,x1,y1) corners by 3x3 matrix, and return their bounding box
+  corners = np.concatenate((bbox[:, [0, 1]], bbox[:, [2, 3]], bbox[:, [0, 3]], bbox[:, [2, 1]]), axis=0)
+  corners = np.dot(corners, matrix[:2, :2].transpose()) + matrix[:2, 2]
+  corners = corners.reshape(4, -1, 2)
+  return np.concatenate((np.min(corners, axis=0), np.max(corners, axis=0)), axis=1)
+
+
+class GeometricSample(object):
+  """
+  Image (and its segmentation) with pending geometric transform. Consecutive geometric nodes
+  compose their 3x3 matrix (x, y, 1) from source to current coordinates, and image is
+  resampled only once for all channels.
+  """
+  def __init__(self, image, annotation):
+    self.image = image
+    self.segmentation = None
+    if type(annotation) == dict and 'segmentation' in annotation:
+      self.segmentation = list(annotation['segmentation'])
+
+    self.matrix = np.eye(3)
+    self.shape = image.shape[:2]
+    self.order = 0
+
+  def copy(self):
+    """ pending transform is copied, image and segmentation are shared (never modified in place) """
+    sample = copy.copy(self)
+    sample.matrix = self.matrix.copy()
+    return sample
+
+  def transform(self, matrix, shape, order=0):
+    """
+    :param matrix: 3x3 matrix from current to new coordinates
+    :param shape: (height, width) of new image
+    :param order: spline interpolation order needed by this transform
+    """
+    self.matrix = np.dot(matrix, self.matrix)
+    self.shape = (int(shape[0]), int(shape[1]))
+    self.order = max(self.order, order)
+
+  def _slice(self, data, inverse):
+    # flip and integer translation are done by slicing (view of source)
+    if np.any(inverse[:2, :2] != np.round(inverse[:2, :2])) or \
+        np.any(inverse[:2, 2] != np.round(inverse[:2, 2])) or \
+        inverse[0, 1] != 0 or inverse[1, 0] != 0:
+      return None
+
+    slices = []
+    for axis, size, source_size in [(1, self.shape[0], data.shape[0]), (0, self.shape[1], data.shape[1])]:
+      step = int(inverse[axis, axis])
+      start = int(inverse[axis, 2])
+      stop = start + step * (size - 1)
+      if min(start, stop) < 0 or max(start, stop) >= source_size:
+        return None
+      slices.append(slice(start, stop + step if stop + step >= 0 else None, step))
+
+    return data[slices[0], slices[1]]
+
+  def warp(self, data, order):
+    """ resample data (H x W or H x W x C) to current coordinates """
+    inverse = np.linalg.inv(self.matrix)
+    sliced = self._slice(data, inverse)
+    if sliced is not None:
+      return sliced
+
+    # affine_transform works in (row, col) coordinates, every channel is written into one output
+    output = np.empty(self.shape + data.shape[2:], dtype=data.dtype)
+    channels = data.reshape(data.shape[:2] + (-1,))
+    for channel in range(channels.shape[2]):
+      affine_transform(channels[:, :, channel],
+                       inverse[1::-1, 1::-1],
+                       offset=inverse[1::-1, 2],
+                       output_shape=self.shape,
+                       order=order,
+                       cval=0,
+                       output=output.reshape(self.shape + (-1,))[:, :, channel])
+    return output
+
+  def value(self, annotation):
+    """ (image, annotation) after all pending transforms """
+    image = self.warp(self.image, self.order)
+    if self.segmentation is not None:
+      # segmentation is resampled by nearest
+      annotation['segmentation'] = [self.warp(obj_seg, 0) for obj_seg in self.segmentation]
+    return (image, annotation)
+
+
+class GeometricNode(Node):
+  """
+  Base class of geometric augmentation. Output of a geometric node consumed only by geometric
+  nodes stays a pending GeometricSample, so the whole geometric stage is one warp.
+  """
+  def __init__(self, inputs):
+    super(GeometricNode, self).__init__(name=None, action=self.action, inputs=inputs)
+
+  def transform(self, sample, annotation):
+    """
+    compose transform of this node into sample and update annotation (segmentation is updated by sample)
+    :return: annotation
+    """
+    raise NotImplementedError
+
+  def _is_fused(self):
+    return len(self._dependents) > 0 and \
+           all([isinstance(dependent, GeometricNode) for dependent in self._dependents])
+
+  def action(self, *args, **kwargs):
+    assert(len(args) == 1)
+    image, annotation = args[0] if len(args[0]) == 2 else (args[0], {})
+    # sample and annotation of upstream node may be consumed by several (branching) nodes,
+    # so pending transform is copied and annotation entries are replaced, never modified in place
+    if isinstance(image, GeometricSample):
+      sample = image.copy()
+    else:
+      sample = GeometricSample(image, annotation)
+    annotation = copy.copy(annotation)
+
+    annotation = self.transform(sample, annotation)
+    if self._is_fused():
+      return (sample, annotation)
+
+    return sample.value(annotation)
+
+
+class Flip(GeometricNode):
   def __init__(self, inputs, horiz=False, vert=False, prob=0.5):
-    super(Flip, self).__init__(name=None, action=self.action, inputs=inputs)
+    super(Flip, self).__init__(inputs=inputs)
 
     """
     Only one of horiz, vert can be set.
@@ -35,86 +158,51 @@ class Flip(Node):
     self.prob = prob
     self.rng = get_rng(self)
 
-  def action(self, *args, **kwargs):
-    assert(len(args) == 1)
+  def transform(self, sample, annotation):
     is_flip = self.rng.uniform(0, 1) < self.prob
-    image, annotation = args[0] if len(args[0]) == 2 else (args[0], {})
-    annotation = copy.deepcopy(annotation)
-    if is_flip:
-      # for image
-      if self.code == 1:
-        image = np.fliplr(image)
-      else:
-        image = np.flipud(image)
-
-      # for annotation
-      if 'bbox' in annotation:
-        if self.code == 1:
-          w = annotation['info'][1]
-          boxes = annotation['bbox'].copy()
-          oldx1 = boxes[:, 0].copy()
-          oldx2 = boxes[:, 2].copy()
-          boxes[:, 0] = w - oldx2 - 1
-          boxes[:, 2] = w - oldx1 - 1
-
-          assert ((boxes[:, 2] >= boxes[:, 0]).all())
-          annotation['bbox'] = boxes
-          annotation['flipped'] = True
-        else:
-          h = annotation['info'][0]
-          boxes = annotation['bbox'].copy()
-          oldy1 = boxes[:, 1].copy()
-          oldy2 = boxes[:, 3].copy()
-          boxes[:, 1] = h - oldy2 - 1
-          boxes[:, 3] = h - oldy1 - 1
-
-          assert ((boxes[:, 3] >= boxes[:, 1]).all())
-          annotation['bbox'] = boxes
-          annotation['flipped'] = True
-      if 'segmentation' in annotation:
-        resized_obj_seg = []
-        for obj_seg in annotation['segmentation']:
-          temp = None
-          if self.code == 1:
-            temp = np.fliplr(obj_seg)
-          else:
-            temp = np.flipud(obj_seg)
-          resized_obj_seg.append(temp)
-        annotation['segmentation'] = resized_obj_seg
+    if not is_flip:
+      return annotation
 
-    return (image, annotation)
+    h, w = sample.shape
+    if self.code == 1:
+      matrix = np.array([[-1.0, 0.0, w - 1], [0.0, 1.0, 0.0], [0.0, 0.0, 1.0]])
+    else:
+      matrix = np.array([[1.0, 0.0, 0.0], [0.0, -1.0, h - 1], [0.0, 0.0, 1.0]])
+    sample.transform(matrix, sample.shape)
+
+    # for annotation
+    if 'bbox' in annotation:
+      boxes = _transform_bbox(annotation['bbox'], matrix)
+      assert ((boxes[:, 2] >= boxes[:, 0]).all())
+      assert ((boxes[:, 3] >= boxes[:, 1]).all())
+      annotation['bbox'] = boxes
+      annotation['flipped'] = True
+
+    return annotation
 
 
-class Resize(Node):
+class Resize(GeometricNode):
   def __init__(self, inputs, shape):
-    super(Resize, self).__init__(name=None, action=self.action, inputs=inputs)
+    super(Resize, self).__init__(inputs=inputs)
     self.shape = shape
 
-  def action(self, *args, **kwargs):
-    assert (len(args) == 1)
-    image, annotation = args[0] if len(args[0]) == 2 else (args[0], {})
-    # for image
-    image = scipy.misc.imresize(image, self.shape)
-    annotation = copy.deepcopy(annotation)
-    # for annotation
+  def transform(self, sample, annotation):
+    # (bilinear) resize to self.shape (height, width), pixel center is aligned
+    h, w = sample.shape
+    horizontal_scale = float(self.shape[1]) / float(w)
+    vertical_scale = float(self.shape[0]) / float(h)
+    matrix = np.array([[horizontal_scale, 0.0, 0.5 * (horizontal_scale - 1.0)],
+                       [0.0, vertical_scale, 0.5 * (vertical_scale - 1.0)],
+                       [0.0, 0.0, 1.0]])
+    sample.transform(matrix, self.shape[:2], order=1)
+
+    # for annotation (bbox is scaled without pixel center alignment, as before)
     if type(annotation) == dict and 'bbox' in annotation:
-      boxes = annotation['bbox']
-      info = annotation['info']
-      horizontal_scale = float(self.shape[1]) / float(info[1])
-      vertical_scale = float(self.shape[0]) / float(info[0])
-
-      boxes[:, [0, 2]] = boxes[:, [0, 2]] * horizontal_scale
-      boxes[:, [1, 3]] = boxes[:, [1, 3]] * vertical_scale
+      annotation['bbox'] = _transform_bbox(annotation['bbox'], np.diag([horizontal_scale, vertical_scale, 1.0]))
+    if type(annotation) == dict and 'info' in annotation:
+      annotation['info'] = tuple(self.shape[:2]) + tuple(annotation['info'][2:])
 
-      annotation['bbox'] = boxes
-    if type(annotation) == dict and 'segmentation' in annotation:
-      resized_obj_seg = []
-      for obj_seg in annotation['segmentation']:
-        temp = scipy.misc.imresize(obj_seg[:, :, 0], self.shape[::-1], 'nearest')
-        resized_obj_seg.append(temp.reshape(temp.shape[0],temp.shape[1],1))
-      annotation['segmentation'] = resized_obj_seg
-
-    return (image, annotation)
+    return annotation
 
 
 class Subtract(Node):
@@ -150,90 +238,34 @@ class DisturbChannels(Node):
     return (image, annotation)
 
 
-class DisturbRotation(Node):
+class DisturbRotation(GeometricNode):
   def __init__(self, inputs, max_deg=10):
-    super(DisturbRotation, self).__init__(name=None, action=self.action, inputs=inputs)
+    super(DisturbRotation, self).__init__(inputs=inputs)
     self._max_deg = max_deg
     self.rng = get_rng(self)
 
-  @staticmethod
-  def _affine_matrix(rotate_center, rotate_deg):
-    theta = np.deg2rad(rotate_deg)
-    rot = np.array([[np.cos(theta), np.sin(theta)], [-np.sin(theta), np.cos(theta)]])
-    # offset = np.array(rotate_center) - np.array(rotate_center).dot(rot)
-    offset = (rotate_center - rotate_center.dot(rot)).dot(np.linalg.inv(rot))
+  def transform(self, sample, annotation):
+    # (cubic) rotate around image center
+    deg = self.rng.uniform(-self._max_deg, self._max_deg)
+    height, width = sample.shape
+    center_x = width / 2.0
+    center_y = height / 2.0
 
-    return rot, -offset
+    theta = np.deg2rad(deg)
+    rot = np.array([[np.cos(theta), -np.sin(theta)], [np.sin(theta), np.cos(theta)]])
+    matrix = np.eye(3)
+    matrix[:2, :2] = rot
+    matrix[:2, 2] = np.array([center_x, center_y]) - rot.dot(np.array([center_x, center_y]))
+    sample.transform(matrix, sample.shape, order=3)
 
-  def action(self, *args, **kwargs):
-    assert(len(args) == 1)
-    image, annotation = args[0] if len(args[0]) == 2 else (args[0], {})
+    if type(annotation) == dict and 'bbox' in annotation:
+      # rotate bbox corners, then reset bbox and clip
+      bbox = _transform_bbox(annotation['bbox'], matrix)
+      bbox[:, [0, 2]] = np.minimum(np.maximum(bbox[:, [0, 2]], 0), width - 1)
+      bbox[:, [1, 3]] = np.minimum(np.maximum(bbox[:, [1, 3]], 0), height - 1)
+      annotation['bbox'] = bbox
 
-    deg = self.rng.uniform(-self._max_deg, self._max_deg)
-    center_x = image.shape[1] / 2.0
-    center_y = image.shape[0] / 2.0
-    rot, offset = DisturbRotation._affine_matrix(np.array([center_y, center_x]), -deg)
-
-    image_channles = [None, None, None]
-    for channel, image_channle in enumerate(np.split(image, 3, axis=2)):
-      image_channles[channel] = \
-          affine_transform(np.squeeze(image_channle, 2),
-                           rot,
-                           order=3,
-                           offset=offset,
-                           cval=0,
-                           output=np.uint8)
-
-    image = np.concatenate((np.expand_dims(image_channles[0], 2),
-                            np.expand_dims(image_channles[1], 2),
-                            np.expand_dims(image_channles[2], 2)), axis=2)
-    
-    annotation_cpy = copy.deepcopy(annotation)
-    if type(annotation_cpy) == dict and 'bbox' in annotation_cpy:
-      bbox = annotation_cpy['bbox']
-
-      rrr_theta = np.deg2rad(deg)
-      rrr = np.array([[np.cos(rrr_theta), np.sin(rrr_theta)], [-np.sin(rrr_theta), np.cos(rrr_theta)]])
-
-      # x0,y0,x1,y1,x0,y1,x1,y0
-      bbox_mm = np.concatenate((bbox,
-                                bbox[:, 0][:, np.newaxis], bbox[:, 3][:, np.newaxis],
-                                bbox[:, 2][:, np.newaxis], bbox[:, 1][:, np.newaxis]), axis=1)
-      bbox_mm = bbox_mm.reshape(-1, 2)
-      rotate_bbox = np.matmul(bbox_mm - np.array([center_x, center_y]).reshape(-1, 2), rrr) + \
-                    np.array([center_x, center_y]).reshape(-1, 2)
-      rotate_bbox = rotate_bbox.reshape(-1, 8)
-
-      # reset bbox and clip
-      temp = np.zeros(bbox.shape)
-      for bbox_i, bbox in enumerate(rotate_bbox):
-        x0, y0, x1, y1, xx0, yy0, xx1, yy1 = bbox
-        n_x0 = np.minimum(np.maximum(np.min([x0, x1, xx0, xx1]), 0), image.shape[1] - 1)
-        n_y0 = np.minimum(np.maximum(np.min([y0, y1, yy0, yy1]), 0), image.shape[0] - 1)
-
-        n_x1 = np.maximum(np.minimum(np.max([x0, x1, xx0, xx1]), image.shape[1] - 1), 0)
-        n_y1 = np.maximum(np.minimum(np.max([y0, y1, yy0, yy1]), image.shape[0] - 1), 0)
-
-        temp[bbox_i, 0] = n_x0
-        temp[bbox_i, 1] = n_y0
-        temp[bbox_i, 2] = n_x1
-        temp[bbox_i, 3] = n_y1
-
-      annotation_cpy['bbox'] = temp
-
-    if type(annotation_cpy) == dict and 'segmentation' in annotation_cpy:
-      obj_segs = []
-      for obj_seg in annotation_cpy['segmentation']:
-        obj_segs.append(
-          np.expand_dims(affine_transform(np.squeeze(obj_seg, 2),
-                                          rot,
-                                          order=3,
-                                          offset=offset,
-                                          cval=0,
-                                          output=np.uint8), axis=2))
-
-      annotation_cpy['segmentation'] = obj_segs
-    return image, annotation_cpy
+    return annotation
 
 
 class DisturbLighting(Node):
@@ -267,3 +299,97 @@ class DisturbNoise(Node):
     image_cpy = image.copy() + noise
 
     return image_cpy, annotation
+
+
+class BatchPhotometricNode(Node):
+  """
+  Base class of photometric augmentation on (B,H,W,C) batch of BatchData. Batch is converted to
+  ``dtype`` once (kept if already), and modified in place when ``inplace`` is True. Per sample
+  random parameters are drawn as vectors, with one RNG call per batch.
+  """
+  def __init__(self, inputs, dtype=np.float32, inplace=True):
+    super(BatchPhotometricNode, self).__init__(name=None, action=self.action, inputs=inputs)
+    self.dtype = dtype
+    self.inplace = inplace
+    self.rng = get_rng(self)
+
+  def _float_batch(self, batch):
+    if batch.dtype == self.dtype and self.inplace:
+      return batch
+    return batch.astype(self.dtype)
+
+  def batch_action(self, batch):
+    raise NotImplementedError
+
+  def action(self, *args, **kwargs):
+    assert(len(args) == 1)
+    # (batch, label) of BatchData or batch
+    if type(args[0]) in [tuple, list] and len(args[0]) == 2:
+      return (self.batch_action(args[0][0]), args[0][1])
+    return self.batch_action(args[0])
+
+
+class BatchSubtract(BatchPhotometricNode):
+  def __init__(self, inputs, mean_val=(128, 128, 128), dtype=np.float32, inplace=True):
+    super(BatchSubtract, self).__init__(inputs, dtype, inplace)
+    self._mean_value = np.array(mean_val, dtype=dtype)
+
+  def batch_action(self, batch):
+    batch = self._float_batch(batch)
+    batch -= self._mean_value
+    return batch
+
+
+class BatchDisturbLighting(BatchPhotometricNode):
+  def __init__(self, inputs, max_lighting=10, dtype=np.float32, inplace=True):
+    super(BatchDisturbLighting, self).__init__(inputs, dtype, inplace)
+    self._max_lighting = max_lighting
+
+  def batch_action(self, batch):
+    batch = self._float_batch(batch)
+    light = self.rng.uniform(-self._max_lighting, self._max_lighting, batch.shape[0]).astype(self.dtype)
+    batch += light.reshape((-1,) + (1,) * (batch.ndim - 1))
+    return batch
+
+
+class BatchDisturbNoise(BatchPhotometricNode):
+  def __init__(self, inputs, sigma=10, dtype=np.float32, inplace=True):
+    super(BatchDisturbNoise, self).__init__(inputs, dtype, inplace)
+    self._sigma = sigma
+    self._noise = None
+    # Generator draws float32 noise into reused buffer (without float64 temporary)
+    self._generator = None
+    if hasattr(np.random, 'default_rng'):
+      self._generator = np.random.default_rng(self.rng.randint(0, 2147483647))
+
+  def batch_action(self, batch):
+    batch = self._float_batch(batch)
+    if self._generator is None or self.dtype not in [np.float32, np.float64]:
+      noise = self.rng.uniform(-self._sigma, self._sigma, batch.shape).astype(self.dtype)
+    else:
+      if self._noise is None or self._noise.shape != batch.shape:
+        self._noise = np.empty(batch.shape, dtype=self.dtype)
+      noise = self._noise
+      self._generator.random(batch.shape, dtype=self.dtype, out=noise)
+      noise *= 2 * self._sigma
+      noise -= self._sigma
+
+    batch += noise
+    return batch
+
+
+class BatchDisturbChannels(BatchPhotometricNode):
+  def __init__(self, inputs, inplace=True):
+    super(BatchDisturbChannels, self).__init__(inputs, None, inplace)
+
+  def batch_action(self, batch):
+    if batch.ndim < 4:
+      return batch
+
+    # every sample has its own channel permutation (sample wise copy is faster than gather)
+    channels = np.argsort(self.rng.rand(batch.shape[0], batch.shape[3]), axis=1)
+    if not self.inplace:
+      batch = batch.copy()
+    for sample, sample_channels in zip(batch, channels):
+      sample[...] = sample[..., sample_channels]
+    return batch
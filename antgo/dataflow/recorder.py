@@ -16,11 +16,14 @@ except:
   import Queue as queue
 from antgo.task.task import *
 from antgo.dataflow.basic import *
+from antgo.dataflow.column import *
 
 
 class RecorderNode(Node):
-  def __init__(self, inputs):
+  def __init__(self, inputs, record_format='rocksdb'):
     super(RecorderNode, self).__init__(name=None, action=self.action, inputs=inputs, auto_trigger=True)
+    # record_format: 'rocksdb' or 'column' (memory mapped columnar record)
+    self._record_format = record_format
     self._dump_dir = None
     self._annotation_cache = queue.Queue()
     self._record_writer = None
@@ -43,6 +46,10 @@ class RecorderNode(Node):
     if self._record_writer is not None:
         self._record_writer.close()
     self._record_writer = None
+
+  def flush(self):
+    if self._record_writer is not None:
+      self._record_writer.flush()
     
   @property
   def dump_dir(self):
@@ -50,8 +57,13 @@ class RecorderNode(Node):
 
   @dump_dir.setter
   def dump_dir(self, val):
+    # pending samples of previous writer must be committed first
+    self.close()
     self._dump_dir = val
-    self._record_writer = RecordWriter(self._dump_dir)
+    if self._record_format == 'column':
+      self._record_writer = ColumnRecordWriter(self._dump_dir)
+    else:
+      self._record_writer = RecordWriter(self._dump_dir, batch_size=1000, batch_bytes=64*1024*1024)
 
   def action(self, *args, **kwargs):
     value = copy.deepcopy(args[0])
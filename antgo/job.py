@@ -8,6 +8,8 @@ from __future__ import print_function
 
 import uuid
 import threading
+import collections
+import multiprocessing
 import numpy as np
 import re
 import copy
@@ -62,6 +64,49 @@ class Chart():
     self.chart_id = unicode(uuid.uuid1()) if PYTHON_VERSION == 2 else str(uuid.uuid1())
 
 
+def reorganize_image_data(data):
+  # downscale and png encode image (module level, so that it could run in encoding process)
+  data_x, data_y = data
+  try:
+    data_x = float(data_x)
+  except:
+    logger.error("Channel X Must be Scalar Data")
+    return None
+
+  try:
+    if len(data_y.shape) != 2 and len(data_y.shape) != 3:
+      logger.error("Channel Y Must be 2 or 3 Dimension")
+      return None
+    if len(data_y.shape) == 3:
+      if data_y.shape[2] != 3:
+        logger.error("Channel Y Must Possess 3 or 1 Channels")
+        return None
+
+    allowed_size = 50.0
+    height, width = data_y.shape[:2]
+    min_scale = allowed_size / np.minimum(height, width)
+
+    new_height = int(height * min_scale)
+    new_width = int(width * min_scale)
+    resized_img = scipy.misc.imresize(data_y,(new_height, new_width))
+    # resized_img = data_y
+    if resized_img.dtype == np.uint8:
+      return (data_x, base64.b64encode(png_encode(resized_img)).decode('utf-8'))
+
+    max_val = np.max(resized_img.flatten())
+    min_val = np.min(resized_img.flatten())
+    if len(data_y.shape) == 3:
+        resized_img = ((resized_img - np.tile(min_val, (1,1,3))) / np.tile(max_val, (1,1,3))) * 255
+        resized_img = resized_img.astype(np.uint8)
+    else:
+        resized_img = (resized_img - min_val) / max_val * 255
+        resized_img = resized_img.astype(np.uint8)
+
+    return (data_x, base64.b64encode(png_encode(resized_img)).decode('utf-8'))
+  except:
+    logger.error("Channel Y Must be Numpy Array")
+
+
 class Channel():
   def __init__(self, channel_name = None, channel_type = None, channel_job=None, **channel_params):
     self.channel_id = -1
@@ -105,45 +150,7 @@ class Channel():
       return data
 
   def reorganize_image_data(self, data):
-    data_x, data_y = data
-    try:
-      data_x = float(data_x)
-    except:
-      logger.error("Channel X Must be Scalar Data")
-      return None
-
-    try:
-      if len(data_y.shape) != 2 and len(data_y.shape) != 3:
-        logger.error("Channel Y Must be 2 or 3 Dimension")
-        return None
-      if len(data_y.shape) == 3:
-        if data_y.shape[2] != 3:
-          logger.error("Channel Y Must Possess 3 or 1 Channels")
-          return None
-
-      allowed_size = 50.0
-      height, width = data_y.shape[:2]
-      min_scale = allowed_size / np.minimum(height, width)
-
-      new_height = int(height * min_scale)
-      new_width = int(width * min_scale)
-      resized_img = scipy.misc.imresize(data_y,(new_height, new_width))
-      # resized_img = data_y
-      if resized_img.dtype == np.uint8:
-        return (data_x, base64.b64encode(png_encode(resized_img)).decode('utf-8'))
-
-      max_val = np.max(resized_img.flatten())
-      min_val = np.min(resized_img.flatten())
-      if len(data_y.shape) == 3:
-          resized_img = ((resized_img - np.tile(min_val, (1,1,3))) / np.tile(max_val, (1,1,3))) * 255
-          resized_img = resized_img.astype(np.uint8)
-      else:
-          resized_img = (resized_img - min_val) / max_val * 255
-          resized_img = resized_img.astype(np.uint8)
-
-      return (data_x, base64.b64encode(png_encode(resized_img)).decode('utf-8'))
-    except:
-      logger.error("Channel Y Must be Numpy Array")
+    return reorganize_image_data(data)
 
   def reorganize_numeric_data(self, data):
     data_x, data_y = data
@@ -176,10 +183,15 @@ class Channel():
       logger.error("Channel Y Must be Numpy Array")
     return (data_x, data_y)
 
-  def send(self, x=0, y=0):
+  def send(self, x=0, y=0, copy_data=True):
     # {"CHART", (chart_id, chart_title,...)}
-    x_copy = copy.deepcopy(x)
-    y_copy = copy.deepcopy(y)
+    # copy_data=False hands over x, y without copy (caller mustn't modify them later)
+    x_copy = x
+    y_copy = y
+    if copy_data:
+      x_copy = x.copy() if type(x) == np.ndarray else copy.deepcopy(x)
+      y_copy = y.copy() if type(y) == np.ndarray else copy.deepcopy(y)
+
     data = {"CHANNEL": self,
             "DATA": {"CHART": [self.chart.id,
                                self.chart.title,
@@ -198,9 +210,28 @@ class Channel():
 
 
 class Job(threading.Thread):
-  def __init__(self, context=None):
+  # max pending data of every channel (by channel type, or channel param 'PENDING'),
+  # the oldest pending data of channel is dropped once exceeded (latest value wins)
+  channel_pending = {'IMAGE': 1, 'HISTOGRAM': 1, 'NUMERIC': 256}
+
+  def __init__(self, context=None, encode_process=True):
     super(Job, self).__init__()
-    self.data_queue = queue.Queue()
+    # pending data of every channel (key None is for non channel data, never dropped)
+    self.data_pending = {}
+    # key of pending data in arrival order
+    self.data_order = collections.deque()
+    self.data_condition = threading.Condition()
+    self.is_stop = False
+
+    # telemetry counter
+    self.queued_num = 0
+    self.dropped_num = 0
+    self.sent_num = 0
+
+    # image encoding process (downscale and png encoding is off training process)
+    self.encode_process = encode_process
+    self.encode_pool = None
+
     self.job_context = context
     self.setDaemon(True)
     self.pid = str(os.getpid())
@@ -226,45 +257,108 @@ class Job(threading.Thread):
   def context(self):
       return self.job_context
 
+  @property
+  def statistic(self):
+    # queued (pending now), dropped (replaced by latter data) and sent data number
+    with self.data_condition:
+      return {'queued': self.queued_num, 'dropped': self.dropped_num, 'sent': self.sent_num}
+
   def send(self, data):
     if data is None:
         return
 
     # running stage
     data["STAGE"] = self.context.stage
-    self.data_queue.put(data)
+
+    key = None
+    max_pending = 0
+    if 'CHANNEL' in data:
+      channel = data['CHANNEL']
+      key = (channel.chart.id, channel.id)
+      max_pending = channel.params.get('PENDING', Job.channel_pending.get(channel.channel_type, 1))
+
+    with self.data_condition:
+      pending = self.data_pending.setdefault(key, collections.deque())
+      if key is not None and len(pending) >= max(max_pending, 1):
+        # drop the oldest pending data of channel (its position in data_order is taken over)
+        pending.popleft()
+        self.dropped_num += 1
+      else:
+        self.data_order.append(key)
+        self.queued_num += 1
+
+      pending.append(data)
+      self.data_condition.notify()
 
   def stop(self):
-    self.data_queue.put(None)
+    with self.data_condition:
+      self.is_stop = True
+      self.data_condition.notify()
 
   def clone_charts(self):
     for chart in self.charts:
       chart.clone()
 
+  def _next(self):
+    # next pending data (None if job is stopped and all data has been sent)
+    with self.data_condition:
+      while len(self.data_order) == 0:
+        if self.is_stop:
+          return None
+        self.data_condition.wait()
+
+      key = self.data_order.popleft()
+      self.queued_num -= 1
+      return self.data_pending[key].popleft()
+
+  def _reorganize_image_data(self, data):
+    if self.encode_process and self.encode_pool is None:
+      try:
+        self.encode_pool = multiprocessing.Pool(1)
+      except:
+        logger.warn('fail to launch image encoding process, encode in job thread')
+        self.encode_process = False
+
+    if self.encode_pool is not None:
+      return self.encode_pool.apply(reorganize_image_data, (data,))
+
+    return reorganize_image_data(data)
+
   def run(self):
-    while True:
-      # 0.step get data
-      data = self.data_queue.get()
-
-      # check whether stop thread
-      if data is None:
-          break
-
-      # 1.step reorganize data
-      job_stage = data.pop('STAGE')
-      if 'CHANNEL' in data:
-        job_channel = data['CHANNEL']
-        chart_data = data['DATA']["CHART"]
-
-        # reorganize (channel_type, channel_y)
-        reorganized_xy= job_channel.reorganize_data(chart_data[6], [chart_data[8], chart_data[9]])
-        if reorganized_xy is None:
-          continue
-        chart_data[8] = reorganized_xy[0]
-        chart_data[9] = reorganized_xy[1]
-
-        data['DATA']["CHART"] = chart_data
-
-      # 2.step sending to mltalker
-      if self.job_context != None and data['DATA'] != None:
-        self.job_context.send(data['DATA'], job_stage)
\ No newline at end of file
+    try:
+      while True:
+        # 0.step get data
+        data = self._next()
+
+        # check whether stop thread
+        if data is None:
+            break
+
+        # 1.step reorganize data
+        job_stage = data.pop('STAGE')
+        if 'CHANNEL' in data:
+          job_channel = data['CHANNEL']
+          chart_data = data['DATA']["CHART"]
+
+          # reorganize (channel_type, channel_y)
+          if chart_data[6] == "IMAGE":
+            reorganized_xy = self._reorganize_image_data([chart_data[8], chart_data[9]])
+          else:
+            reorganized_xy = job_channel.reorganize_data(chart_data[6], [chart_data[8], chart_data[9]])
+          if reorganized_xy is None:
+            continue
+          chart_data[8] = reorganized_xy[0]
+          chart_data[9] = reorganized_xy[1]
+
+          data['DATA']["CHART"] = chart_data
+
+        # 2.step sending to mltalker
+        if self.job_context != None and data['DATA'] != None:
+          self.job_context.send(data['DATA'], job_stage)
+
+        with self.data_condition:
+          self.sent_num += 1
+    finally:
+      if self.encode_pool is not None:
+        self.encode_pool.terminate()
+        self.encode_pool = None
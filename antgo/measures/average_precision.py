@@ -129,8 +129,7 @@ def vmap(label, predicted_s):
         return None
 
     # transform to array(int)
-    if label.dtype != int:
-        actual = label.astype(dtype=int)
+    label = label.astype(dtype=int)
 
     # absorb some error
     if np.max(label) > 1:
@@ -141,50 +140,55 @@ def vmap(label, predicted_s):
         predicted_s = predicted_s.flatten()
 
     #data number
-    num = label.size
     assert(label.size == predicted_s.size)
 
-    #sort descend
-    index = sorted(range(num), key=lambda k: predicted_s[k], reverse=True)
+    return float(batch_vmap(label.reshape((1, -1)), predicted_s.reshape((1, -1)))[0])
 
-    label = label[index]
-    predicted_s = predicted_s[index]
 
-    positive_num = len(np.where(label == 1)[0])
-    num_hits = 0.0
+def batch_vmap(label, predicted_s):
+    '''
+    compute PASCAL VOC mean average precision of every row (all classes or all bootstrap replicas)
+    in a single call
+
+    Parameters
+    ----------
+    label: 2-D array of ground truth label (0 or 1, row padding should be 0)
+    predicted_s: 2-D array of predicted elements score (row padding should be -inf)
+    Returns
+    -------
+    return numpy array of mean average precision (-1 for row without detected positive)
+    '''
+    label = np.asarray(label)
+    predicted_s = np.asarray(predicted_s, dtype=np.float64)
+    if label.size == 0 or predicted_s.size == 0:
+        return None
+
+    rows, num = label.shape
+    assert(label.shape == predicted_s.shape)
+
+    #sort descend (stable)
+    index = np.argsort(-predicted_s, axis=1, kind='mergesort')
+    label = np.take_along_axis(label, index, axis=1)
+    predicted_s = np.take_along_axis(predicted_s, index, axis=1)
+
+    positive_num = np.sum(label >= 1, axis=1, keepdims=True)
+    hits = (label >= 1) & (predicted_s > -float("inf"))
+    num_hits = np.cumsum(hits, axis=1).astype(np.float64)
+
+    #recall and precision at every hit (precision elsewhere is 0, so it never raises envelope)
+    rc = num_hits / np.maximum(positive_num, 1)
+    pr = np.where(hits, num_hits / (np.arange(num) + 1.0), 0.0)
+    pr = np.maximum.accumulate(pr[:, ::-1], axis=1)[:, ::-1]
 
     #recall_thres = np.array(range(11)) * 0.1
-    recall_thres = np.linspace(.0, 1.00, np.round((1.00 - .0) / .01) + 1, endpoint=True)
-    rc = []
-    pr = []
-    for i in range(label.size):
-        if predicted_s[i] <= -float("inf"):
-            continue
-
-        if label[i] == 1:
-            num_hits += 1.0
-            #recall
-            recall = num_hits / positive_num
-
-            rc.append(recall)
-            pr.append(num_hits / (i + 1.0))
-
-    for i in range(len(pr) - 1, 0, -1):
-        if pr[i] > pr[i - 1]:
-            pr[i - 1] = pr[i]
-
-    inds = np.searchsorted(rc, recall_thres, side='left')
-    q = [-1 for _ in range(len(inds))]
-    try:
-        for ri, pi in enumerate(inds):
-            if pi == len(pr):
-                q[ri] = pr[pi - 1]
-            else:
-                q[ri] = pr[pi]
-    except:
-        pass
-
-    return float(np.mean(q))
+    recall_thres = np.linspace(.0, 1.00, int(np.round((1.00 - .0) / .01)) + 1, endpoint=True)
+    last_hit = num - 1 - np.argmax(hits[:, ::-1], axis=1)
+    q = -np.ones((rows, recall_thres.size))
+    for row in np.where(np.any(hits, axis=1))[0]:
+        inds = np.searchsorted(rc[row], recall_thres, side='left')
+        q[row] = pr[row, np.minimum(inds, last_hit[row])]
+
+    return np.mean(q, axis=1)
 
 #unit test
 class TestAveragePrecision(unittest.TestCase):
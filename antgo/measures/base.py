@@ -6,6 +6,17 @@ from __future__ import division
 from __future__ import unicode_literals
 from __future__ import print_function
 from antgo.task.task import *
+from antgo.utils.concurrency import DIE
+import threading
+import sys
+import six
+try:
+  import queue
+except:
+  import Queue as queue
+
+# cancel marker of streaming evaluation
+_CANCEL = object()
 
 
 class AntMeasure(object):
@@ -22,6 +33,84 @@ class AntMeasure(object):
     self._is_support_rank = False
     self._crowdsource = False
 
+  def eva_statistic(self, data, label):
+    '''
+    per sample sufficient statistic (used by vectorized bootstrap)
+    :param data: same as eva
+    :param label: same as eva
+    :return: (N x K) matrix, measure value only depends on its column sum (None, not supported)
+    '''
+    return None
+
+  def eva_from_statistic(self, statistic):
+    '''
+    :param statistic: (R x K) summed sufficient statistic of R (re)samplings
+    :return: (R,) measure value
+    '''
+    raise NotImplementedError
+
+  def eva_begin(self, cache=64):
+    '''
+    start streaming evaluation, (predict, gt) samples are pushed by eva_feed and
+    result (same as eva) is returned by eva_end. eva runs in a thread, which consumes pushed samples
+    :param cache: max number of pushed samples waiting for eva
+    '''
+    stream_queue = queue.Queue(cache)
+    stream_result = {'is_over': False}
+
+    def _stream():
+      while True:
+        sample = stream_queue.get()
+        if sample is DIE:
+          stream_result['is_over'] = True
+          return
+        if sample is _CANCEL:
+          stream_result['is_over'] = True
+          raise RuntimeError('streaming evaluation is cancelled')
+        yield sample
+
+    def _run():
+      try:
+        stream_result['result'] = self.eva(_stream(), None)
+      except:
+        stream_result['error'] = sys.exc_info()
+      finally:
+        # drain left samples, so that eva_feed never blocks
+        while not stream_result['is_over']:
+          sample = stream_queue.get()
+          stream_result['is_over'] = sample is DIE or sample is _CANCEL
+
+    stream_thread = threading.Thread(target=_run)
+    stream_thread.daemon = True
+    stream_thread.start()
+    self._stream = (stream_queue, stream_thread, stream_result)
+
+  def eva_feed(self, predict, gt):
+    self._stream[0].put((predict, gt))
+
+  def eva_end(self):
+    stream_queue, stream_thread, stream_result = self._stream
+    stream_queue.put(DIE)
+    stream_thread.join()
+    self._stream = None
+
+    if 'error' in stream_result:
+      six.reraise(*stream_result['error'])
+    return stream_result['result']
+
+  def eva_cancel(self):
+    # stop streaming evaluation without result (eva thread exits once it reaches cancel marker)
+    if getattr(self, '_stream', None) is None:
+      return
+
+    self._stream[0].put(_CANCEL)
+    self._stream = None
+
+  @property
+  def is_support_statistic(self):
+    # vectorized bootstrap needs both eva_statistic and eva_from_statistic
+    return type(self).eva_statistic != AntMeasure.eva_statistic and \
+           type(self).eva_from_statistic != AntMeasure.eva_from_statistic
 
   @property
   def is_support_rank(self):
@@ -42,4 +131,32 @@ class AntMeasure(object):
     return self._crowdsource
   @crowdsource.setter
   def crowdsource(self, val):
-    self._crowdsource = val
\ No newline at end of file
+    self._crowdsource = val
+
+
+def eva_measures(data, measures):
+  '''
+  evaluate all measures in one pass, every (predict, gt) sample of data is decoded once and
+  fed to all measures (measures shouldn't modify samples in place)
+  :param data: (predict, gt) iterator, e.g. record_reader.iterate_read('predict', 'groundtruth')
+  :param measures: AntMeasure list
+  :return: eva result list (same order as measures)
+  '''
+  if len(measures) == 1:
+    return [measures[0].eva(data, None)]
+
+  for measure in measures:
+    measure.eva_begin()
+
+  try:
+    for predict, gt in data:
+      for measure in measures:
+        measure.eva_feed(predict, gt)
+  except:
+    # keep original error, streams are cancelled (not finished)
+    error = sys.exc_info()
+    for measure in measures:
+      measure.eva_cancel()
+    six.reraise(*error)
+
+  return [measure.eva_end() for measure in measures]
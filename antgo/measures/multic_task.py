@@ -20,6 +20,24 @@ class AntAccuracyMultiC(AntMeasure):
     assert(task.task_type == 'CLASSIFICATION')
     self.is_support_rank = True
 
+  def eva_statistic(self, data, label):
+    # per sample (correct, count)
+    if label is not None:
+      data = zip(data, label)
+
+    statistic = []
+    for predict, gt in data:
+      gt_label = gt
+      if type(gt) == dict:
+        gt_label = gt['category_id']
+
+      statistic.append((1.0 if int(predict) == int(gt_label) else 0.0, 1.0))
+    return np.array(statistic).reshape((-1, 2))
+
+  def eva_from_statistic(self, statistic):
+    statistic = np.asarray(statistic)
+    return statistic[:, 0] / statistic[:, 1]
+
   def eva(self, data, label):
     '''
     :param data: logits (N x class_num)
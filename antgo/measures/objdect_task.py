@@ -13,6 +13,9 @@ from antgo.task.task import *
 from antgo.measures.base import *
 from antgo.utils._bbox import bbox_overlaps
 from collections import defaultdict
+from collections import OrderedDict
+import threading
+import multiprocessing
 import antgo.utils._mask as _mask
 
 __all__ = {'AntVOCDet': ('VOC', 'OBJECT-DETECTION'),
@@ -22,6 +25,162 @@ __all__ = {'AntVOCDet': ('VOC', 'OBJECT-DETECTION'),
            'AntTFTFDet': ('TFTF', 'OBJECT-DETECTION'),
            'AntCOCODet': ('COCO', 'OBJECT-DETECTION'),
            }
+
+
+# (predict, gt) -> matching result, shared by all detection measures evaluated in one pass
+# (cleared once no detection evaluation is running, so that samples aren't kept alive after evaluation)
+_MATCH_CACHE = OrderedDict()
+_MATCH_CACHE_SIZE = 1024
+_MATCH_CACHE_LOCK = threading.Lock()
+_MATCH_CACHE_USERS = 0
+
+
+def _greedy_match(det_bbox, det_category, gt_bbox, gt_category, overlap_thre):
+  '''
+  greedy matching (detections in given order, best overlap gt of same category)
+  :return: gtm (G,) matched detection index of gt (-1, missed), dtm (D,) matched gt index of detection (-1, unmatched)
+  '''
+  det_num = det_bbox.shape[0]
+  gt_num = gt_bbox.shape[0]
+  gtm = -np.ones((gt_num), dtype=np.int64)
+  dtm = -np.ones((det_num), dtype=np.int64)
+  if det_num == 0 or gt_num == 0:
+    return gtm, dtm
+
+  overlaps = bbox_overlaps(np.ascontiguousarray(det_bbox, dtype=np.float64),
+                           np.ascontiguousarray(gt_bbox, dtype=np.float64))
+
+  # category masking and overlap thresholding over whole (D x G) overlaps
+  overlaps[(det_category.reshape((-1, 1)) != gt_category.reshape((1, -1))) | (overlaps < overlap_thre)] = -1
+
+  # only detections with candidate gt take part in greedy assignment
+  for dind in np.where((overlaps >= 0).any(axis=1))[0]:
+    row = overlaps[dind]
+    best = row.max()
+    if best < 0:
+      continue
+
+    # last gt of best overlap (same as sequential scan)
+    m = gt_num - 1 - int(np.argmax(row[::-1] == best))
+    gtm[m] = dind
+    dtm[dind] = m
+    overlaps[:, m] = -1
+
+  return gtm, dtm
+
+
+def _match(predict, gt, overlap_thre):
+  key = (id(predict), id(gt), overlap_thre)
+  with _MATCH_CACHE_LOCK:
+    if key in _MATCH_CACHE:
+      return _MATCH_CACHE[key][2]
+
+  det_bbox = np.array(predict['det-bbox']).reshape((-1, 4))
+  det_score = np.array(predict['det-score']).flatten()
+  det_category = np.array(predict['det-label']).flatten().astype(np.int32)
+  gt_bbox = np.array(gt['bbox']).reshape((-1, 4))
+  gt_category = np.array(gt['category_id']).flatten().astype(np.int32)
+  gtm, dtm = _greedy_match(det_bbox, det_category, gt_bbox, gt_category, overlap_thre)
+  result = (det_score, det_category, gt_bbox, gt_category, gtm, dtm)
+
+  with _MATCH_CACHE_LOCK:
+    # keep predict and gt alive, so that their id is not reused
+    _MATCH_CACHE[key] = (predict, gt, result)
+    while len(_MATCH_CACHE) > _MATCH_CACHE_SIZE:
+      _MATCH_CACHE.popitem(last=False)
+
+  return result
+
+
+def _match_samples(data, overlap_thre, samples_scores=None):
+  # (category, score, label) arrays of detections and missed gts of all samples
+  categories = []
+  scores = []
+  labels = []
+  for predict, gt in data:
+    if predict is None:
+      gt_category = np.array(gt['category_id']).flatten().astype(np.int32)
+      categories.append(gt_category)
+      scores.append(np.full(gt_category.shape, -float("inf")))
+      labels.append(np.ones(gt_category.shape, dtype=np.int32))
+      continue
+
+    det_score, det_category, gt_bbox, gt_category, gtm, dtm = _match(predict, gt, overlap_thre)
+    matched = dtm >= 0
+    missed = gtm < 0
+
+    categories.extend([det_category[matched], det_category[~matched], gt_category[missed]])
+    scores.extend([det_score[matched], det_score[~matched], np.full((int(missed.sum())), -float("inf"))])
+    labels.extend([np.ones((int(matched.sum())), dtype=np.int32),
+                   np.zeros((int((~matched).sum())), dtype=np.int32),
+                   np.ones((int(missed.sum())), dtype=np.int32)])
+
+    if samples_scores is not None:
+      sample_id = gt['id']
+      for m in dtm[matched].tolist() + np.where(missed)[0].tolist():
+        samples_scores.append({'id': sample_id,
+                               'score': 0 if missed[m] else 1,
+                               'category': gt_category[m],
+                               'box': gt_bbox[m].tolist(),
+                               'index': sample_id * 100 + m})
+
+  return categories, scores, labels
+
+
+def _detection_statistic(data, category_num, overlap_thre, samples_scores=None):
+  '''
+  match every sample once and collect (label, score) of matched detection (1, score),
+  unmatched detection (0, score) and missed gt (1, -inf) for every category
+  '''
+  global _MATCH_CACHE_USERS
+  with _MATCH_CACHE_LOCK:
+    _MATCH_CACHE_USERS += 1
+
+  try:
+    categories, scores, labels = _match_samples(data, overlap_thre, samples_scores)
+  finally:
+    with _MATCH_CACHE_LOCK:
+      _MATCH_CACHE_USERS -= 1
+      if _MATCH_CACHE_USERS == 0:
+        _MATCH_CACHE.clear()
+
+  detection_score = [[] for _ in range(category_num)]
+  detection_label = [[] for _ in range(category_num)]
+  if len(categories) == 0:
+    return detection_score, detection_label
+
+  categories = np.concatenate(categories)
+  scores = np.concatenate(scores)
+  labels = np.concatenate(labels)
+
+  # stable sort keeps sample order within every category
+  order = np.argsort(categories, kind='mergesort')
+  categories = categories[order]
+  bounds = np.searchsorted(categories, np.arange(category_num + 1))
+  scores = scores[order]
+  labels = labels[order]
+  for c in range(category_num):
+    detection_score[c] = scores[bounds[c]:bounds[c + 1]].tolist()
+    detection_label[c] = labels[bounds[c]:bounds[c + 1]].tolist()
+
+  return detection_score, detection_label
+
+
+def _category_matrix(detection_score, detection_label):
+  '''
+  pad (label, score) of every category into (category x max length) matrix,
+  padding is (0, -inf) which is ignored by batch_vmap and batch_auc
+  '''
+  length = [len(s) for s in detection_score]
+  label_matrix = np.zeros((len(length), max(length + [1])), dtype=np.int32)
+  score_matrix = np.full((len(length), max(length + [1])), -float("inf"))
+  for c, (score, label) in enumerate(zip(detection_score, detection_label)):
+    score_matrix[c, :len(score)] = score
+    label_matrix[c, :len(label)] = label
+
+  return label_matrix, score_matrix, np.array(length) == 0
+
+
 class AntVOCDet(AntMeasure):
   def __init__(self, task):
     super(AntVOCDet, self).__init__(task, 'VOC')
@@ -31,113 +190,18 @@ class AntVOCDet(AntMeasure):
 
   def eva(self, data, label):
     category_num = len(self.task.class_label)
-    detection_score = [[] for _ in range(category_num)]
-    detection_label = [[] for _ in range(category_num)]
-
     if label is not None:
       data = zip(data, label)
 
-    # assert(len(data) == len(label))
-    predict_box_total = 0
-
-    samples_scores = []
     # 1.step positive sample is overlap > 0.5
-    for predict, gt in data:
-      # sample id
-      sample_id = gt['id']
-
-      if predict is None:
-        for missed_gt_bi in range(len(gt['bbox'])):
-          detection_label[gt['category_id'][missed_gt_bi]].append(1)
-          detection_score[gt['category_id'][missed_gt_bi]].append(-float("inf"))
-        continue
-
-      det_bbox = predict['det-bbox']
-      det_score = predict['det-score'].flatten()
-      det_label = predict['det-label'].flatten()
-
-      # ground truth bbox and categories
-      gt_bbox = np.array(gt['bbox'])
-      gt_category = np.array(gt['category_id']).astype(dtype=np.int32)
-      gt_bbox_num = gt_bbox.shape[0]
-
-      # predict position, category, and score
-      predict_box = np.array(det_bbox)
-      predict_category = np.array(det_label).astype(dtype=np.int32)
-      predict_score = np.array(det_score)
-      predict_box_total += predict_score.shape[0]
-
-      overlaps = bbox_overlaps(
-          np.ascontiguousarray(predict_box, dtype=np.float),
-          np.ascontiguousarray(gt_bbox, dtype=np.float))
-      #overlaps = _mask.iou(predict_box.tolist(), gt_bbox.tolist(), [0 for _ in range(gt_bbox_num)])
-
-      # distinguish positive and negative samples and scores (overlap > 0.5)
-      gtm = np.ones((gt_bbox_num)) * (-1)
-      for dind, d in enumerate(predict_box.tolist()):
-        # information about best match so far (m=-1 -> unmatched)
-        m = -1
-        iou = 0.5
-        for gind, g in enumerate(gt_bbox.tolist()):
-          if gt_category[gind] != predict_category[dind]:
-            continue
-
-          # if this gt already matched continue
-          if gtm[gind] >= 0:
-            continue
-
-          # continue to next gt unless better match made
-          if overlaps[dind, gind] < iou:
-            continue
-          # if match successful and best so far, store appropriately
-          iou = overlaps[dind, gind]
-          m = gind
-
-        # if match made store id of match for both dt and gt
-        if m > -1:
-          gtm[m] = dind
-
-          # success to match
-          detection_score[gt_category[m]].append(predict_score[dind])
-          detection_label[gt_category[m]].append(1)
-
-          # record sample
-          samples_scores.append({'id': sample_id,
-                                 'score': 1,
-                                 'category': gt_category[m],
-                                 'box': gt_bbox[m].tolist(),
-                                 'index': sample_id * 100 + m})
-
-      # process none matched det
-      for dind, d in enumerate(predict_box.tolist()):
-        if dind not in gtm:
-          detection_score[predict_category[dind]].append(predict_score[dind])
-          detection_label[predict_category[dind]].append(0)
-
-      # process missed gt bbox
-      missed_gt_bbox = [_ for _ in range(gt_bbox_num) if gtm[_] == -1]
-      for missed_gt_bi in missed_gt_bbox:
-        detection_label[gt_category[missed_gt_bi]].append(1)
-        detection_score[gt_category[missed_gt_bi]].append(-float("inf"))
-
-        # record sample
-        samples_scores.append({'id': sample_id,
-                               'score': 0,
-                               'category': gt_category[missed_gt_bi],
-                               'box': gt_bbox[missed_gt_bi].tolist(),
-                               'index': sample_id * 100 +  missed_gt_bi})
-
-      #########################################################################
+    samples_scores = []
+    detection_score, detection_label = _detection_statistic(data, category_num, 0.5, samples_scores)
 
     # 2.step compute mean average precision
-    voc_mean_map = []
-    for predict, gt in zip(detection_label, detection_score):
-      # skip 0
-      
-      result = vmap(predict, gt)
-      if result is None:
-        result = 0.0
-      voc_mean_map.append(result)
+    label_matrix, score_matrix, is_empty = _category_matrix(detection_score, detection_label)
+    voc_mean_map = batch_vmap(label_matrix, score_matrix)
+    voc_mean_map[is_empty] = 0.0
+    voc_mean_map = voc_mean_map.tolist()
 
     # 3.step make json
     voc_map = float(np.mean(voc_mean_map))
@@ -154,101 +218,29 @@ class AntROCandAUCDet(AntMeasure):
 
     def eva(self, data, label):
         category_num = len(self.task.class_label)
-        detection_score = [[] for _ in range(category_num)]
-        detection_label = [[] for _ in range(category_num)]
-
         if label is not None:
             data = zip(data, label)
 
-        # assert(len(data) == len(label))
         #
         overlap_thre = float(getattr(self.task, 'roc_auc_overlap', 0.5))
 
         # 1.step positive sample is overlap > overlap_thre
-        predict_box_total = 0
-        for predict, gt in data:
-            if predict is None:
-                for missed_gt_bi in range(len(gt['bbox'])):
-                    detection_label[gt['category_id'][missed_gt_bi]].append(1)
-                    detection_score[gt['category_id'][missed_gt_bi]].append(-float("inf"))
-                continue
-
-            det_bbox = predict['det-bbox']
-            det_score = predict['det-score'].flatten()
-            det_label = predict['det-label'].flatten()
-
-            # ground truth bbox and categories
-            gt_bbox = np.array(gt['bbox'])
-            gt_category = np.array(gt['category_id']).astype(dtype=np.int32)
-            gt_bbox_num = gt_bbox.shape[0]
-
-            # predict position, category, and score
-            predict_box = np.array(det_bbox)
-            predict_category = np.array(det_label).astype(dtype=np.int32)
-            predict_score = np.array(det_score)
-            predict_box_total += predict_score.shape[0]
-
-            overlaps = bbox_overlaps(
-                np.ascontiguousarray(predict_box, dtype=np.float),
-                np.ascontiguousarray(gt_bbox, dtype=np.float))
-
-            # distinguish positive and negative samples and scores (overlap > 0.5)
-            gtm = np.ones((gt_bbox_num)) * (-1)
-            for dind, d in enumerate(predict_box.tolist()):
-                # information about best match so far (m=-1 -> unmatched)
-                m = -1
-                iou = 0.5
-                for gind, g in enumerate(gt_bbox.tolist()):
-                    if gt_category[gind] != predict_category[dind]:
-                        continue
-
-                    # if this gt already matched  continue
-                    if gtm[gind] >= 0:
-                        continue
-
-                    # continue to next gt unless better match made
-                    if overlaps[dind, gind] < iou:
-                        continue
-                    # if match successful and best so far, store appropriately
-                    iou = overlaps[dind, gind]
-                    m = gind
-
-                # if match made store id of match for both dt and gt
-                if m > -1:
-                    gtm[m] = dind
-
-                    # success to match
-                    detection_score[gt_category[m]].append(predict_score[dind])
-                    detection_label[gt_category[m]].append(1)
-
-            # process none matched det
-            for dind, d in enumerate(predict_box.tolist()):
-                if dind not in gtm:
-                    detection_score[predict_category[dind]].append(predict_score[dind])
-                    detection_label[predict_category[dind]].append(0)
-
-            # process missed gt bbox
-            missed_gt_bbox = [_ for _ in range(gt_bbox_num) if gtm[_] == -1]
-            for missed_gt_bi in missed_gt_bbox:
-                detection_label[gt_category[missed_gt_bi]].append(1)
-                detection_score[gt_category[missed_gt_bi]].append(-float("inf"))
-
-            #########################################################################
+        detection_score, detection_label = _detection_statistic(data, category_num, overlap_thre)
 
         # 2.step compute ROC curve and AUC
         category_roc_curves = []
-        category_auc_scroes = []
         for predict, gt in zip(detection_label, detection_score):
             # skip 0
           
             roc_curve = roc(predict, gt)
             if roc_curve is None:
                 roc_curve = np.array(())
-            auc_score = auc(predict, gt)
-            if auc_score is None:
-                auc_score = 0
             category_roc_curves.append(roc_curve.tolist())
-            category_auc_scroes.append(auc_score)
+
+        label_matrix, score_matrix, is_empty = _category_matrix(detection_score, detection_label)
+        category_auc_scroes = batch_auc(label_matrix, score_matrix)
+        category_auc_scroes[is_empty] = 0
+        category_auc_scroes = category_auc_scroes.tolist()
 
         return {'statistic': {'name': self.name,
                               'value': [{'name': 'ROC',
@@ -270,87 +262,14 @@ class AntPRDet(AntMeasure):
 
     def eva(self, data, label):
         category_num = len(self.task.class_label)
-        detection_score = [[] for _ in range(category_num)]
-        detection_label = [[] for _ in range(category_num)]
-
         if label is not None:
             data = zip(data, label)
 
-        # assert(len(data) == len(label))
-
         #
         overlap_thre = float(getattr(self.task, 'pr_overlap', 0.5))
 
         # 1.step positive sample is overlap > overlap_thre
-        predict_box_total = 0
-        for predict, gt in data:
-            if predict is None:
-                for missed_gt_bi in range(len(gt['bbox'])):
-                    detection_label[gt['category_id'][missed_gt_bi]].append(1)
-                    detection_score[gt['category_id'][missed_gt_bi]].append(-float("inf"))
-                continue
-
-            det_bbox = predict['det-bbox']
-            det_score = predict['det-score'].flatten()
-            det_label = predict['det-label'].flatten()
-
-            # ground truth bbox and categories
-            gt_bbox = np.array(gt['bbox'])
-            gt_category = np.array(gt['category_id']).astype(dtype=np.int32)
-            gt_bbox_num = gt_bbox.shape[0]
-
-            # predict position, category, and score
-            predict_box = np.array(det_bbox)
-            predict_category = np.array(det_label).astype(dtype=np.int32)
-            predict_score = np.array(det_score)
-            predict_box_total += predict_score.shape[0]
-
-            overlaps = bbox_overlaps(
-                np.ascontiguousarray(predict_box, dtype=np.float),
-                np.ascontiguousarray(gt_bbox, dtype=np.float))
-
-            # distinguish positive and negative samples and scores (overlap > 0.5)
-            gtm = np.ones((gt_bbox_num)) * (-1)
-            for dind, d in enumerate(predict_box.tolist()):
-                # information about best match so far (m=-1 -> unmatched)
-                m = -1
-                iou = 0.5
-                for gind, g in enumerate(gt_bbox.tolist()):
-                    if gt_category[gind] != predict_category[dind]:
-                        continue
-
-                    # if this gt already matched  continue
-                    if gtm[gind] >= 0:
-                        continue
-
-                    # continue to next gt unless better match made
-                    if overlaps[dind, gind] < iou:
-                        continue
-                    # if match successful and best so far, store appropriately
-                    iou = overlaps[dind, gind]
-                    m = gind
-
-                # if match made store id of match for both dt and gt
-                if m > -1:
-                    gtm[m] = dind
-
-                    # success to match
-                    detection_score[gt_category[m]].append(predict_score[dind])
-                    detection_label[gt_category[m]].append(1)
-
-            # process none matched det
-            for dind, d in enumerate(predict_box.tolist()):
-                if dind not in gtm:
-                    detection_score[predict_category[dind]].append(predict_score[dind])
-                    detection_label[predict_category[dind]].append(0)
-
-            # process missed gt bbox
-            missed_gt_bbox = [_ for _ in range(gt_bbox_num) if gtm[_] == -1]
-            for missed_gt_bi in missed_gt_bbox:
-                detection_label[gt_category[missed_gt_bi]].append(1)
-                detection_score[gt_category[missed_gt_bi]].append(-float("inf"))
-
-            #########################################################################
+        detection_score, detection_label = _detection_statistic(data, category_num, overlap_thre)
 
         # 2.step compute Precicion Recall curve
         category_pr_curves = []
@@ -377,87 +296,14 @@ class AntAPRFDet(AntMeasure):
 
     def eva(self, data, label):
         category_num = len(self.task.class_label)
-        detection_score = [[] for _ in range(category_num)]
-        detection_label = [[] for _ in range(category_num)]
-
         if label is not None:
             data = zip(data, label)
 
-        # assert(len(data) == len(label))
-
         #
         overlap_thre = float(getattr(self.task, 'aprf_overlap', 0.5))
 
         # 1.step positive sample is overlap > overlap_thre
-        predict_box_total = 0
-        for predict, gt in data:
-            if predict is None:
-                for missed_gt_bi in range(len(gt['bbox'])):
-                    detection_label[gt['category_id'][missed_gt_bi]].append(1)
-                    detection_score[gt['category_id'][missed_gt_bi]].append(-float("inf"))
-                continue
-
-            det_bbox = predict['det-bbox']
-            det_score = predict['det-score']
-            det_label = predict['det-label']
-
-            # ground truth bbox and categories
-            gt_bbox = np.array(gt['bbox'])
-            gt_category = np.array(gt['category_id']).astype(dtype=np.int32)
-            gt_bbox_num = gt_bbox.shape[0]
-
-            # predict position, category, and score
-            predict_box = np.array(det_bbox)
-            predict_category = np.array(det_label).astype(dtype=np.int32)
-            predict_score = np.array(det_score)
-            predict_box_total += predict_score.shape[0]
-
-            overlaps = bbox_overlaps(
-                np.ascontiguousarray(predict_box, dtype=np.float),
-                np.ascontiguousarray(gt_bbox, dtype=np.float))
-
-            # distinguish positive and negative samples and scores (overlap > 0.5)
-            gtm = np.ones((gt_bbox_num)) * (-1)
-            for dind, d in enumerate(predict_box.tolist()):
-                # information about best match so far (m=-1 -> unmatched)
-                m = -1
-                iou = 0.5
-                for gind, g in enumerate(gt_bbox.tolist()):
-                    if gt_category[gind] != predict_category[dind]:
-                        continue
-
-                    # if this gt already matched  continue
-                    if gtm[gind] >= 0:
-                        continue
-
-                    # continue to next gt unless better match made
-                    if overlaps[dind, gind] < iou:
-                        continue
-                    # if match successful and best so far, store appropriately
-                    iou = overlaps[dind, gind]
-                    m = gind
-
-                # if match made store id of match for both dt and gt
-                if m > -1:
-                    gtm[m] = dind
-
-                    # success to match
-                    detection_score[gt_category[m]].append(predict_score[dind])
-                    detection_label[gt_category[m]].append(1)
-
-            # process none matched det
-            for dind, d in enumerate(predict_box.tolist()):
-                if dind not in gtm:
-                    detection_score[predict_category[dind]].append(predict_score[dind])
-                    detection_label[predict_category[dind]].append(0)
-
-            # process missed gt bbox
-            missed_gt_bbox = [_ for _ in range(gt_bbox_num) if gtm[_] == -1]
-            for missed_gt_bi in missed_gt_bbox:
-                detection_label[gt_category[missed_gt_bi]].append(1)
-                detection_score[gt_category[missed_gt_bi]].append(-float("inf"))
-
-            #########################################################################
+        detection_score, detection_label = _detection_statistic(data, category_num, overlap_thre)
 
         # 2.step compute accuracy, precision, recall, and F1
         category_accuracy = []
@@ -507,86 +353,14 @@ class AntTFTFDet(AntMeasure):
 
     def eva(self, data, label):
         category_num = len(self.task.class_label)
-        detection_score = [[] for _ in range(category_num)]
-        detection_label = [[] for _ in range(category_num)]
-
         if label is not None:
             data = zip(data, label)
-        # assert(len(data) == len(label))
 
         #
         overlap_thre = float(getattr(self.task,'APRF_overlap',0.5))
 
         # 1.step positive sample is overlap > overlap_thre
-        predict_box_total = 0
-        for predict, gt in data:
-            if predict is None:
-                for missed_gt_bi in range(len(gt['bbox'])):
-                    detection_label[gt['category_id'][missed_gt_bi]].append(1)
-                    detection_score[gt['category_id'][missed_gt_bi]].append(-float("inf"))
-                continue
-
-            det_bbox = predict['det-bbox']
-            det_score = predict['det-score'].flatten()
-            det_label = predict['det-label'].flatten()
-
-            # ground truth bbox and categories
-            gt_bbox = np.array(gt['bbox'])
-            gt_category = np.array(gt['category_id']).astype(dtype=np.int32)
-            gt_bbox_num = gt_bbox.shape[0]
-
-            # predict position, category, and score
-            predict_box = np.array(det_bbox)
-            predict_category = np.array(det_label).astype(dtype=np.int32)
-            predict_score = np.array(det_score)
-            predict_box_total += predict_score.shape[0]
-
-            overlaps = bbox_overlaps(
-                np.ascontiguousarray(predict_box, dtype=np.float),
-                np.ascontiguousarray(gt_bbox, dtype=np.float))
-
-            # distinguish positive and negative samples and scores (overlap > 0.5)
-            gtm = np.ones((gt_bbox_num)) * (-1)
-            for dind, d in enumerate(predict_box.tolist()):
-                # information about best match so far (m=-1 -> unmatched)
-                m = -1
-                iou = 0.5
-                for gind, g in enumerate(gt_bbox.tolist()):
-                    if gt_category[gind] != predict_category[dind]:
-                        continue
-
-                    # if this gt already matched  continue
-                    if gtm[gind] >= 0:
-                        continue
-
-                    # continue to next gt unless better match made
-                    if overlaps[dind, gind] < iou:
-                        continue
-                    # if match successful and best so far, store appropriately
-                    iou = overlaps[dind, gind]
-                    m = gind
-
-                # if match made store id of match for both dt and gt
-                if m > -1:
-                    gtm[m] = dind
-
-                    # success to match
-                    detection_score[gt_category[m]].append(predict_score[dind])
-                    detection_label[gt_category[m]].append(1)
-
-            # process none matched det
-            for dind, d in enumerate(predict_box.tolist()):
-                if dind not in gtm:
-                    detection_score[predict_category[dind]].append(predict_score[dind])
-                    detection_label[predict_category[dind]].append(0)
-
-            # process missed gt bbox
-            missed_gt_bbox = [_ for _ in range(gt_bbox_num) if gtm[_] == -1]
-            for missed_gt_bi in missed_gt_bbox:
-                detection_label[gt_category[missed_gt_bi]].append(1)
-                detection_score[gt_category[missed_gt_bi]].append(-float("inf"))
-
-            #########################################################################
+        detection_score, detection_label = _detection_statistic(data, category_num, overlap_thre)
 
         # 2.step compute true positive(TP), false negative(FN), true negative(TN), false positive(FP)
         category_TP = []
@@ -628,218 +402,269 @@ class AntTFTFDet(AntMeasure):
                                          'y': 'FP'}]},}
 
 
+# state of running coco evaluation in pool worker (set by _coco_init_worker)
+_COCO_EVALUATION = {}
+
+# AntCOCODet attributes used by per image evaluation
+_COCO_EVALUATION_STATE = ['catIds', 'maxDets', 'areaRng', 'iouThrs', '_gt', '_dt',
+                          '_gt_order', '_gt_bounds', '_dt_order', '_dt_bounds']
+
+
+def _coco_init_worker(state):
+  # rebuild evaluation from struct of arrays gts/dts (doesn't depend on fork)
+  measure = AntCOCODet.__new__(AntCOCODet)
+  measure.__dict__.update(state)
+  _COCO_EVALUATION['measure'] = measure
+
+
+def _coco_evaluate_shard(shard):
+  start, stop = shard
+  return _COCO_EVALUATION['measure']._evaluate_images(start, stop)
+
+
+def _coco_match(ious, gtIg, iscrowd, iouThrs):
+  '''
+  greedy matching of score sorted detections and ignore sorted gts for every iou threshold
+  :return: dtm (T x D) matched flag, dtIg (T x D) matched to ignored gt flag
+  '''
+  T = len(iouThrs)
+  D, G = ious.shape
+  dtm = np.zeros((T, D), dtype=np.bool_)
+  dtIg = np.zeros((T, D), dtype=np.bool_)
+
+  # detections below threshold never match, skip them
+  max_ious = ious.max(axis=1)
+  gtIg = gtIg.tolist()
+  for tind, t in enumerate(iouThrs):
+    thre = min([t, 1-1e-10])
+    candidates = np.where(max_ious >= thre)[0]
+    if len(candidates) == 0:
+      break
+
+    gtm = [0] * G
+    for dind, row in zip(candidates.tolist(), ious[candidates].tolist()):
+      # information about best match so far (m=-1 -> unmatched)
+      iou = thre
+      m = -1
+      for gind in range(G):
+        # if this gt already matched, and not a crowd, continue
+        if gtm[gind] and not iscrowd[gind]:
+          continue
+        # if dt matched to reg gt, and on ignore gt, stop
+        if m > -1 and gtIg[m] == 0 and gtIg[gind] == 1:
+          break
+        # continue to next gt unless better match made
+        if row[gind] < iou:
+          continue
+        # if match successful and best so far, store appropriately
+        iou = row[gind]
+        m = gind
+      # if match made store match for both dt and gt
+      if m == -1:
+        continue
+      dtIg[tind, dind] = gtIg[m]
+      dtm[tind, dind] = True
+      gtm[m] = 1
+
+  return dtm, dtIg
+
+
 class AntCOCODet(AntMeasure):
     def __init__(self, task):
         super(AntCOCODet, self).__init__(task, 'COCO')
         assert(task.task_type == 'OBJECT-DETECTION')
 
         # np.arange causes trouble.  the data point on arange is slightly larger than the true value
-        self.iouThrs = np.linspace(.5, 0.95, np.round((0.95 - .5) / .05) + 1, endpoint=True)
-        self.recThrs = np.linspace(.0, 1.00, np.round((1.00 - .0) / .01) + 1, endpoint=True)
+        self.iouThrs = np.linspace(.5, 0.95, int(np.round((0.95 - .5) / .05)) + 1, endpoint=True)
+        self.recThrs = np.linspace(.0, 1.00, int(np.round((1.00 - .0) / .01)) + 1, endpoint=True)
         self.maxDets = [1, 10, 100]
         self.areaRng = [[0 ** 2, 1e5 ** 2], [0 ** 2, 32 ** 2], [32 ** 2, 96 ** 2], [96 ** 2, 1e5 ** 2]]
         self.areaRngLbl = ['all', 'small', 'medium', 'large']
         self.useCats = 1
-        self.dts = []
-        self.gts = []
         self.imgIds = []
         self.catIds = []
+        # number of processes of per image evaluation (None, cpu count)
+        self.processes = getattr(task, 'coco_processes', None)
 
     def _parse_result(self, data, label):
+        '''
+        gts and dts in struct of arrays form
+        '''
         if label is not None:
             data = zip(data, label)
 
-        # assert(len(data) == len(label))
-        gt_id = 1
-        det_id = 1
-        for index, (a, b) in enumerate(data):
-            image_id = -1
-            for gt_box_i, gt_box in enumerate(b['bbox']):
-                gt = {}
-                x0, y0, x1, y1 = gt_box
-                gt['bbox'] = np.array([x0, y0, x1, y1])
-                gt['area'] = b['area'][gt_box_i]
-                gt['image_id'] = b['id']
-                gt['category_id'] = b['category_id'][gt_box_i]
-                gt['iscrowd'] = b['iscrowd'][gt_box_i] if 'iscrowd' in b else 0
-                gt['id'] = gt_id
-                gt_id += 1
-                image_id = b['id']
-                self.imgIds.append(image_id)
-                self.catIds.append(b['category_id'][gt_box_i])
-                self.gts.append(gt)
+        gt_image, gt_category, gt_bbox, gt_area, gt_iscrowd = [], [], [], [], []
+        dt_image, dt_category, dt_bbox, dt_area, dt_score = [], [], [], [], []
+        for a, b in data:
+            gt_num = len(b['bbox'])
+            if gt_num == 0:
+                # detections of image without gt are never evaluated
+                continue
+
+            gt_image.append(np.full((gt_num), b['id']))
+            gt_category.append(np.array(b['category_id']).reshape((-1))[:gt_num])
+            gt_bbox.append(np.array(b['bbox']).reshape((gt_num, 4)))
+            gt_area.append(np.array(b['area']).reshape((-1))[:gt_num])
+            gt_iscrowd.append(np.array(b['iscrowd']).reshape((-1))[:gt_num]
+                              if 'iscrowd' in b else np.zeros((gt_num), dtype=np.int32))
 
             if a is None:
-                dt = {}
-                dt['bbox'] = None
-                dt['area'] = 0
-                dt['image_id'] = -1
-                dt['category_id'] = -1
-                dt['score'] = -1
-                dt['id'] = -1
-                self.dts.append(dt)
                 continue
 
             # a dict {'det-bbox':, 'det-score':, 'det-label':,}
-            # b annotation
-            det_bbox = a['det-bbox']
-            det_score = a['det-score'].flatten()
-            det_label = a['det-label'].flatten()
-
-            for box_i, box in enumerate(det_bbox):
-                dt = {}
-                x0, y0, x1, y1 = box
-                score = det_score[box_i]
-                label = int(det_label[box_i])
-
-                dt['bbox'] = np.array([x0, y0, x1, y1])
-                dt['area'] = (x1 - x0) * (y1 - y0)
-                dt['image_id'] = image_id
-                dt['category_id'] = int(label)
-                dt['score'] = score
-                dt['id'] = det_id
-                det_id += 1
-
-                self.dts.append(dt)
+            det_bbox = np.array(a['det-bbox'])
+            det_num = det_bbox.shape[0]
+            if det_num == 0:
+                continue
+            dt_image.append(np.full((det_num), b['id']))
+            dt_category.append(a['det-label'].flatten().astype(np.int64))
+            det_bbox = det_bbox.reshape((det_num, 4))
+            dt_bbox.append(det_bbox)
+            dt_area.append((det_bbox[:, 2] - det_bbox[:, 0]) * (det_bbox[:, 3] - det_bbox[:, 1]))
+            dt_score.append(a['det-score'].flatten())
+
+        def _concat(arrays, shape):
+            return np.concatenate(arrays) if len(arrays) > 0 else np.zeros(shape)
+
+        self._gt = {'image_id': _concat(gt_image, (0,)),
+                    'category_id': _concat(gt_category, (0,)),
+                    'bbox': _concat(gt_bbox, (0, 4)),
+                    'area': _concat(gt_area, (0,)),
+                    'iscrowd': _concat(gt_iscrowd, (0,))}
+        self._dt = {'image_id': _concat(dt_image, (0,)),
+                    'category_id': _concat(dt_category, (0,)),
+                    'bbox': _concat(dt_bbox, (0, 4)),
+                    'area': _concat(dt_area, (0,)),
+                    'score': _concat(dt_score, (0,))}
 
     def _prepare(self):
         '''
-        Prepare ._gts and ._dts for evaluation based on params
+        group gts and dts by (image, category), dts are sorted by score only once
         :return: None
         '''
-        # set ignore flag
-        for gt in self.gts:
-            gt['ignore'] = gt['ignore'] if 'ignore' in gt else 0
-            gt['ignore'] = 'iscrowd' in gt and gt['iscrowd']
-
-        self._gts = defaultdict(list)       # gt for evaluation
-        self._dts = defaultdict(list)       # dt for evaluation
-        for gt in self.gts:
-            self._gts[gt['image_id'], gt['category_id']].append(gt)
-        for dt in self.dts:
-            self._dts[dt['image_id'], dt['category_id']].append(dt)
-        self.evalImgs = defaultdict(list)   # per-image per-category evaluation results
+        self.imgIds = list(np.unique(self._gt['image_id']))
+        self.catIds = list(np.unique(self._gt['category_id']))
+        self.maxDets = sorted(self.maxDets)
+        I0 = len(self.imgIds)
+        K0 = len(self.catIds)
+
+        def _group_key(items):
+            image_index = np.searchsorted(self.imgIds, items['image_id']).clip(0, max(I0 - 1, 0))
+            category_index = np.searchsorted(self.catIds, items['category_id']).clip(0, max(K0 - 1, 0))
+            valid = (np.array(self.imgIds)[image_index] == items['image_id']) & \
+                    (np.array(self.catIds)[category_index] == items['category_id']) if I0 * K0 > 0 else \
+                    np.zeros(items['image_id'].shape, dtype=np.bool_)
+            return np.where(valid, image_index * K0 + category_index, I0 * K0)
+
+        # gt keeps input order in group
+        gt_key = _group_key(self._gt)
+        self._gt_order = np.argsort(gt_key, kind='mergesort')
+        self._gt_bounds = np.searchsorted(gt_key[self._gt_order], np.arange(I0 * K0 + 1))
+
+        # dt is sorted by score (mergesort keeps input order of same score) in group
+        dt_key = _group_key(self._dt)
+        score_order = np.argsort(-self._dt['score'], kind='mergesort')
+        self._dt_order = score_order[np.argsort(dt_key[score_order], kind='mergesort')]
+        self._dt_bounds = np.searchsorted(dt_key[self._dt_order], np.arange(I0 * K0 + 1))
+
+        self.evalImgs = {}                  # per-category per-area evaluation results of all images
         self.eval     = {}                  # accumulated evaluation results
 
     def _evaluate(self):
         '''
-        Run per image evaluation on given images and store results (a list of dict) in self.evalImgs
+        Run per image evaluation (process pool over image shards) and merge results into self.evalImgs
         :return: None
         '''
-        #p = self.params
+        self._prepare()
 
-        self.imgIds = list(np.unique(self.imgIds))
-        self.catIds = list(np.unique(self.catIds))
-        self.maxDets = sorted(self.maxDets)
+        I0 = len(self.imgIds)
+        processes = self.processes
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        processes = max(1, min(processes, I0 // 64))
+        if multiprocessing.current_process().daemon:
+            # daemonic process (i.e. bootstrap worker) is not allowed to have children
+            processes = 1
+
+        if processes == 1:
+            shards_results = [self._evaluate_images(0, I0)]
+        else:
+            shard_size = int(np.ceil(I0 / float(processes * 4)))
+            shards = [(start, min(start + shard_size, I0)) for start in range(0, I0, shard_size)]
+            state = {k: getattr(self, k) for k in _COCO_EVALUATION_STATE}
+            pool = multiprocessing.Pool(processes, initializer=_coco_init_worker, initargs=(state,))
+            try:
+                shards_results = pool.map(_coco_evaluate_shard, shards)
+            finally:
+                pool.close()
+                pool.join()
+
+        # merge shards (in image order)
+        for k in range(len(self.catIds)):
+            for a in range(len(self.areaRng)):
+                self.evalImgs[k, a] = []
+                for shard_results in shards_results:
+                    self.evalImgs[k, a].extend(shard_results[k, a])
+
+    def _evaluate_images(self, start, stop):
+        '''
+        evaluate images [start, stop) for all categories and area ranges
+        :return: {(category index, area index): [per image result, ...]}
+        '''
+        K0 = len(self.catIds)
+        maxDet = self.maxDets[-1]
+        results = {(k, a): [] for k in range(K0) for a in range(len(self.areaRng))}
+        for i in range(start, stop):
+            for k in range(K0):
+                gt = self._gt_order[self._gt_bounds[i * K0 + k]:self._gt_bounds[i * K0 + k + 1]]
+                dt = self._dt_order[self._dt_bounds[i * K0 + k]:self._dt_bounds[i * K0 + k + 1]][0:maxDet]
+                if len(gt) == 0 and len(dt) == 0:
+                    continue
 
-        self._prepare()
-        # loop through images, area range, max detection number
-        catIds = self.catIds
-        computeIoU = self._computeIoU
+                ious = self._computeIoU(gt, dt)
+                for a, aRng in enumerate(self.areaRng):
+                    results[k, a].append(self._evaluateImg(gt, dt, ious, aRng))
 
-        self.ious = {(imgId, catId): computeIoU(imgId, catId) \
-                        for imgId in self.imgIds
-                        for catId in catIds}
+        return results
 
-        maxDet = self.maxDets[-1]
-        self.evalImgs = [self._evaluateImg(imgId, catId, areaRng, maxDet)
-                 for catId in catIds
-                 for areaRng in self.areaRng
-                 for imgId in self.imgIds
-             ]
-
-    def _computeIoU(self, imgId, catId):
-        # p = self.params
-        gt = self._gts[imgId, catId]
-        dt = self._dts[imgId, catId]
-
-        if len(gt) == 0 and len(dt) == 0:
-            return []
-        inds = np.argsort([-d['score'] for d in dt], kind='mergesort')
-        dt = [dt[i] for i in inds]
-        if len(dt) > self.maxDets[-1]:
-            dt = dt[0:self.maxDets[-1]]
-
-        g = [g['bbox'] for g in gt]
-        d = [d['bbox'] for d in dt]
+    def _computeIoU(self, gt, dt):
+        g = list(self._gt['bbox'][gt])
+        d = list(self._dt['bbox'][dt])
 
         # compute iou between each dt and gt region
-        iscrowd = [int(o['iscrowd']) for o in gt]
+        iscrowd = [int(o) for o in self._gt['iscrowd'][gt]]
         ious = _mask.iou(d, g, iscrowd)
         return ious
 
-    def _evaluateImg(self, imgId, catId, aRng, maxDet):
+    def _evaluateImg(self, gt, dt, ious, aRng):
         '''
-        perform evaluation for single category and image
+        perform evaluation for single category and image (dt is sorted by score)
         :return: dict (single image results)
         '''
-        gt = self._gts[imgId, catId]
-        dt = self._dts[imgId, catId]
-
-        if len(gt) == 0 and len(dt) ==0:
-            return None
-
-        for g in gt:
-            if g['ignore'] or (g['area'] < aRng[0] or g['area'] > aRng[1]):
-                g['_ignore'] = 1
-            else:
-                g['_ignore'] = 0
+        gt_area = self._gt['area'][gt]
+        gt_ignore = (self._gt['iscrowd'][gt] != 0) | (gt_area < aRng[0]) | (gt_area > aRng[1])
 
-        # sort dt highest score first, sort gt ignore last
-        gtind = np.argsort([g['_ignore'] for g in gt], kind='mergesort')
-        gt = [gt[i] for i in gtind]
-        dtind = np.argsort([-d['score'] for d in dt], kind='mergesort')
-        dt = [dt[i] for i in dtind[0:maxDet]]
-        iscrowd = [int(o['iscrowd']) for o in gt]
-        # load computed ious
-        ious = self.ious[imgId, catId][:, gtind] if len(self.ious[imgId, catId]) > 0 else self.ious[imgId, catId]
+        # sort gt ignore last
+        gtind = np.argsort(gt_ignore, kind='mergesort')
+        gtIg = gt_ignore[gtind].astype(np.int64)
+        iscrowd = [int(o) for o in self._gt['iscrowd'][gt][gtind]]
 
         T = len(self.iouThrs)
-        G = len(gt)
         D = len(dt)
-        gtm  = np.zeros((T,G))
-        dtm  = np.zeros((T,D))
-        gtIg = np.array([g['_ignore'] for g in gt])
-        dtIg = np.zeros((T,D))
-        if not len(ious)==0:
-            for tind, t in enumerate(self.iouThrs):
-                for dind, d in enumerate(dt):
-                    # information about best match so far (m=-1 -> unmatched)
-                    iou = min([t, 1-1e-10])
-                    m   = -1
-                    for gind, g in enumerate(gt):
-                        # if this gt already matched, and not a crowd, continue
-                        if gtm[tind, gind] > 0 and not iscrowd[gind]:
-                            continue
-                        # if dt matched to reg gt, and on ignore gt, stop
-                        if m > -1 and gtIg[m] == 0 and gtIg[gind] == 1:
-                            break
-                        # continue to next gt unless better match made
-                        if ious[dind, gind] < iou:
-                            continue
-                        # if match successful and best so far, store appropriately
-                        iou = ious[dind, gind]
-                        m = gind
-                    # if match made store id of match for both dt and gt
-                    if m == -1:
-                        continue
-                    dtIg[tind, dind] = gtIg[m]
-                    dtm[tind, dind]  = gt[m]['id']
-                    gtm[tind, m]     = d['id']
+        if len(ious) > 0:
+            dtm, dtIg = _coco_match(np.asarray(ious)[:, gtind], gtIg, iscrowd, self.iouThrs)
+        else:
+            dtm = np.zeros((T, D), dtype=np.bool_)
+            dtIg = np.zeros((T, D), dtype=np.bool_)
+
         # set unmatched detections outside of area range to ignore
-        a = np.array([d['area']<aRng[0] or d['area']>aRng[1] for d in dt]).reshape((1, len(dt)))
-        dtIg = np.logical_or(dtIg, np.logical_and(dtm==0, np.repeat(a,T,0)))
+        dt_area = self._dt['area'][dt]
+        a = ((dt_area < aRng[0]) | (dt_area > aRng[1])).reshape((1, D))
+        dtIg = np.logical_or(dtIg, np.logical_and(dtm == 0, np.repeat(a, T, 0)))
         # store results for given image and category
         return {
-                'image_id':     imgId,
-                'category_id':  catId,
-                'aRng':         aRng,
-                'maxDet':       maxDet,
-                'dtIds':        [d['id'] for d in dt],
-                'gtIds':        [g['id'] for g in gt],
                 'dtMatches':    dtm,
-                'gtMatches':    gtm,
-                'dtScores':     [d['score'] for d in dt],
+                'dtScores':     self._dt['score'][dt],
                 'gtIgnore':     gtIg,
                 'dtIgnore':     dtIg,
             }
@@ -847,15 +672,8 @@ class AntCOCODet(AntMeasure):
     def _accumulate(self):
         '''
         Accumulate per image evaluation results and store the result in self.eval
-        :param p: input params for evaluation
         :return: None
         '''
-        if not self.evalImgs:
-            print('Please run evaluate() first')
-        # allows input customized parameters
-        # if p is None:
-        #     p = self.params
-
         T           = len(self.iouThrs)
         R           = len(self.recThrs)
         K           = len(self.catIds)
@@ -864,29 +682,13 @@ class AntCOCODet(AntMeasure):
         precision   = -np.ones((T,R,K,A,M)) # -1 for the precision of absent categories
         recall      = -np.ones((T,K,A,M))
 
-        # create dictionary for future indexing
-        catIds = self.catIds
-        setK = set(catIds)
-        setA = set(map(tuple, self.areaRng))
-        setM = set(self.maxDets)
-        setI = set(self.imgIds)
-        # get inds to evaluate
-        k_list = [n for n, k in enumerate(self.catIds)  if k in setK]
-        m_list = [m for n, m in enumerate(self.maxDets) if m in setM]
-        a_list = [n for n, a in enumerate(map(lambda x: tuple(x), self.areaRng)) if a in setA]
-        i_list = [n for n, i in enumerate(self.imgIds)  if i in setI]
-        I0 = len(self.imgIds)
-        A0 = len(self.areaRng)
         # retrieve E at each category, area range, and max number of detections
-        for k, k0 in enumerate(k_list):
-            Nk = k0*A0*I0
-            for a, a0 in enumerate(a_list):
-                Na = a0*I0
-                for m, maxDet in enumerate(m_list):
-                    E = [self.evalImgs[Nk + Na + i] for i in i_list]
-                    E = [e for e in E if not e is None]
-                    if len(E) == 0:
-                        continue
+        for k in range(K):
+            for a in range(A):
+                E = self.evalImgs[k, a]
+                if len(E) == 0:
+                    continue
+                for m, maxDet in enumerate(self.maxDets):
                     dtScores = np.concatenate([e['dtScores'][0:maxDet] for e in E])
 
                     # different sorting method generates slightly different results.
@@ -902,8 +704,8 @@ class AntCOCODet(AntMeasure):
                     tps = np.logical_and(               dtm,  np.logical_not(dtIg) )
                     fps = np.logical_and(np.logical_not(dtm), np.logical_not(dtIg) )
 
-                    tp_sum = np.cumsum(tps, axis=1).astype(dtype=np.float)
-                    fp_sum = np.cumsum(fps, axis=1).astype(dtype=np.float)
+                    tp_sum = np.cumsum(tps, axis=1).astype(dtype=np.float64)
+                    fp_sum = np.cumsum(fps, axis=1).astype(dtype=np.float64)
                     for t, (tp, fp) in enumerate(zip(tp_sum, fp_sum)):
                         tp = np.array(tp)
                         fp = np.array(fp)
@@ -914,28 +716,15 @@ class AntCOCODet(AntMeasure):
 
                         if nd:
                             recall[t,k,a,m] = rc[-1]
+
+                            # precision envelope (suffix maximum) sampled at recall thresholds
+                            pr = np.maximum.accumulate(pr[::-1])[::-1]
+                            inds = np.searchsorted(rc, self.recThrs, side='left')
+                            q = pr[np.minimum(inds, nd - 1)]
                         else:
                             recall[t,k,a,m] = 0
 
-                        # numpy is slow without cython optimization for accessing elements
-                        # use python array gets significant speed improvement
-                        pr = pr.tolist(); q = q.tolist()
-
-                        for i in range(nd-1, 0, -1):
-                            if pr[i] > pr[i-1]:
-                                pr[i-1] = pr[i]
-
-                        inds = np.searchsorted(rc, self.recThrs, side='left')
-                        try:
-                            for ri, pi in enumerate(inds):
-                                if pi == len(pr):
-                                    q[ri] = pr[pi - 1]
-                                else:
-                                    q[ri] = pr[pi]
-                        except:
-                            pass
-
-                        precision[t,:,k,a,m] = np.array(q)
+                        precision[t,:,k,a,m] = q
         self.eval = {
             'counts': [T, R, K, A, M],
             'precision': precision,
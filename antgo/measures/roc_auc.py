@@ -6,6 +6,38 @@ import unittest
 import json
 
 
+def _tied_rank_2d(x):
+    """
+    Computes the tied rank of every row of x (-inf elements are ranked out and get rank 0).
+    Parameters
+    ----------
+    x : 2-D numpy array
+    Returns
+    -------
+    rank : 2-D numpy array (float)
+    """
+    rows, num = x.shape
+    order = np.argsort(x, axis=1, kind='mergesort')
+    sorted_x = np.take_along_axis(x, order, axis=1)
+    position = np.tile(np.arange(num), (rows, 1))
+
+    # first and last position of every tied group
+    group_start = np.ones((rows, num), dtype=np.bool_)
+    group_start[:, 1:] = sorted_x[:, 1:] != sorted_x[:, :-1]
+    group_end = np.ones((rows, num), dtype=np.bool_)
+    group_end[:, :-1] = group_start[:, 1:]
+    first = np.maximum.accumulate(np.where(group_start, position, 0), axis=1)
+    last = np.minimum.accumulate(np.where(group_end, position, num)[:, ::-1], axis=1)[:, ::-1]
+
+    # -inf elements are sorted first and don't occupy any rank
+    ninf = np.sum(sorted_x <= -float('inf'), axis=1, keepdims=True)
+    sorted_r = np.where(sorted_x > -float('inf'), (first + last) / 2.0 + 1 - ninf, 0.0)
+
+    r = np.zeros((rows, num))
+    np.put_along_axis(r, order, sorted_r, axis=1)
+    return r
+
+
 def tied_rank(x):
     """
     Computes the tied rank of elements in x.
@@ -18,34 +50,8 @@ def tied_rank(x):
     score : list of numbers
             The tied rank f each element in x
     """
-    sorted_x = sorted(zip(x, range(len(x))))
-    r = [0 for k in x]
-
-    cur_val = sorted_x[0][0]
-    offset = 0
-    for i in range(len(sorted_x)):
-        if sorted_x[i][0] > -float('inf'):
-            cur_val = sorted_x[i][0]
-            offset = i
-            break
-
-    last_rank = 0
-    for i in range(len(sorted_x)):
-        if sorted_x[i][0] <= -float('inf'):
-            continue
-
-        if cur_val != sorted_x[i][0]:
-            cur_val = sorted_x[i][0]
-            ioffset = i - offset
-            for j in range(last_rank, ioffset):
-                r[sorted_x[j + offset][1]] = float(last_rank+1+ioffset)/2.0
-            last_rank = ioffset
-
-        if i == len(sorted_x)-1:
-            ioffset = i - offset
-            for j in range(last_rank, ioffset+1):
-                r[sorted_x[j + offset][1]] = float(last_rank+ioffset+2)/2.0
-    return r
+    x = np.asarray(x, dtype=np.float64).reshape((1, -1))
+    return _tied_rank_2d(x)[0].tolist()
 
 
 def auc(actual, posterior):
@@ -84,14 +90,38 @@ def auc(actual, posterior):
         posterior = posterior[:, 0]
     posterior = np.reshape(posterior, [posterior.size])
 
-    r = tied_rank(posterior.tolist())
-    det_num = len(np.where(posterior > -float('inf'))[0])
-    det_positive_index = [i for i in range(len(actual)) if actual[i] == 1 and posterior[i] > -float('inf')]
-    det_num_positive = len(det_positive_index)
-    num_positive = len(np.where(actual == 1)[0])    # detected positive and missed positive
+    return float(batch_auc(actual.reshape((1, -1)), posterior.reshape((1, -1)))[0])
+
+
+def batch_auc(actual, posterior):
+    """
+    Computes AUC of every row (all classes or all bootstrap replicas) in a single call
+    Parameters
+    ----------
+    actual : 2-D numpy array of binary numbers
+             The ground truth value (row padding should be 0)
+    posterior : 2-D numpy array, same shape as actual
+                Score of every row (row padding should be -inf)
+    Returns
+    -------
+    score : numpy array
+            AUC of every row
+    """
+    actual = np.asarray(actual)
+    posterior = np.asarray(posterior, dtype=np.float64)
+    if actual.size == 0 or posterior.size == 0:
+        return None
+
+    positive = actual >= 1
+    detected = posterior > -float('inf')
+    r = _tied_rank_2d(posterior)
+
+    det_num = np.sum(detected, axis=1)
+    det_num_positive = np.sum(positive & detected, axis=1)
+    num_positive = np.sum(positive, axis=1)    # detected positive and missed positive
     det_num_negative = det_num - det_num_positive
 
-    det_sum_positive = sum([r[i] for i in det_positive_index])
+    det_sum_positive = np.sum(np.where(positive & detected, r, 0.0), axis=1)
     auc = ((det_sum_positive - det_num_positive * (det_num_positive + 1)/2.0) /
            (det_num_negative * num_positive + 0.000001))
     return auc
@@ -132,52 +162,24 @@ def roc(actual,posterior):
         posterior = posterior[:, 0]
     posterior = np.reshape(posterior, [posterior.size])
 
-    #
-    num = actual.shape[0]
     positive_num = len(np.where(actual == 1)[0])
-    negative_num = num - positive_num
+    negative_num = actual.shape[0] - positive_num
+    negative_num = negative_num if negative_num > 0 else negative_num + 0.0000000001
+    positive_num = positive_num if positive_num > 0 else positive_num + 0.0000000001
+
+    # descend order (tie is ordered by descend index)
+    index = np.argsort(posterior, kind='mergesort')[::-1]
+    index = index[posterior[index] > -float("inf")]
+    is_positive = actual[index] == 1
 
-    true_positive_num = 0.0
-    false_positive_num = 0.0
+    # false positive rate and true positive rate
+    fp = np.cumsum(~is_positive).astype(np.float64) / float(negative_num)
+    tp = np.cumsum(is_positive).astype(np.float64) / float(positive_num)
 
-    sorted_x = sorted(zip(posterior, range(len(posterior))), reverse=True)
     fp_thres = np.array(range(11)) * 0.1
+    if len(tp) == 0:
+        return np.zeros((len(fp_thres), 2), dtype=int)
 
-    fp = []
-    tp = []
-
-    for i in range(len(sorted_x)):
-        if posterior[sorted_x[i][1]] <= -float("inf"):
-            continue
-
-        if actual[sorted_x[i][1]] == 1:
-            true_positive_num += 1.0
-        else:
-            false_positive_num += 1.0
-
-        # false positive rate
-        negative_num = negative_num if negative_num > 0 else negative_num + 0.0000000001
-        fp_rate = false_positive_num / float(negative_num)
-        # true positive rate
-        positive_num = positive_num if positive_num > 0 else positive_num + 0.0000000001
-        tp_rate = true_positive_num / float(positive_num)
-
-        fp.append(fp_rate)
-        tp.append(tp_rate)
-
-    inds = np.searchsorted(fp, fp_thres, side='left')
-    x = [0 for _ in range(len(inds))]
-    y = [0 for _ in range(len(inds))]
-    try:
-        for ri, pi in enumerate(inds):
-            if pi == len(tp):
-                y[ri] = tp[pi - 1]
-                x[ri] = fp[pi - 1]
-            else:
-                y[ri] = tp[pi]
-                x[ri] = fp[pi]
-    except:
-        pass
-
-    xy = np.array([x, y])
+    inds = np.minimum(np.searchsorted(fp, fp_thres, side='left'), len(tp) - 1)
+    xy = np.array([fp[inds], tp[inds]])
     return xy.transpose()
@@ -16,6 +16,83 @@ __all__ = {'AntPixelAccuracySeg': ('PixelAccuracy', 'SEGMENTATION'),
            'AntFrequencyWeightedIOUSeg': ('FrequencyWeightedIOU', 'SEGMENTATION'),
            'AntMeanIOUBoundary': ('MeanIOUBoundary', 'SEGMENTATION'),
            }
+
+
+def _confusion_matrix(predict, gt, classes_num, stride=1):
+  # (classes_num + 1) x (classes_num + 1) confusion matrix (row: gt, column: predict),
+  # label out of [0, classes_num) is collected by the last row/column
+  gt = np.asarray(gt)
+  predict = np.asarray(predict)
+  if stride > 1 and gt.ndim >= 2:
+    # strided (nearest downsampled) evaluation
+    gt = gt[::stride, ::stride]
+    predict = predict[::stride, ::stride]
+
+  gt = gt.astype(np.int64).flatten()
+  predict = predict.astype(np.int64).flatten()
+  gt[(gt < 0) | (gt >= classes_num)] = classes_num
+  predict[(predict < 0) | (predict >= classes_num)] = classes_num
+
+  confusion = np.bincount(gt * (classes_num + 1) + predict, minlength=(classes_num + 1) * (classes_num + 1))
+  return confusion.reshape((classes_num + 1, classes_num + 1))
+
+
+def _segmentation_statistic(data, label, task, ids=None):
+  # per sample (n_ii, t_i, n_ji) of every class (n_ji is only counted for class in groundtruth),
+  # derived from per sample confusion matrix
+  classes_num = len(task.class_label)
+  stride = int(getattr(task, 'segmentation_stride', 1))
+  if label is not None:
+    data = zip(data, label)
+
+  statistic = []
+  for predict, gt in data:
+    sample_statistic = np.zeros((3, classes_num))
+    id = None
+    if type(gt) == dict:
+      if 'segmentation_map' not in gt:
+        statistic.append(sample_statistic.flatten())
+        if ids is not None:
+          ids.append(None)
+        continue
+
+      id = gt.get('id', None)
+      gt = gt['segmentation_map']
+
+    confusion = _confusion_matrix(predict, gt, classes_num, stride)
+    ti = np.sum(confusion[:classes_num, :], axis=1)
+    ji = np.sum(confusion[:, :classes_num], axis=0)
+    ji[ti == 0] = 0
+
+    sample_statistic[0] = np.diag(confusion)[:classes_num]
+    sample_statistic[1] = ti
+    sample_statistic[2] = ji
+    statistic.append(sample_statistic.flatten())
+    if ids is not None:
+      ids.append(id)
+
+  return np.array(statistic).reshape((-1, 3 * classes_num))
+
+
+def _split_segmentation_statistic(statistic, classes_num):
+  statistic = np.asarray(statistic).reshape((-1, 3, classes_num))
+  return statistic[:, 0, :], statistic[:, 1, :], statistic[:, 2, :]
+
+
+def _segmentation_sample_scores(statistic, ids, classes_num):
+  # per sample accuracy n_ii/t_i of every class in groundtruth
+  sample_nii, sample_ti, _ = _split_segmentation_statistic(statistic, classes_num)
+  sample_scores = []
+  for nii, ti, id in zip(sample_nii, sample_ti, ids):
+    if id is None:
+      continue
+
+    for l in np.where(ti > 0)[0].tolist():
+      sample_scores.append({'id': id, 'score': float(nii[l]) / float(ti[l]), 'category': l})
+
+  return sample_scores
+
+
 class AntPixelAccuracySeg(AntMeasure):
   def __init__(self, task):
     # paper: Jonathan Long, Evan Shelhamer, etc. Fully Convolutional Networks for Semantic Segmentation
@@ -25,67 +102,21 @@ class AntPixelAccuracySeg(AntMeasure):
 
     self.is_support_rank = True
 
-  def eva(self, data, label):
-    classes_num = len(self.task.class_label)
-
-    sum_nii = np.zeros((classes_num))
-    sum_ti = np.zeros((classes_num))
-
-    if label is not None:
-        data = zip(data, label)
+  def eva_statistic(self, data, label):
+    return _segmentation_statistic(data, label, self.task)
 
-    sample_scores = []
-    for predict, gt in data:
-      id = None
-      if type(gt) == dict:
-        if 'segmentation_map' not in gt:
-          continue
+  def eva_from_statistic(self, statistic):
+    sum_nii, sum_ti, _ = _split_segmentation_statistic(statistic, len(self.task.class_label))
+    return np.sum(sum_nii, axis=1) / (np.sum(sum_ti, axis=1) + 1e-6)
 
-        id = gt['id']
-        gt = gt['segmentation_map']
-      
-      gt_labels = set(gt.flatten())
-      for l in gt_labels:
-        l = int(l)
-        # if l == 0:
-        #   continue
-
-        p = np.where(gt == l)
-        sum_ti[l] += len(p[0])
-
-        predicted_l = predict[p]
-        nii = len(np.where(predicted_l == l)[0])
-        sum_nii[l] += nii
-        
-        if id is not None:
-          sample_scores.append({'id': id, 'score': float(nii) / float(len(p[0])), 'category': l})
-
-    val = np.sum(sum_nii) / (np.sum(sum_ti) + 1e-6)
-
-    # # temparary test statistic quantity
-    # # 1.step curve statistic
-    # curve_measure = {'name': 'MAP', 'value': [23.0, 11.0, 12.0], 'type': 'SCALAR', 'x': 'class',
-    #                                         'y': 'Mean Average Precision'}
-    #
-    # # 2.step histogram statistic
-    # histogram_measure = {'name': 'ROC', 'value': [[[0, 0], [1, 1], [2, 3]],
-    #                                                                      [[0, 3], [2, 5], [3, 0]]],
-    #                                             'type': 'CURVE', 'x': 'FP', 'y': 'TP',
-    #                                             'legend': ['class-0', 'class-1']}
-    #
-    # # 3.step matrix statistic
-    # matrix_measure = {'name': 'ccmm', 'value': (np.ones((3, 4)) * 3).tolist(), 'type': 'MATRIX',
-    #                                         'x': ['a', 'b', 'c', 'd'], 'y': ['x', 'y', 'z']}
-    #
-    # # 4.step image statistic
-    # random_img = np.random.random((100, 100))
-    # random_img = random_img * 255
-    # random_img = random_img.astype(np.uint8)
-    # image_measure = {'name': 'image', 'value': random_img, 'type': 'IMAGE'}
+  def eva(self, data, label):
+    ids = []
+    statistic = _segmentation_statistic(data, label, self.task, ids)
+    val = float(self.eva_from_statistic(np.sum(statistic, axis=0, keepdims=True))[0])
 
     return {'statistic': {'name': self.name,
                           'value': [{'name': self.name, 'value': val, 'type': 'SCALAR'}]},
-            'info': sample_scores}
+            'info': _segmentation_sample_scores(statistic, ids, len(self.task.class_label))}
 
 
 class AntMeanAccuracySeg(AntMeasure):
@@ -97,44 +128,20 @@ class AntMeanAccuracySeg(AntMeasure):
 
     self.is_support_rank = True
 
-  def eva(self, data, label):
-    classes_num = len(self.task.class_label)
-
-    sum_nii = np.zeros((classes_num))
-    sum_ti = np.zeros((classes_num))
-
-    if label is not None:
-      data = zip(data, label)
+  def eva_statistic(self, data, label):
+    return _segmentation_statistic(data, label, self.task)
 
-    sample_scores = []
-    for predict, gt in data:
-      id = None
-      if type(gt) == dict:
-        if 'segmentation_map' not in gt:
-          continue
+  def eva_from_statistic(self, statistic):
+    sum_nii, sum_ti, _ = _split_segmentation_statistic(statistic, len(self.task.class_label))
+    return np.mean(sum_nii / (sum_ti + 1e-6), axis=1)
 
-        id = gt['id']
-        gt = gt['segmentation_map']
-        
-      gt_labels = set(gt.flatten())
-      for l in gt_labels:
-        l = int(l)
-        # if l == 0:
-        #   continue
-
-        p = np.where(gt == l)
-        sum_ti[l] += len(p[0])
-
-        predicted_l = predict[p]
-        nii = len(np.where(predicted_l == l)[0])
-        sum_nii[l] += nii
-        
-        if id is not None:
-          sample_scores.append({'id': id, 'score': float(nii) / float(len(p[0])), 'category': l})
+  def eva(self, data, label):
+    ids = []
+    statistic = _segmentation_statistic(data, label, self.task, ids)
+    val = float(self.eva_from_statistic(np.sum(statistic, axis=0, keepdims=True))[0])
 
-    val = np.mean(sum_nii / (sum_ti + 1e-6))
     return {'statistic': {'name': self.name, 'value': [{'name': self.name, 'value': val, 'type': 'SCALAR'}]},
-            'info': sample_scores}
+            'info': _segmentation_sample_scores(statistic, ids, len(self.task.class_label))}
 
 
 class AntMeanIOUSeg(AntMeasure):
@@ -147,40 +154,16 @@ class AntMeanIOUSeg(AntMeasure):
 
     self.is_support_rank = True
 
-  def eva(self, data, label):
-    classes_num = len(self.task.class_label)
-
-    sum_nii = np.zeros((classes_num))
-    sum_ti = np.zeros((classes_num))
-    sum_ji = np.zeros((classes_num))
-
-    if label is not None:
-      data = zip(data, label)
-
-    for predict, gt in data:
-      id = None
-      if type(gt) == dict:
-        if 'segmentation_map' not in gt:
-          continue
-
-        id = gt['id']
-        gt = gt['segmentation_map']
-  
-      gt_labels = set(gt.flatten())
-      for l in gt_labels:
-        l = int(l)
-        # if l == 0:
-        #   continue
-        p = np.where(gt == l)
-        sum_ti[l] += len(p[0])
+  def eva_statistic(self, data, label):
+    return _segmentation_statistic(data, label, self.task)
 
-        predicted_l = predict[p]
-        nii = len(np.where(predicted_l == l)[0])
-        sum_nii[l] += nii
+  def eva_from_statistic(self, statistic):
+    sum_nii, sum_ti, sum_ji = _split_segmentation_statistic(statistic, len(self.task.class_label))
+    return np.mean(sum_nii / (sum_ti + sum_ji - sum_nii + 1e-6), axis=1)
 
-        sum_ji[l] += len(np.where(predict == l)[0])
-        
-    val = np.mean(sum_nii / (sum_ti + sum_ji - sum_nii + 1e-6))
+  def eva(self, data, label):
+    statistic = _segmentation_statistic(data, label, self.task)
+    val = float(self.eva_from_statistic(np.sum(statistic, axis=0, keepdims=True))[0])
     return {'statistic': {'name': self.name, 'value': [{'name': self.name, 'value': val, 'type':'SCALAR'}]}}
 
 
@@ -194,40 +177,16 @@ class AntFrequencyWeightedIOUSeg(AntMeasure):
 
     self.is_support_rank = True
 
-  def eva(self, data, label):
-    classes_num = len(self.task.class_label)
-
-    sum_nii = np.zeros((classes_num))
-    sum_ti = np.zeros((classes_num))
-    sum_ji = np.zeros((classes_num))
-
-    if label is not None:
-        data = zip(data, label)
-
-    for predict, gt in data:
-      id = None
-      if type(gt) == dict:
-        if 'segmentation_map' not in gt:
-          continue
-
-        id = gt['id']
-        gt = gt['segmentation_map']
-  
-      gt_labels = set(gt.flatten())
-      for l in gt_labels:
-        l = int(l)
-        # if l == 0:
-        #     continue
-        p = np.where(gt == l)
-        sum_ti[l] += len(p[0])
+  def eva_statistic(self, data, label):
+    return _segmentation_statistic(data, label, self.task)
 
-        predicted_l = predict[p]
-        nii = len(np.where(predicted_l == l)[0])
-        sum_nii[l] += nii
+  def eva_from_statistic(self, statistic):
+    sum_nii, sum_ti, sum_ji = _split_segmentation_statistic(statistic, len(self.task.class_label))
+    return np.sum(sum_ti * sum_nii / (sum_ti + sum_ji - sum_nii + 1e-6), axis=1) / (np.sum(sum_ti, axis=1) + 1e-6)
 
-        sum_ji[l] += len(np.where(predict == l)[0])
-
-    val = np.sum(sum_ti * sum_nii / (sum_ti + sum_ji - sum_nii + 1e-6)) / (np.sum(sum_ti) + 1e-6)
+  def eva(self, data, label):
+    statistic = _segmentation_statistic(data, label, self.task)
+    val = float(self.eva_from_statistic(np.sum(statistic, axis=0, keepdims=True))[0])
     return {'statistic': {'name': self.name, 'value': [{'name': self.name, 'value': val, 'type': 'SCALAR'}]}}
 
 
@@ -6,26 +6,128 @@ from __future__ import division
 from __future__ import unicode_literals
 from __future__ import print_function
 from antgo.dataflow.basic import *
+from antgo.dataflow.column import *
+import multiprocessing
 import numpy as np
-import random
+import shutil
+import tempfile
+
+
+def bootstrap_resample_counts(num, replicas, seed, block_size=1 << 23):
+  # resample count matrix (block x num) of bootstrap replicas, yielded block by block
+  rng = np.random.RandomState(int(seed) % (1 << 32))
+  block = max(1, min(replicas, int(block_size // max(num, 1))))
+  for start in range(0, replicas, block):
+    counts = np.zeros((min(block, replicas - start), num))
+    for i in range(counts.shape[0]):
+      counts[i] = np.bincount(rng.randint(0, num, num), minlength=num)
+    yield counts
+
+
+def bootstrap_replica_index(num, seed, replica):
+  # every replica has its own seed, so result doesn't depend on worker number
+  rng = np.random.RandomState((int(seed) + replica) % (1 << 32))
+  return rng.randint(0, num, num)
+
+
+# column record readers opened in bootstrap worker process
+_bootstrap_readers = {}
+
+
+def _bootstrap_replica_worker(args):
+  record_paths, measure, num, seed, replicas = args
+  replicas_values = []
+  for replica in replicas:
+    index = bootstrap_replica_index(num, seed, replica)
+    values = []
+    for record_path in record_paths:
+      if record_path not in _bootstrap_readers:
+        _bootstrap_readers[record_path] = ColumnRecordReader(record_path)
+      record_generator = _bootstrap_readers[record_path].iterate_sampling_read(index, 'predict', 'groundtruth')
+      result = measure.eva(record_generator, None)
+      values.append(result['statistic']['value'][0]['value'])
+    replicas_values.append(values)
+  return replicas_values
+
+
+def _bootstrap_replicas(data_sources, measure, seed, replicas, processes):
+  # (replicas x len(data_sources)) measure values, decoded records are shared by memory mapped column record
+  num = data_sources[0].size
+  record_paths = []
+  temp_paths = []
+  for data_source in data_sources:
+    if isinstance(data_source, ColumnRecordReader):
+      record_paths.append(data_source._record_path)
+      continue
+
+    temp_path = tempfile.mkdtemp()
+    with ColumnRecordWriter(temp_path) as record_writer:
+      for predict, gt in data_source.iterate_read('predict', 'groundtruth'):
+        record_writer.write(Sample(predict=predict, groundtruth=gt))
+    record_paths.append(temp_path)
+    temp_paths.append(temp_path)
+
+  try:
+    if processes is None:
+      processes = multiprocessing.cpu_count()
+    processes = max(1, min(processes, replicas))
+
+    chunks = [list(range(replicas))[i::processes * 4] for i in range(min(replicas, processes * 4))]
+    tasks = [(record_paths, measure, num, seed, chunk) for chunk in chunks]
+    if processes == 1:
+      chunks_values = [_bootstrap_replica_worker(task) for task in tasks]
+    else:
+      pool = multiprocessing.Pool(processes)
+      try:
+        chunks_values = pool.map(_bootstrap_replica_worker, tasks)
+      finally:
+        pool.close()
+        pool.join()
+
+    values = np.zeros((replicas, len(data_sources)))
+    for chunk, chunk_values in zip(chunks, chunks_values):
+      values[chunk] = chunk_values
+    return values
+  finally:
+    for temp_path in temp_paths:
+      _bootstrap_readers.pop(temp_path, None)
+      shutil.rmtree(temp_path)
+
+
+def _sufficient_statistic(data_source, measure):
+  if not measure.is_support_statistic:
+    return None
+
+  statistic = measure.eva_statistic(data_source.iterate_read('predict', 'groundtruth'), None)
+  if statistic is None:
+    return None
+
+  statistic = np.asarray(statistic, dtype=np.float64)
+  assert(statistic.shape[0] == data_source.size)
+  return statistic
 
 
-def bootstrap_confidence_interval(data_source, seed, measure, replicas=50):
+def bootstrap_confidence_interval(data_source, seed, measure, replicas=50, processes=None):
   num = data_source.size
-  random.seed(seed)
-  bootstrap_samples = [[random.randint(0, num-1) for _ in range(num)] for _ in range(replicas)]
+
+  # vectorized bootstrap (all replicas are weighted sum of per sample statistic)
+  statistic = _sufficient_statistic(data_source, measure)
+  if statistic is not None:
+    estimated_measure = measure.eva_from_statistic(np.sum(statistic, axis=0, keepdims=True))[0]
+    bootstrap_estimated_measures = \
+      np.concatenate([measure.eva_from_statistic(np.dot(counts, statistic))
+                      for counts in bootstrap_resample_counts(num, replicas, seed)])
+    return _percentile_interval(estimated_measure, bootstrap_estimated_measures, replicas)
 
   result = measure.eva(data_source.iterate_read('predict', 'groundtruth'), None)
   estimated_measure = result['statistic']['value'][0]['value']
 
-  bootstrap_estimated_measures = []
-  for bootstrap_sample in bootstrap_samples:
-    record_generator = data_source.iterate_sampling_read(bootstrap_sample, 'predict', 'groundtruth')
-    result = measure.eva(record_generator, None)
+  # replicas are evaluated in process pool
+  bootstrap_estimated_measures = _bootstrap_replicas([data_source], measure, seed, replicas, processes)[:, 0]
+  return _percentile_interval(estimated_measure, bootstrap_estimated_measures, replicas)
 
-    value = result['statistic']['value'][0]['value']
-    bootstrap_estimated_measures.append(value)
 
+def _percentile_interval(estimated_measure, bootstrap_estimated_measures, replicas):
   delta_measure = estimated_measure - np.array(bootstrap_estimated_measures)
   sorted_delta_measure = np.sort(delta_measure)
 
@@ -51,27 +153,27 @@ def bootstrap_direct_confidence_interval(bootstrap_estimated_measures):
   return (measure_025, measure_975)
 
 
-def bootstrap_ab_significance_compare(ab_data_source, seed, measure, replicas=50):
+def bootstrap_ab_significance_compare(ab_data_source, seed, measure, replicas=50, processes=None):
   assert(ab_data_source[0].size == ab_data_source[1].size)
   num = ab_data_source[0].size
-  random.seed(seed)
-  bootstrap_samples = [[random.randint(0, num-1) for _ in range(num)] for _ in range(replicas)]
-
-  a_bootstrap_scores = []
-  for bootstrap_sample in bootstrap_samples:
-    record_generator = ab_data_source[0].iterate_sampling_read(bootstrap_sample, 'predict', 'groundtruth')
-    result = measure.eva(record_generator, None)
-    value = result['statistic']['value'][0]['value']
-    a_bootstrap_scores.append(value)
-
-  b_bootstrap_scores = []
-  for bootstrap_sample in bootstrap_samples:
-    record_generator = ab_data_source[1].iterate_sampling_read(bootstrap_sample, 'predict', 'groundtruth')
-    result = measure.eva(record_generator, None)
-    value = result['statistic']['value'][0]['value']
-    b_bootstrap_scores.append(value)
-
-  diff_bootstrap_scores = np.array(a_bootstrap_scores) - np.array(b_bootstrap_scores)
+
+  # vectorized bootstrap (a and b share resample counts)
+  a_statistic = _sufficient_statistic(ab_data_source[0], measure)
+  if a_statistic is not None:
+    b_statistic = _sufficient_statistic(ab_data_source[1], measure)
+    diff_bootstrap_scores = []
+    for counts in bootstrap_resample_counts(num, replicas, seed):
+      diff_bootstrap_scores.append(measure.eva_from_statistic(np.dot(counts, a_statistic)) -
+                                   measure.eva_from_statistic(np.dot(counts, b_statistic)))
+    return _significance_compare(np.concatenate(diff_bootstrap_scores), measure, replicas)
+
+  # replicas are evaluated in process pool (a and b share resample index)
+  ab_bootstrap_scores = _bootstrap_replicas(ab_data_source, measure, seed, replicas, processes)
+  diff_bootstrap_scores = ab_bootstrap_scores[:, 0] - ab_bootstrap_scores[:, 1]
+  return _significance_compare(diff_bootstrap_scores, measure, replicas)
+
+
+def _significance_compare(diff_bootstrap_scores, measure, replicas):
   sorted_diff_scores = np.sort(diff_bootstrap_scores)
 
   # percentile method (B.Efron 1981)
@@ -0,0 +1,302 @@
+# -*- coding: UTF-8 -*-
+# @Time    : 18-6-2
+# @File    : benchmark.py
+# @Author  : jian<jian@mltalker.com>
+from __future__ import division
+from __future__ import unicode_literals
+from __future__ import print_function
+import os
+import shutil
+import tempfile
+import time
+import numpy as np
+from antgo.utils import logger
+
+
+def _timeit(func, *args, **kwargs):
+  start = time.time()
+  func(*args, **kwargs)
+  return time.time() - start
+
+
+def benchmark_record_write(num=10000, sample_shape=(32, 32), batch_size=1000, record_dir=None):
+  # samples/sec of unbatched and batched RecordWriter
+  from antgo.dataflow.basic import RecordWriter, Sample
+
+  root_dir = record_dir if record_dir is not None else tempfile.mkdtemp()
+  samples = [Sample(groundtruth=np.random.randint(0, 255, sample_shape).astype(np.uint8),
+                    predict=np.random.randint(0, 255, sample_shape).astype(np.uint8)) for _ in range(num)]
+
+  def _write(path, size):
+    with RecordWriter(path, batch_size=size) as record_writer:
+      for sample in samples:
+        record_writer.write(sample)
+
+  result = {}
+  try:
+    for name, size in [('unbatched', 1), ('batched', batch_size)]:
+      elapsed_time = _timeit(_write, os.path.join(root_dir, name), size)
+      result[name] = num / max(elapsed_time, 1e-9)
+      logger.info('record write (%s) %.2f samples/sec' % (name, result[name]))
+  finally:
+    if record_dir is None:
+      shutil.rmtree(root_dir)
+
+  return result
+
+
+def benchmark_gather_multiprocs(num=2000, image_shape=(224, 224, 3), nr=2, cache_bytes=64*1024*1024):
+  # samples/sec of GatherMultiProcs with pickling queue and shared memory slots
+  from antgo.dataflow.core import Node
+  from antgo.utils.concurrency import GatherMultiProcs
+
+  class _ImageNode(Node):
+    def __init__(self):
+      super(_ImageNode, self).__init__(name='image')
+      self._image = np.random.randint(0, 255, image_shape).astype(np.uint8)
+
+    def iterator_value(self):
+      for i in range(num // nr):
+        yield self._image, i
+
+  def _gather(gather):
+    for _ in gather.iterator_value():
+      pass
+
+  result = {}
+  for name, size in [('queue', 0), ('shared memory', cache_bytes)]:
+    gather = GatherMultiProcs(_ImageNode(), nr=nr, cache_bytes=size, slot_bytes=int(np.prod(image_shape)))
+    # first epoch includes process launch
+    _gather(gather)
+    elapsed_time = _timeit(_gather, gather)
+    result[name] = (num // nr) * nr / max(elapsed_time, 1e-9)
+    logger.info('gather multiprocs (%s) %.2f samples/sec' % (name, result[name]))
+
+  return result
+
+
+def benchmark_node_chain(num=10000, depth=10):
+  # per sample overhead (us) of recursive and compiled evaluation of a node chain
+  from antgo.dataflow.core import Input, Node
+
+  def _chain():
+    entry_node = Input(name='entry')
+    end_node = entry_node
+    for _ in range(depth):
+      end_node = Node(action=lambda x: x, inputs=Node.inputs(end_node))
+    return entry_node, end_node
+
+  def _run(entry_node, end_node):
+    for i in range(num):
+      entry_node.set_value(i)
+      end_node.get_value()
+
+  result = {}
+  for name in ['recursive', 'compiled']:
+    entry_node, end_node = _chain()
+    if name == 'compiled':
+      end_node.compile()
+    elapsed_time = _timeit(_run, entry_node, end_node)
+    result[name] = elapsed_time / num * 1e6
+    logger.info('node chain (%s, depth %d) %.2f us/sample' % (name, depth, result[name]))
+
+  return result
+
+
+def benchmark_coco_evaluation(num=5000, category_num=80, gt_num=7, det_num=100, processes=None):
+  # seconds of COCO evaluation on synthetic COCO-val sized set (serial and process pool)
+  from antgo.measures.objdect_task import AntCOCODet
+
+  class _Task(object):
+    task_type = 'OBJECT-DETECTION'
+    class_label = list(range(category_num))
+
+  rng = np.random.RandomState(0)
+  samples = []
+  for i in range(num):
+    gt_bbox = np.hstack([rng.randint(0, 500, (gt_num, 2)), rng.randint(4, 200, (gt_num, 2))]).astype(np.float64)
+    gt = {'id': i,
+          'bbox': gt_bbox,
+          'area': gt_bbox[:, 2] * gt_bbox[:, 3],
+          'category_id': rng.randint(0, category_num, gt_num),
+          'iscrowd': (rng.rand(gt_num) < 0.01).astype(np.int32)}
+
+    # half of detections jitter around gt
+    det_bbox = np.hstack([rng.randint(0, 500, (det_num, 2)), rng.randint(4, 200, (det_num, 2))]).astype(np.float64)
+    det_label = rng.randint(0, category_num, det_num)
+    near_gt = rng.randint(0, gt_num, det_num // 2)
+    det_bbox[:det_num // 2] = np.maximum(gt_bbox[near_gt] + rng.randint(-8, 9, (det_num // 2, 4)), 1)
+    det_label[:det_num // 2] = gt['category_id'][near_gt]
+    predict = {'det-bbox': det_bbox,
+               'det-score': rng.rand(det_num).astype(np.float32),
+               'det-label': det_label}
+    samples.append((predict, gt))
+
+  result = {}
+  for name, nr in [('serial', 1), ('pool', processes)]:
+    _Task.coco_processes = nr
+    measure = AntCOCODet(_Task())
+    result[name] = _timeit(measure.eva, samples, None)
+    logger.info('coco evaluation (%s) %.2f sec' % (name, result[name]))
+
+  return result
+
+
+def benchmark_segmentation_evaluation(num=20, shape=(1024, 2048), category_num=19, strides=(1, 2, 4)):
+  # seconds of MeanIOU evaluation on synthetic cityscapes sized maps (full and strided)
+  from antgo.measures.segmentation_task import AntMeanIOUSeg
+
+  class _Task(object):
+    task_type = 'SEGMENTATION'
+    class_label = list(range(category_num))
+
+  rng = np.random.RandomState(0)
+  samples = []
+  for i in range(num):
+    gt = rng.randint(0, category_num, shape).astype(np.uint8)
+    predict = np.where(rng.rand(*shape) < 0.8, gt, rng.randint(0, category_num, shape)).astype(np.uint8)
+    samples.append((predict, {'id': i, 'segmentation_map': gt}))
+
+  result = {}
+  for stride in strides:
+    _Task.segmentation_stride = stride
+    measure = AntMeanIOUSeg(_Task())
+    result[stride] = _timeit(measure.eva, samples, None)
+    logger.info('segmentation evaluation (stride %d) %.2f sec' % (stride, result[stride]))
+
+  return result
+
+
+def benchmark_geometric_augmentation(num=20, image_shape=(1024, 1024, 3), resize_shape=(900, 900)):
+  # ms/sample of Flip -> Resize -> DisturbRotation stage, resampled after every node and fused into one warp
+  from antgo.dataflow.core import Input, Node
+  from antgo.dataflow.imgaug.regular import Flip, Resize, DisturbRotation
+
+  image = np.random.randint(0, 255, image_shape).astype(np.uint8)
+  bbox = np.array([[10.0, 20.0, 300.0, 400.0]])
+
+  def _run(entry_node, end_node):
+    for _ in range(num):
+      entry_node.set_value((image, {'bbox': bbox}))
+      end_node.get_value()
+
+  result = {}
+  for name in ['sequential', 'fused']:
+    entry_node = Input(name='image')
+    nodes = [Flip(Node.inputs(entry_node), horiz=True, prob=1.0)]
+    nodes.append(Resize(Node.inputs(nodes[-1]), resize_shape))
+    nodes.append(DisturbRotation(Node.inputs(nodes[-1])))
+    end_node = Node(action=lambda x: x, inputs=Node.inputs(nodes[-1]))
+    if name == 'sequential':
+      for node in nodes:
+        node._is_fused = lambda: False
+
+    elapsed_time = _timeit(_run, entry_node, end_node)
+    result[name] = elapsed_time / num * 1000
+    logger.info('geometric augmentation (%s) %.2f ms/sample' % (name, result[name]))
+
+  return result
+
+
+def benchmark_batch_augmentation(batch_size=64, image_shape=(224, 224, 3), num=5):
+  # us/sample of photometric augmentation per sample and on BatchData batch
+  from antgo.dataflow.core import Input, Node
+  from antgo.dataflow.imgaug.regular import Subtract, DisturbLighting, DisturbNoise, DisturbChannels, \
+    BatchSubtract, BatchDisturbLighting, BatchDisturbNoise, BatchDisturbChannels
+
+  batch = np.random.randint(0, 255, (batch_size,) + image_shape).astype(np.uint8)
+
+  def _chain(node_types):
+    entry_node = Input(name='image')
+    end_node = entry_node
+    for node_type in node_types:
+      end_node = node_type(Node.inputs(end_node))
+    return entry_node, end_node
+
+  def _run_sample():
+    entry_node, end_node = _chain([Subtract, DisturbLighting, DisturbNoise, DisturbChannels])
+    for _ in range(num):
+      for image in batch:
+        entry_node.set_value((image, {}))
+        end_node.get_value()
+
+  def _run_batch():
+    entry_node, end_node = _chain([BatchSubtract, BatchDisturbLighting, BatchDisturbNoise, BatchDisturbChannels])
+    for _ in range(num):
+      entry_node.set_value((batch, None))
+      end_node.get_value()
+
+  result = {}
+  for name, func in [('sample', _run_sample), ('batch', _run_batch)]:
+    result[name] = _timeit(func) / (num * batch_size) * 1e6
+    logger.info('photometric augmentation (%s) %.2f us/sample' % (name, result[name]))
+
+  return result
+
+
+def benchmark_dht_ingestion(num=2000, sample_shape=(128, 128, 3), block_num=20, threads_num=4, latency=0.05):
+  # MB/s of dht dataset ingestion (download, decode and write into db) from local mock block server
+  import functools
+  import multiprocessing
+  import threading
+  from http.server import HTTPServer, SimpleHTTPRequestHandler
+  from socketserver import ThreadingMixIn
+  from antgo.dataflow.basic import RecordReader
+  from antgo.utils.dht import dataset_dump_blocks, dataset_download_dht, dataset_record_dht, HTTPFetcher
+
+  class _BlockHandler(SimpleHTTPRequestHandler):
+    def do_GET(self):
+      # simulate network latency
+      time.sleep(latency)
+      SimpleHTTPRequestHandler.do_GET(self)
+
+    def log_message(self, format, *args):
+      pass
+
+  class _BlockServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+  root_dir = tempfile.mkdtemp()
+  samples = [(np.random.randint(0, 255, sample_shape).astype(np.uint8), {'category_id': i % 10}) for i in range(num)]
+  dataset_dump_blocks('benchmark', {'train': {'generator': iter(samples), 'num': num, 'block': block_num}},
+                      os.path.join(root_dir, 'blocks'))
+  blocks_bytes = sum([os.path.getsize(os.path.join(root_dir, 'blocks', f)) for f in os.listdir(os.path.join(root_dir, 'blocks'))])
+
+  server = _BlockServer(('127.0.0.1', 0), functools.partial(_BlockHandler, directory=root_dir))
+  server_thread = threading.Thread(target=server.serve_forever)
+  server_thread.daemon = True
+  server_thread.start()
+
+  def _ingest(dataset_folder, nr):
+    record_reader = RecordReader(os.path.join(dataset_folder, 'train'), read_only=False)
+    data_queue = multiprocessing.Queue(maxsize=64)
+    dht_process = multiprocessing.Process(target=dataset_download_dht,
+                                          args=(dataset_folder,
+                                                'train',
+                                                'blocks',
+                                                data_queue,
+                                                record_reader,
+                                                nr,
+                                                HTTPFetcher('http://127.0.0.1:%d' % server.server_address[1])))
+    dht_process.start()
+
+    count = data_queue.get()['count']
+    ok_ids = []
+    while len(ok_ids) < count:
+      with record_reader.batch_writer() as record_writer:
+        ok_ids.extend(dataset_record_dht(record_writer, data_queue.get()))
+    dht_process.join()
+
+  result = {}
+  try:
+    for name, nr in [('single thread', 1), ('pipeline', threads_num)]:
+      dataset_folder = os.path.join(root_dir, name.replace(' ', '_'))
+      os.makedirs(os.path.join(dataset_folder, 'train'))
+      elapsed_time = _timeit(_ingest, dataset_folder, nr)
+      result[name] = blocks_bytes / 1024.0 / 1024.0 / max(elapsed_time, 1e-9)
+      logger.info('dht ingestion (%s) %.2f MB/s' % (name, result[name]))
+  finally:
+    server.shutdown()
+    shutil.rmtree(root_dir)
+
+  return result
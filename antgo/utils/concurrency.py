@@ -6,6 +6,8 @@ from __future__ import unicode_literals
 
 import threading
 import multiprocessing
+import ctypes
+import numpy as np
 import atexit
 import bisect
 from contextlib import contextmanager
@@ -23,7 +25,8 @@ from . import logger
 
 __all__ = ['StoppableThread', 'LoopThread','TimerThread', 'ensure_proc_terminate',
            'OrderedResultGatherProc', 'OrderedContainer', 'DIE',
-           'mask_sigint', 'start_proc_mask_signal', 'StoppableProcess', 'GatherMultiProcs']
+           'mask_sigint', 'start_proc_mask_signal', 'StoppableProcess', 'GatherMultiProcs',
+           'SharedMemorySlots']
 
 
 class StoppableThread(threading.Thread):
@@ -196,6 +199,109 @@ class OrderedContainer(object):
     return rank, ret
 
 
+class _SlotRef(object):
+  """ A placeholder of numpy array stored in shared memory slot """
+  def __init__(self, index):
+    self.index = index
+
+
+class SharedMemorySlots(object):
+  """
+  Preallocated shared memory slots. Numpy payload of a datapoint is written into a free slot,
+  and only a small descriptor is transferred by queue. Datapoint without free slot (or too large
+  for one slot) is transferred as it is.
+  """
+  def __init__(self, nr_slots, slot_bytes):
+    self.nr_slots = nr_slots
+    self.slot_bytes = slot_bytes
+    self._buffer = multiprocessing.RawArray(ctypes.c_uint8, max(nr_slots * slot_bytes, 1))
+    self._view = None
+    self._free_slots = multiprocessing.Queue()
+    for slot in range(nr_slots):
+      self._free_slots.put(slot)
+
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    state['_view'] = None
+    return state
+
+  @property
+  def view(self):
+    if self._view is None:
+      self._view = np.frombuffer(self._buffer, dtype=np.uint8)
+    return self._view
+
+  def _flatten(self, obj, arrays):
+    if type(obj) == np.ndarray and obj.dtype != np.object_:
+      arrays.append(obj)
+      return _SlotRef(len(arrays) - 1)
+    elif type(obj) == list:
+      return [self._flatten(o, arrays) for o in obj]
+    elif type(obj) == tuple:
+      return tuple([self._flatten(o, arrays) for o in obj])
+    elif type(obj) == dict:
+      return {k: self._flatten(v, arrays) for k, v in obj.items()}
+    return obj
+
+  def _restore(self, obj, arrays):
+    if type(obj) == _SlotRef:
+      return arrays[obj.index]
+    elif type(obj) == list:
+      return [self._restore(o, arrays) for o in obj]
+    elif type(obj) == tuple:
+      return tuple([self._restore(o, arrays) for o in obj])
+    elif type(obj) == dict:
+      return {k: self._restore(v, arrays) for k, v in obj.items()}
+    return obj
+
+  def pack(self, obj, block=False):
+    """ write numpy payload of obj into a free slot and return descriptor """
+    arrays = []
+    structure = self._flatten(obj, arrays)
+
+    # 8 bytes aligned offset for every array
+    offsets = []
+    nbytes = 0
+    for array in arrays:
+      offsets.append(nbytes)
+      nbytes += (array.nbytes + 7) // 8 * 8
+
+    if self.nr_slots == 0 or len(arrays) == 0 or nbytes > self.slot_bytes:
+      return None, obj
+
+    try:
+      slot = self._free_slots.get(block)
+    except queue.Empty:
+      return None, obj
+
+    meta = []
+    slot_offset = slot * self.slot_bytes
+    for array, offset in zip(arrays, offsets):
+      start = slot_offset + offset
+      self.view[start:start + array.nbytes] = np.ascontiguousarray(array).view(np.uint8).reshape(-1)
+      meta.append((offset, array.dtype.str, array.shape))
+
+    return slot, (structure, meta)
+
+  def unpack(self, descriptor):
+    """ rebuild datapoint from descriptor and release its slot """
+    slot, payload = descriptor
+    if slot is None:
+      return payload
+
+    structure, meta = payload
+    slot_offset = slot * self.slot_bytes
+    arrays = []
+    for offset, dtype, shape in meta:
+      dtype = np.dtype(dtype)
+      start = slot_offset + offset
+      nbytes = int(np.prod(shape)) * dtype.itemsize
+      arrays.append(self.view[start:start + nbytes].view(dtype).reshape(shape).copy())
+
+    self._free_slots.put(slot)
+    return self._restore(structure, arrays)
+
+
 class OrderedResultGatherProc(multiprocessing.Process):
   """
   Gather indexed data from a data queue, and produce results with the
@@ -263,58 +369,67 @@ class StoppableProcess(multiprocessing.Process):
   
   
 class GatherMultiProcs(object):
+  """
+  Run ``data_flow`` in ``nr`` processes and gather their datapoints. Numpy payload is
+  transferred by :class:`SharedMemorySlots`, so only small descriptors go through the queue.
+  Every process reports its own epoch end and waits on its own event for the next epoch.
+  """
   @staticmethod
-  def process_func(data_flow, data_pipe, condition):
+  def process_func(data_flow, data_pipe, slots, epoch_event, worker_id):
     # 1.step prepare random seed for current pid
     seed = (os.getpid() +
             int(datetime.now().strftime("%Y%m%d%H%M%S%f"))) % 4294967295
     random.seed(seed)
-    
+
     while True:
-      # 2.step put in queue
+      # 2.step put in queue (blocks until a slot is free)
       for data in data_flow.iterator_value():
-        data_pipe.put(data)
-      
-      # 3.step add DIE flag
-      with condition:
-        data_pipe.put(DIE)
-        condition.wait()
-
-  def __init__(self, data_flow, nr=2, cache=2):
+        data_pipe.put((worker_id, slots.pack(data, block=True)))
+
+      # 3.step add DIE flag and wait for next epoch
+      data_pipe.put((worker_id, DIE))
+      epoch_event.wait()
+      epoch_event.clear()
+
+  def __init__(self, data_flow, nr=2, cache=2, cache_bytes=None, slot_bytes=4*1024*1024):
+    """
+    :param data_flow: dataflow running in every process
+    :param nr: number of processes
+    :param cache: number of cached datapoints per process (used when cache_bytes is None)
+    :param cache_bytes: bytes of shared memory cache, 0 falls back to pickling queue
+    :param slot_bytes: bytes of one shared memory slot (one datapoint)
+    """
     self._is_running = False
     self._nr = nr
-    self._queue = multiprocessing.Queue(nr * cache)
-    self._condition = multiprocessing.Condition()
+    if cache_bytes is None:
+      cache_bytes = nr * cache * slot_bytes
+
+    nr_slots = cache_bytes // slot_bytes if slot_bytes > 0 else 0
+    self._slots = SharedMemorySlots(nr_slots, slot_bytes)
+    self._queue = multiprocessing.Queue(max(nr_slots, nr * cache))
+    self._epoch_events = [multiprocessing.Event() for _ in range(nr)]
     self._processes = [multiprocessing.Process(target=GatherMultiProcs.process_func,
-                       args=(data_flow, self._queue, self._condition)) for _ in range(nr)]
+                       args=(data_flow, self._queue, self._slots, self._epoch_events[i], i)) for i in range(nr)]
 
     for p in self._processes:
       p.daemon = True
-  
+
   def iterator_value(self):
-    assert(self._queue.empty())
-    
-    # launch all processes
     if not self._is_running:
+      # launch all processes
       for p in self._processes:
         p.start()
       self._is_running = True
-    
-    # notify all waiting processes
-    with self._condition:
-      self._condition.notify_all()
-
-    while True:
-      data = self._queue.get()
+    else:
+      # every process has finished last epoch, notify them
+      for evt in self._epoch_events:
+        evt.set()
+
+    finished = [False] * self._nr
+    while not all(finished):
+      worker_id, data = self._queue.get()
       if data == DIE:
-        DIE_nr = 1
-        # waiting until nr DIE
-        while DIE_nr < self._nr:
-          temp = self._queue.get()
-          if temp == DIE:
-            DIE_nr += 1
-          else:
-            yield temp
-          
-        raise StopIteration
-      yield data
\ No newline at end of file
+        finished[worker_id] = True
+        continue
+
+      yield self._slots.unpack(data)
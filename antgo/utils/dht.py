@@ -12,9 +12,11 @@ import subprocess
 import json
 import traceback
 import threading
+import hashlib
 import sys
 from antgo.dataflow.basic import *
 from antgo.utils.serialize import *
+from antgo.utils import logger
 import numpy as np
 import shutil
 
@@ -30,18 +32,57 @@ Config = config.AntConfig
 
 
 class FuncThread(threading.Thread):
-  def __init__(self, func, blocks, data_q):
+  def __init__(self, func, *args):
     threading.Thread.__init__(self)
     self._func = func
-    self._blocks = blocks
-    self._data_q = data_q
+    self._args = args
     self.daemon = True
 
   def run(self):
-    self._func(self._blocks, self._data_q)
+    self._func(*self._args)
 
 
-def dataset_upload_dht(dataset_name, data_generators, dump_dir):
+def block_checksum(block_path):
+  # md5 of block file (read in chunks)
+  md5 = hashlib.md5()
+  with open(block_path, 'rb') as fp:
+    for chunk in iter(lambda: fp.read(1024*1024), b''):
+      md5.update(chunk)
+  return md5.hexdigest()
+
+
+class IPFSFetcher(object):
+  # pull file from local ipfs daemon into folder
+  def __init__(self, host='127.0.0.1', port=5001):
+    self._host = host
+    self._port = port
+    self._local = threading.local()
+
+  def __call__(self, address, folder):
+    import ipfsapi
+    # one connection for every thread
+    if getattr(self._local, 'ipfs', None) is None:
+      self._local.ipfs = ipfsapi.connect(self._host, self._port)
+    self._local.ipfs.get(address, filepath=folder)
+
+
+class HTTPFetcher(object):
+  # pull file from http gateway (ipfs gateway or mirror)
+  def __init__(self, gateway, chunk_size=1024*1024):
+    self._gateway = gateway
+    self._chunk_size = chunk_size
+
+  def __call__(self, address, folder):
+    file_path = os.path.join(folder, address.split('/')[-1])
+    res = requests.get('%s/%s' % (self._gateway, address), stream=True)
+    res.raise_for_status()
+    with open('%s.tmp' % file_path, 'wb') as fp:
+      for chunk in res.iter_content(self._chunk_size):
+        fp.write(chunk)
+    os.rename('%s.tmp' % file_path, file_path)
+
+
+def dataset_dump_blocks(dataset_name, data_generators, dump_dir):
   dataset_readme = {}
 
   if not os.path.exists(dump_dir):
@@ -66,6 +107,7 @@ def dataset_upload_dht(dataset_name, data_generators, dump_dir):
     blocks_content = []
     blocks_name = ['%s_%s_block_%d'%(dataset_name, dataset_c, bi) for bi in range(block_num)]
     blocks_index = {}
+    blocks_checksum = {}
 
     block_size = int(int(dataset_num) // int(block_num))
 
@@ -79,6 +121,8 @@ def dataset_upload_dht(dataset_name, data_generators, dump_dir):
       if current_block_index != block_index:
         with open(os.path.join(dump_dir, blocks_name[current_block_index]), 'wb') as fp:
           fp.write(dumps(blocks_content))
+        blocks_checksum[blocks_name[current_block_index]] = \
+          block_checksum(os.path.join(dump_dir, blocks_name[current_block_index]))
 
         blocks_content = []
         current_block_index = block_index
@@ -94,6 +138,8 @@ def dataset_upload_dht(dataset_name, data_generators, dump_dir):
 
     with open(os.path.join(dump_dir, blocks_name[current_block_index]), 'wb') as fp:
       fp.write(dumps(blocks_content))
+    blocks_checksum[blocks_name[current_block_index]] = \
+      block_checksum(os.path.join(dump_dir, blocks_name[current_block_index]))
 
     # dataset sample number
     dataset_readme['%s_count'%dataset_c] = dataset_num
@@ -101,11 +147,18 @@ def dataset_upload_dht(dataset_name, data_generators, dump_dir):
     dataset_readme['%s_block'%dataset_c] = blocks_name
     # dataset block sample index
     dataset_readme['%s_index'%dataset_c] = blocks_index
+    # dataset block checksum (verify download and resume)
+    dataset_readme['%s_checksum'%dataset_c] = blocks_checksum
 
   # save readme
   with open(os.path.join(dump_dir, 'readme.yaml'), 'w') as fp:
     yaml.safe_dump(dataset_readme, fp)
 
+
+def dataset_upload_dht(dataset_name, data_generators, dump_dir):
+  # split to blocks
+  dataset_dump_blocks(dataset_name, data_generators, dump_dir)
+
   # upload to dht
   short_dir = dump_dir.split('/')[-1]
   s = subprocess.Popen('ipfs add -r %s'%short_dir,
@@ -124,109 +177,150 @@ def dataset_upload_dht(dataset_name, data_generators, dump_dir):
   return dataset_hash_code
 
 
-def dataset_download_dht(dataset_folder, train_or_test, dht_address, data_queue, db, threads_num):
-  # 1.step download dataset readme.yaml
-  import ipfsapi
-  ipfs = ipfsapi.connect('127.0.0.1', 5001)
+def dataset_download_dht(dataset_folder,
+                         train_or_test,
+                         dht_address,
+                         data_queue,
+                         db,
+                         threads_num,
+                         fetcher=None,
+                         chunk_size=256,
+                         retry=3):
+  # data_queue receives
+  # (1) {'count': ...} - dataset sample number
+  # (2) [index, ...] - samples already in db
+  # (3) [(index, data, label), ..., (block, checksum)] - samples pulled from dht, block is finished at the end
+  # (4) [(block, None)] - block failed after all retries (dataset couldn't be complete)
+  if fetcher is None:
+    fetcher = IPFSFetcher()
 
-  if not os.path.exists(os.path.join(dataset_folder,'temp')):
-    os.makedirs(os.path.join(dataset_folder,'temp'))
+  # 1.step download dataset readme.yaml
+  temp_folder = os.path.join(dataset_folder, 'temp')
+  if not os.path.exists(temp_folder):
+    os.makedirs(temp_folder)
 
-  os.chdir(os.path.join(dataset_folder,'temp'))
-  ipfs.get('%s/readme.yaml' % dht_address)
+  temp_folder = os.path.abspath(temp_folder)
+  fetcher('%s/readme.yaml' % dht_address, temp_folder)
 
-  with open(os.path.join(dataset_folder, 'temp', 'readme.yaml'),'r') as fp:
-    readme_config = yaml.load(fp)
+  with open(os.path.join(temp_folder, 'readme.yaml'),'r') as fp:
+    readme_config = yaml.safe_load(fp)
     # notify dataset sample number
     data_queue.put({'count': readme_config['%s_count'%train_or_test]})
 
-  # all data blocks and their index
+  # all data blocks, their index and checksum
   block_list = readme_config['%s_block'%train_or_test]
   block_index_list = readme_config['%s_index'%train_or_test]
+  block_checksum_list = readme_config.get('%s_checksum'%train_or_test, {})
 
-  # 2.step download data block in parallel
-  ok_block_list = []
+  # 2.step skip blocks which have been finished (resume)
   ok_index_list = []
-
-  for b in block_list:
-    if db.get(b) is not None:
-      ok_block_list.append(b)
-      ok_index_list.extend(block_index_list[b])
+  waiting_block_q = queue.Queue()
+  for block_name in block_list:
+    block_record = db.get(block_name)
+    if block_record is not None and block_record.decode('utf-8') == block_checksum_list.get(block_name, 'true'):
+      ok_index_list.extend(block_index_list[block_name])
+    else:
+      waiting_block_q.put(block_name)
 
   # notify prepared block index
   if len(ok_index_list) > 0:
     data_queue.put(ok_index_list)
 
-  # prepare waiting blocks
-  block_address_list = [(block_index, '%s/%s' % (dht_address, block_name)) for block_index, block_name in
-                        enumerate(block_list) if block_name not in ok_block_list]
-
-  if len(block_address_list) == 0:
+  if waiting_block_q.qsize() == 0:
     return
 
-  # continue download data from dht
-  def _pull_from_dht(block_addresses, data_q):
-    local_ipfs = ipfsapi.connect('127.0.0.1', 5001)
-
-    for block_index, block_address in block_addresses:
+  # 3.step download data blocks in parallel
+  # every thread takes next waiting block once it is free, so slow block doesnt stall others
+  def _pull_from_dht(waiting_q, ready_q):
+    while True:
       try:
-        # 1.step pull
-        local_ipfs.get(block_address)
-
-        # 3.step read content from block
-        data_q.put((block_index, block_address.split('/')[-1]))
-      except:
-        pass
-
-    data_q.put(None)
-
-  waiting_block_num = len(block_address_list)
-  if waiting_block_num < threads_num:
-    threads_num = waiting_block_num
-
-  blocks_in_thread = int(int(waiting_block_num) / int(threads_num))
-  assign_responsability_blocks = [None for _ in range(threads_num)]
-  for s in range(threads_num - 1):
-    assign_responsability_blocks[s] = block_address_list[s*blocks_in_thread:(s+1)*blocks_in_thread]
-
-  assign_responsability_blocks[threads_num-1] = block_address_list[(threads_num-1)*blocks_in_thread:]
+        block_name = waiting_q.get_nowait()
+      except queue.Empty:
+        break
 
-  q = queue.Queue()
+      block_path = os.path.join(temp_folder, block_name)
+      expected_checksum = block_checksum_list.get(block_name, None)
+      for _ in range(retry):
+        try:
+          # downloaded block file is reused after crash
+          if expected_checksum is None or \
+              not os.path.exists(block_path) or block_checksum(block_path) != expected_checksum:
+            fetcher('%s/%s' % (dht_address, block_name), temp_folder)
+
+          if expected_checksum is not None and block_checksum(block_path) != expected_checksum:
+            logger.warn('block %s checksum mismatch' % block_name)
+            continue
+
+          ready_q.put((block_name, True))
+          break
+        except:
+          logger.warn('fail to pull block %s' % block_name)
+      else:
+        logger.error('give up block %s' % block_name)
+        ready_q.put((block_name, False))
+
+    ready_q.put(None)
+
+  threads_num = min(threads_num, waiting_block_q.qsize())
+  ready_block_q = queue.Queue()
   # initialize thread
-  process_threads = [FuncThread(_pull_from_dht, assign_responsability_blocks[i], q) for i in range(threads_num)]
+  process_threads = [FuncThread(_pull_from_dht, waiting_block_q, ready_block_q) for _ in range(threads_num)]
   # launch thread
   for pt in process_threads:
     pt.start()
 
+  # 4.step decode blocks in stream (overlap with download), notify samples in chunks
   none_num = threads_num
-  while True:
-    content = q.get()
-    if content == None:
+  while none_num > 0:
+    block = ready_block_q.get()
+    if block is None:
       none_num -= 1
-      if none_num == 0:
-        break
-
-    if content is not None:
-      block_index, block_file = content
-
-      ok_samples = []
-      with open(os.path.join(dataset_folder, 'temp', block_file), 'rb') as fp:
-        # parse content
-        binary_content = fp.read()
-        data_list = loads(binary_content)
-
-        for a,b,c in data_list:
-          ok_samples.append((a, b, c, block_file))
-
-      # notfiy prepared block
-      if len(ok_samples) > 0:
-        data_queue.put(ok_samples)
+      continue
+
+    block_name, is_ok = block
+    if not is_ok:
+      # notify failed block, so that consumer doesnt wait for its samples
+      data_queue.put([(block_name, None)])
+      continue
+
+    ok_samples = []
+    with open(os.path.join(temp_folder, block_name), 'rb') as fp:
+      for a, b, c in loads_stream(fp):
+        if len(ok_samples) == chunk_size:
+          data_queue.put(ok_samples)
+          ok_samples = []
+        ok_samples.append((a, b, c))
+
+    # block is finished together with its last samples
+    ok_samples.append((block_name, block_checksum_list.get(block_name, 'true')))
+    data_queue.put(ok_samples)
 
   # wating until all stop
   for pt in process_threads:
     pt.join()
 
 
+def dataset_record_dht(record_writer, data_list):
+  # write content from dataset_download_dht into db, return sample index in it
+  ok_ids = []
+  for data in data_list:
+    if type(data) != tuple:
+      # sample has been in db
+      ok_ids.append(int(data))
+    elif len(data) == 3:
+      data_index, data_info, data_label = data
+      record_writer.write(Sample(data=data_info, label=data_label), data_index)
+      ok_ids.append(data_index)
+    else:
+      # record block (written together with its last samples)
+      block_name, checksum = data
+      if checksum is None:
+        raise IOError('fail to download dataset block %s' % block_name)
+      record_writer.put(block_name, checksum)
+
+  return ok_ids
+
+
 def experiment_download_dht(dump_dir, experiment, pwd, token):
   # call in an independent process
   try:
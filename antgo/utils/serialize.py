@@ -11,7 +11,7 @@ import msgpack_numpy
 msgpack_numpy.patch()
 
 import json
-__all__ = ['loads', 'dumps', 'Encoder', 'Decoder']
+__all__ = ['loads', 'loads_fields', 'loads_stream', 'dumps', 'Encoder', 'Decoder']
 
 
 def dumps(obj):
@@ -22,6 +22,28 @@ def loads(buf):
   return msgpack.loads(buf,encoding='utf-8')
 
 
+def loads_fields(buf, fields):
+  # decode only the requested fields of a serialized dict (others are skipped without building objects)
+  unpacker = msgpack.Unpacker(encoding='utf-8')
+  unpacker.feed(buf)
+
+  data = {}
+  for _ in range(unpacker.read_map_header()):
+    key = unpacker.unpack()
+    if key in fields:
+      data[key] = unpacker.unpack()
+    else:
+      unpacker.skip()
+  return data
+
+
+def loads_stream(fp, read_size=1024*1024):
+  # decode items of a serialized list from file one by one (list is never fully in memory)
+  unpacker = msgpack.Unpacker(fp, read_size=read_size, encoding='utf-8')
+  for _ in range(unpacker.read_array_header()):
+    yield unpacker.unpack()
+
+
 class Decoder(json.JSONDecoder):
   def __init__(self):
     json.JSONDecoder.__init__(self, object_hook=self.dict_to_object)
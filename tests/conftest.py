@@ -0,0 +1,4 @@
+# encoding=utf-8
+# @File    : conftest.py
+# antgo.utils has to be imported before antgo.dataflow (antgo.utils.net imports antgo.dataflow.core)
+import antgo.utils
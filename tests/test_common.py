@@ -0,0 +1,27 @@
+# encoding=utf-8
+# @File    : test_common.py
+from __future__ import division
+from __future__ import unicode_literals
+from __future__ import print_function
+import numpy as np
+from antgo.dataflow.common import BatchData
+
+
+def test_aggregate_label_type_stable():
+  # one object per sample and ragged objects give the same (per sample list) type
+  same = BatchData._aggregate_label([{'category': ['a'], 'info': (2, 3, 3)},
+                                     {'category': ['b'], 'info': (4, 5, 3)}])
+  ragged = BatchData._aggregate_label([{'category': ['a'], 'info': (2, 3, 3)},
+                                       {'category': ['b', 'c'], 'info': (4, 5, 3)}])
+  assert same['category'] == [['a'], ['b']]
+  assert ragged['category'] == [['a'], ['b', 'c']]
+
+  # fixed arity tuple is collated by position
+  assert type(same['info']) == tuple
+  assert same['info'][0].tolist() == [2, 4]
+
+
+def test_aggregate_label_missing_key():
+  collated = BatchData._aggregate_label([{'id': 0, 'segmentation': [np.zeros((2, 2))]}, {'id': 1}])
+  assert collated['id'].tolist() == [0, 1]
+  assert collated['segmentation'][1] is None
@@ -0,0 +1,39 @@
+# encoding=utf-8
+# @File    : test_dataset.py
+from __future__ import division
+from __future__ import unicode_literals
+from __future__ import print_function
+import numpy as np
+from antgo.utils.serialize import dumps, loads
+from antgo.dataflow.dataset.dataset import Dataset
+
+
+class _Dataset(Dataset):
+  def data_pool(self):
+    pass
+
+
+def test_filter_by_condition_transform_record_label():
+  # label decoded from record (read only category_id), all objects are kept
+  label = loads(dumps({'category': ['a', 'b'],
+                       'category_id': np.array([1, 2]),
+                       'bbox': np.array([[0.0, 0.0, 10.0, 10.0], [0.0, 0.0, 20.0, 20.0]])}))
+  category_id = label['category_id']
+
+  dataset = _Dataset('train', None, {'excluded': ['z'], 'transform': {'a': 7}})
+  filtered = dataset.filter_by_condition(label)
+  assert filtered['category_id'].tolist() == [7, 2]
+  assert filtered['category'] == ['a', 'b']
+  # caller's category_id is untouched
+  assert category_id.tolist() == [1, 2]
+
+
+def test_filter_by_condition_writable_label():
+  category_id = np.array([1, 2, 3])
+  label = {'category': ['a', 'b', 'c'], 'category_id': category_id}
+
+  dataset = _Dataset('train', None, {'included': ['a', 'c'], 'transform': {'c': 9}})
+  filtered = dataset.filter_by_condition(label)
+  assert filtered['category_id'].tolist() == [1, 9]
+  assert filtered['category'] == ['a', 'c']
+  assert category_id.tolist() == [1, 2, 3]
@@ -0,0 +1,35 @@
+# encoding=utf-8
+# @File    : test_regular.py
+from __future__ import division
+from __future__ import unicode_literals
+from __future__ import print_function
+import numpy as np
+from antgo.dataflow.core import Input, Node
+from antgo.dataflow.imgaug.regular import Flip, Resize
+
+
+def test_geometric_branch_independent():
+  # Flip -> Resize(50,60) and Flip -> Resize(200,240), every branch has its own transform
+  image = np.random.randint(0, 255, (100, 120, 3)).astype(np.uint8)
+  annotation = {'bbox': np.array([[10.0, 20.0, 40.0, 60.0]]), 'info': (100, 120, 3)}
+
+  entry_node = Input(name='image')
+  flip_node = Flip(Node.inputs(entry_node), horiz=True, prob=1.0)
+  small_node = Node(action=lambda x: x, inputs=Node.inputs(Resize(Node.inputs(flip_node), (50, 60))))
+  large_node = Node(action=lambda x: x, inputs=Node.inputs(Resize(Node.inputs(flip_node), (200, 240))))
+
+  entry_node.set_value((image, annotation))
+  small_image, small_annotation = small_node.get_value()
+  large_image, large_annotation = large_node.get_value()
+
+  assert small_image.shape == (50, 60, 3)
+  assert small_annotation['info'] == (50, 60, 3)
+  assert np.allclose(small_annotation['bbox'], [[39.5, 10.0, 54.5, 30.0]])
+
+  assert large_image.shape == (200, 240, 3)
+  assert large_annotation['info'] == (200, 240, 3)
+  assert np.allclose(large_annotation['bbox'], [[158.0, 40.0, 218.0, 120.0]])
+
+  # input annotation is untouched
+  assert np.allclose(annotation['bbox'], [[10.0, 20.0, 40.0, 60.0]])
+  assert annotation['info'] == (100, 120, 3)